@@ -77,7 +77,9 @@ def get_test_changes() {
         job: queue_job_name,
         parameters: [
             string(name: 'QUEUE_ACTION', value: 'get_next_test'),
-            string(name: 'ACTION_ARG', value: 'not-needed'),
+            // A unique value so Jenkins does not merge requests from
+            // parallel testers
+            string(name: 'ACTION_ARG', value: env.BUILD_TAG),
         ],
         wait: true,
     )
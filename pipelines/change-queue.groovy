@@ -22,8 +22,14 @@ def main() {
     }
     stage('triggering test job') {
         build_args = readJSON(file: 'build_args.json')
-        build_args['wait'] = false
-        build build_args
+        // We get a list of builds when bisecting in parallel
+        if(!(build_args instanceof List)) {
+            build_args = [build_args]
+        }
+        for(build_arg in build_args) {
+            build_arg['wait'] = false
+            build build_arg
+        }
     }
 }
 
@@ -36,7 +42,11 @@ def load_queue_state() {
     }
     step([
         $class: 'CopyArtifact',
-        filter: 'exported-artifacts/JenkinsChangeQueue.dat',
+        filter: 'exported-artifacts/JenkinsChangeQueue.dat, ' +
+            'exported-artifacts/JenkinsChangeQueue.journal, ' +
+            // The status files are copied so they do not need to be written
+            // again if the queue action does not change the queue
+            'exported-artifacts/queue-status*',
         fingerprintArtifacts: true,
         projectName: env.JOB_NAME,
         selector: [$class: 'StatusBuildSelector', stable: false],
@@ -114,8 +114,10 @@ def get_generic_queue_build_args(
     withEnv(['PYTHONPATH=jenkins']) {
         def get_generic_queue_build_args = """\
             #!/usr/bin/env python
+            import json
             from os import environ
             from stdci_libs.change_queue import JenkinsChangeQueueClient
+            from stdci_libs.change_queue.build_registry import BuildRegistry
             from stdci_libs.change_queue.changes import (
                 GitMergedChange, GerritMergedChange
             )
@@ -127,8 +129,17 @@ def get_generic_queue_build_args(
                 change = GitMergedChange(
                     '$project', '$branch', '$sha'${url ? ", '$url'" : ""}
                 )
-            change.set_current_build_from_env()
-            jcqc.add(change).as_pipeline_build_step_json('${json_file}')
+            change.set_build_spec_from_env()
+            # If another queue already got builds for the change we pass them
+            # instead of the current build, so the build jobs can be skipped
+            registry = BuildRegistry.from_env()
+            reused_builds = change.set_builds_from_registry(registry)
+            if not reused_builds:
+                change.set_current_build_from_env()
+            build_step = jcqc.add(change).as_pipeline_build_step()
+            build_step['reused_builds'] = reused_builds
+            with open('${json_file}', 'w') as fil:
+                json.dump(build_step, fil)
         """.stripIndent()
         sh label: 'get_generic_queue_build_args', script: get_generic_queue_build_args
     }
@@ -21,6 +21,8 @@ def on_load(loader){
 @Field def project
 @Field def jobs
 @Field def queues
+@Field def build_jobs = []
+@Field def queues_with_reused_builds = []
 @Field def previous_build
 @Field Boolean wait_for_previous_build
 @Field Boolean call_beaker = false
@@ -57,7 +59,8 @@ def loader_main(loader) {
             def build_job_properties = dsl_lib.parse(
                 project.clone_dir_name, 'build-artifacts'
             )
-            jobs += build_job_properties.jobs
+            build_jobs = build_job_properties.jobs
+            jobs += build_jobs
         }
         stdci_runner_lib.remove_blacklisted_jobs(jobs)
         if(jobs.empty) {
@@ -108,6 +111,11 @@ def loader_main(loader) {
     if(!queues.empty) {
         stage('Queueing change') {
             enqueue_change(project, queues)
+            def all_reused = queues.every { it in queues_with_reused_builds }
+            if(!build_jobs.empty && all_reused) {
+                echo "All queues got existing builds, not running build jobs"
+                jobs -= build_jobs
+            }
         }
     }
     previous_build = null
@@ -342,6 +350,9 @@ def mk_enqueue_change_branch(project, String queue) {
         try {
             project.notify(ctx, 'PENDING', 'Submitting change to queue')
             build_args = project.get_queue_build_args(queue)
+            if(build_args.remove('reused_builds')) {
+                queues_with_reused_builds << queue
+            }
             build_args['wait'] = true
         } catch(Exception ea) {
             project.notify(ctx, 'ERROR', 'System error')
@@ -3,17 +3,29 @@
 """
 from __future__ import absolute_import, print_function
 from uuid import uuid4
-from itertools import chain
+from itertools import chain, islice
 from collections import deque, namedtuple
-from six.moves import map, reduce, range
+from six.moves import map, range
+from six.moves.urllib.request import Request, urlopen
 from copy import copy
-from os import path
+from os import path, environ, unlink, fsync
+from contextlib import contextmanager
+from hashlib import sha1
+from math import ceil
+from time import time
+from timeit import default_timer
+import json
 import logging
-from jinja2 import Environment, PackageLoader
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
 
+from .batch_sizing import BatchSizeModel
+from .build_registry import BuildRegistry
+from .metrics import Histogram, TextfileMetrics
+from .risk import FailureEstimator, even_split_points
 from .changes import DisplayableChangeWrapper, ChangeInStreamWrapper, \
-    ChangeWithBuildsWrapper
+    ChangeWithBuildsWrapper, ChangeWithPriorityWrapper
 from stdci_libs.jenkins_objects import JenkinsObject, JobRunSpec, BuildsList
+from stdci_libs.email_dispatcher import EmailDispatcher
 
 
 logger = logging.getLogger(__name__)
@@ -25,7 +37,8 @@ class ChangeQueue(object):
     change that caused a testing failure.
 
     The changes in the queue can be any kind of object but immutable objects
-    are preferred.
+    are preferred. Changes need to be hashable or have a hashable 'id'
+    attribute, since the queue keeps an index of where each change is located.
 
     Constructor arguments:
     :param Iterable initial_state: (Optional) The initial state of the queue,
@@ -36,7 +49,50 @@ class ChangeQueue(object):
 
     If test_key is specified (not None), then initial_state must have more then
     one member where the last member is the list of changes being tested
+
+    By default a failed batch of changes is split in two, and the first half
+    is tested. If 'bisect_ways' is set to a larger number k, failed batches are
+    split into k parts instead, and the k-1 leading prefixes of the batch are
+    tested in parallel. Each parallel test gets its own test key, and
+    get_next_test hands out a different test on every call until all of them
+    were handed out. This shortens the time it takes to find the failure
+    cause at the expense of running more tests.
+
+    If 'speculation_depth' is set to a positive number, the queue will also
+    speculatively start testing changes that arrive while a test is running,
+    on top of the changes being tested (like a merge train). Changes that
+    arrived are sealed into a new section, and a test for all the sections up
+    to and including it is handed out, up to 'speculation_depth' such tests at
+    a time. If an earlier test fails, the speculative tests are discarded.
+
+    Changes with a 'priority' attribute that is larger then 0 are placed in
+    priority lanes (one for each priority) rather then at the end of the
+    queue. When no tests are running, the lanes are moved to the head of the
+    queue, each lane as a section of its own with higher priorities first, so
+    they are tested before, and separately from, all other changes. If a
+    failed batch is being bisected at that time, the bisection is suspended
+    and resumes once all the priority changes were tested. No speculative
+    tests are started while changes wait in the lanes, so that the running
+    tests can finish and let the lanes start.
+
+    If 'adaptive_batching' is set to True, new batches are limited to the
+    size a BatchSizeModel finds best given the fraction of recent changes
+    that were rejected, and the test durations passed to
+    record_test_duration. Changes beyond that size wait for the next batch.
+
+    The queue also keeps a 'failure_estimator_class' object that learns how
+    likely changes are to fail from the outcomes of earlier changes. If
+    'risk_weighted_bisection' is set to True, failed batches are split so
+    that each part is about as likely to hold the failure, rather then into
+    parts of equal size. So changes that rarely fail are cleared in large
+    groups, while bisection focuses on the risky ones.
     """
+    bisect_ways = 2
+    speculation_depth = 0
+    adaptive_batching = False
+    risk_weighted_bisection = False
+    failure_estimator_class = FailureEstimator
+
     def __init__(self, initial_state=None, test_key=None):
         if initial_state is None:
             self._state = deque([deque()])
@@ -47,6 +103,136 @@ class ChangeQueue(object):
                 'test_key cannot be set when len(initial_state) < 2'
             )
         self._test_key = test_key
+        self._failing_prefix = self._initial_failing_prefix()
+        self._prefix_tests = dict()
+        self._undispatched_tests = deque()
+        self._priority_lanes = dict()
+        self._lane_sections = 0
+        self._suspended_prefix = 0
+        self._batch_model = BatchSizeModel()
+        self._failure_estimator = self.failure_estimator_class()
+        self._rebuild_index()
+
+    def _initial_failing_prefix(self):
+        # With plain bisection, a queue with more then two sections always
+        # has the two halves of a failed batch at its head
+        return 2 if len(self._state) > 2 else 0
+
+    def __getstate__(self):
+        # The change index is derived data, we leave it out of pickles so that
+        # the pickled state remains the same as the one of older versions
+        state = self.__dict__.copy()
+        state.pop('_change_index', None)
+        state.pop('_index_base', None)
+        state.pop('_lane_index', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_failing_prefix' not in state:
+            # Migrate queue state that was saved before we supported parallel
+            # bisection
+            self._failing_prefix = self._initial_failing_prefix()
+            self._prefix_tests = dict()
+            self._undispatched_tests = deque()
+        if '_priority_lanes' not in state:
+            # Migrate queue state that was saved before we had priority lanes
+            self._priority_lanes = dict()
+            self._lane_sections = 0
+            self._suspended_prefix = 0
+        if '_batch_model' not in state:
+            # Migrate queue state that was saved before we had adaptive
+            # batching
+            self._batch_model = BatchSizeModel()
+        if '_failure_estimator' not in state:
+            # Migrate queue state that was saved before we estimated change
+            # failure probabilities
+            self._failure_estimator = self.failure_estimator_class()
+        self._rebuild_index()
+
+    @staticmethod
+    def _change_id(change):
+        if hasattr(change, 'id'):
+            return change.id
+        else:
+            return change
+
+    @staticmethod
+    def _change_priority(change):
+        return ChangeWithPriorityWrapper(change).priority
+
+    def _rebuild_index(self):
+        """Build the change index from scratch
+
+        The index maps change IDs to lists of (batch serial, position) pairs.
+        Batch serials are converted to indices in self._state by subtracting
+        self._index_base, which allows removing and inserting batches at the
+        head of the queue without touching the index entries of other batches.
+        """
+        self._index_base = 0
+        self._change_index = dict()
+        for batch_idx in range(len(self._state)):
+            self._index_batch(batch_idx)
+        self._lane_index = dict(
+            (self._change_id(change), priority)
+            for priority, lane in self._priority_lanes.items()
+            for change in lane
+        )
+
+    def _index_batch(self, batch_idx):
+        serial = self._index_base + batch_idx
+        for pos, change in enumerate(self._state[batch_idx]):
+            self._change_index.setdefault(
+                self._change_id(change), []
+            ).append((serial, pos))
+
+    def _unindex_batch(self, batch_idx):
+        serial = self._index_base + batch_idx
+        for pos, change in enumerate(self._state[batch_idx]):
+            change_id = self._change_id(change)
+            locations = self._change_index[change_id]
+            locations.remove((serial, pos))
+            if not locations:
+                del self._change_index[change_id]
+
+    def _popleft_batch(self):
+        self._unindex_batch(0)
+        self._index_base += 1
+        return self._state.popleft()
+
+    def _pushleft_batch(self, batch):
+        self._state.appendleft(batch)
+        self._index_base -= 1
+        self._index_batch(0)
+
+    def _replace_batch(self, batch_idx, batch):
+        self._unindex_batch(batch_idx)
+        self._state[batch_idx] = batch
+        self._index_batch(batch_idx)
+
+    def _in_queue(self, change_id):
+        """Check if a change is in the queue or in one of the priority lanes
+        """
+        return change_id in self._change_index or change_id in self._lane_index
+
+    def locate(self, change_id):
+        """Find where a change is located in the queue
+
+        :param object change_id: The ID of the change to look for (for changes
+                                 that do not have an 'id' attribute, this is
+                                 the change itself)
+
+        :rtype: tuple
+        :returns: A (batch index, position) pair pointing to the location of
+                  the change in the queue state or None if the change is not
+                  in the queue. If several copies of the change were added,
+                  the location of the first one is returned.
+        """
+        locations = self._change_index.get(change_id)
+        if not locations:
+            return None
+        serial, pos = min(locations)
+        return serial - self._index_base, pos
 
     def add(self, change):
         """Add a change to the queue
@@ -56,7 +242,15 @@ class ChangeQueue(object):
                               positively)
         :returns: None
         """
+        priority = self._lane_priority(change)
+        if priority > 0:
+            self._priority_lanes.setdefault(priority, deque()).append(change)
+            self._lane_index[self._change_id(change)] = priority
+            return
         self._state[-1].append(change)
+        self._change_index.setdefault(self._change_id(change), []).append(
+            (self._index_base + len(self._state) - 1, len(self._state[-1]) - 1)
+        )
 
     def get_next_test(self):
         """Returns the next test that needs to be performed
@@ -67,18 +261,201 @@ class ChangeQueue(object):
                  If no test is needed the returned key is none and the list is
                  empty
         """
+        if self._priority_lanes and self._test_key is None and \
+                not self._prefix_tests and not self._lane_sections:
+            self._start_priority_lanes()
+        if self.adaptive_batching and self._test_key is None and \
+                len(self._state) == 1:
+            self._limit_new_batch()
         change_list = list(self._state[0])
         if change_list:
             if len(self._state) <= 1:
                 self._state.append([])
             if self._test_key is None:
-                self._test_key = str(uuid4())
+                self._test_key = self._new_test_key()
+                return (self._test_key, change_list)
+            self._plan_prefix_tests()
+            if self._undispatched_tests:
+                test_key = self._undispatched_tests.popleft()
+                return (test_key, self._prefix_changes(test_key))
+            if self._can_speculate():
+                test_key = self._start_speculative_test()
+                return (test_key, self._prefix_changes(test_key))
         return (self._test_key, change_list)
 
+    @staticmethod
+    def _new_test_key():
+        return str(uuid4())
+
+    def _limit_new_batch(self):
+        """Seal the changes that fit into a batch of the best size into a
+        section of their own, so that only they get tested
+        """
+        batch_size = self._batch_model.best_batch_size(self.bisect_ways)
+        if batch_size is None or len(self._state[0]) <= batch_size:
+            return
+        changes = list(self._state[0])
+        self._replace_batch(0, deque(changes[:batch_size]))
+        self._state.append(deque(changes[batch_size:]))
+        self._index_batch(1)
+
+    def record_test_duration(self, batch_size, duration):
+        """Record how long a test took, for choosing batch sizes when
+        'adaptive_batching' is set
+
+        :param int batch_size:  The amount of changes that were tested
+        :param float duration:  How long the test took
+        """
+        self._batch_model.record_test_duration(batch_size, duration)
+
+    def _lane_priority(self, change):
+        """Returns the priority lane a change should be placed in, or 0 if it
+        should be placed at the end of the queue
+        """
+        return self._change_priority(change)
+
+    def _start_priority_lanes(self):
+        """Move the priority lanes to the head of the queue, each lane into a
+        section of its own, with the highest priority first
+        """
+        for priority in sorted(self._priority_lanes):
+            lane = self._priority_lanes.pop(priority)
+            for change in lane:
+                self._lane_index.pop(self._change_id(change), None)
+            self._pushleft_batch(lane)
+            self._lane_sections += 1
+        # Failures in the lanes are bisected on their own, so we put aside
+        # what we know about the failing prefix of the rest of the queue
+        self._suspended_prefix = self._failing_prefix
+        self._failing_prefix = 0
+
+    def _end_lane_sections(self, removed):
+        """Update the amount of sections at the head of the queue that came
+        from priority lanes after sections were removed from the head, and
+        resume a suspended bisection if no such sections remain
+        """
+        self._lane_sections = max(0, self._lane_sections - removed)
+        if not self._lane_sections and self._suspended_prefix:
+            self._failing_prefix = self._suspended_prefix
+            self._suspended_prefix = 0
+
+    def priority_changes(self):
+        """Returns the changes waiting in the priority lanes
+
+        :rtype: list
+        :returns: A list of (priority, changes) pairs, with the highest
+                  priority first
+        """
+        return [
+            (priority, list(self._priority_lanes[priority]))
+            for priority in sorted(self._priority_lanes, reverse=True)
+        ]
+
+    def _prefix_changes(self, test_key):
+        return list(chain.from_iterable(
+            self._state[i] for i in range(self._test_prefix(test_key))
+        ))
+
+    def _can_speculate(self):
+        """Returns True if we can start a speculative test for changes that
+        arrived while other tests are running
+        """
+        return (
+            self.speculation_depth > 0 and
+            self._test_key is not None and
+            not self._priority_lanes and
+            self._failing_prefix == 0 and
+            self._suspended_prefix == 0 and
+            len(self._state) > 1 and
+            bool(self._state[-1]) and
+            len(self._prefix_tests) < self.speculation_depth
+        )
+
+    def _start_speculative_test(self):
+        # Seal the section of changes that arrived so far so that changes
+        # arriving later do not change what we are testing
+        self._state.append([])
+        test_key = self._new_test_key()
+        self._prefix_tests[test_key] = len(self._state) - 1
+        return test_key
+
+    def _plan_prefix_tests(self):
+        """Create test keys for the parallel tests of the prefixes of a failed
+        batch if we do not have them already
+        """
+        planned = set(self._prefix_tests.values())
+        for prefix in range(2, min(self._failing_prefix, self.bisect_ways)):
+            if prefix in planned:
+                continue
+            test_key = self._new_test_key()
+            self._prefix_tests[test_key] = prefix
+            self._undispatched_tests.append(test_key)
+
+    def tests_to_dispatch(self):
+        """Returns the amount of tests that can be started right now
+
+        :rtype: int
+        :returns: The amount of times get_next_test can be called before it
+                  starts returning tests that were already handed out. This is
+                  1 unless parallel bisection or speculation are enabled.
+        """
+        unplanned = set(
+            range(2, min(self._failing_prefix, self.bisect_ways))
+        ) - set(self._prefix_tests.values())
+        return max(1, sum((
+            len(self._undispatched_tests),
+            len(unplanned),
+            int(self._test_key is None),
+            int(self._can_speculate()),
+        )))
+
+    def _test_prefix(self, test_key):
+        """Returns the amount of queue sections tested by the given test key or
+        None if the test key is unknown
+        """
+        if test_key is None:
+            return None
+        if test_key == self._test_key:
+            return 1
+        return self._prefix_tests.get(test_key)
+
+    def _forget_prefix_tests(self, min_prefix):
+        """Forget about parallel tests of prefixes that are known to fail
+        """
+        self._prefix_tests = dict(
+            (key, prefix) for key, prefix in self._prefix_tests.items()
+            if prefix < min_prefix
+        )
+        self._drop_stale_undispatched_tests()
+
+    def _shift_prefix_tests(self, removed):
+        """Update parallel tests after sections were removed from the head of
+        the queue. Tests of shorter prefixes are moot now, and the rest test
+        fewer sections
+        """
+        shifted = dict(
+            (key, prefix - removed)
+            for key, prefix in self._prefix_tests.items() if prefix > removed
+        )
+        self._test_key = next(
+            (key for key, prefix in shifted.items() if prefix == 1), None
+        )
+        self._prefix_tests = dict(
+            (key, prefix) for key, prefix in shifted.items() if prefix > 1
+        )
+        self._drop_stale_undispatched_tests()
+
+    def _drop_stale_undispatched_tests(self):
+        self._undispatched_tests = deque(
+            key for key in self._undispatched_tests
+            if self._test_prefix(key) is not None
+        )
+
     def test_key_match(self, test_key):
         """Returns True if the given test_key matches the last generated one
+        or one of the in-flight parallel tests
         """
-        return test_key is not None and test_key == self._test_key
+        return self._test_prefix(test_key) is not None
 
     def on_test_success(self, test_key):
         """Updated the queue when a test is successful
@@ -97,14 +474,24 @@ class ChangeQueue(object):
                   The changes in the returned lists will be removed from the
                   queue. On ignored calls empty lists are returned
         """
-        if not self.test_key_match(test_key):
+        tested_prefix = self._test_prefix(test_key)
+        if tested_prefix is None:
             return [], [], None
-        success_list = list(self._state.popleft())
-        if len(self._state) > 1:
+        success_list = list(chain.from_iterable(
+            self._popleft_batch() for _ in range(tested_prefix)
+        ))
+        self._record_outcomes(success_list, [])
+        self._shift_prefix_tests(tested_prefix)
+        self._failing_prefix = max(0, self._failing_prefix - tested_prefix)
+        self._end_lane_sections(tested_prefix)
+        if self._failing_prefix == 1:
+            # We know the failure is in the section at the head of the queue
+            self._test_key = test_key
             _, fail_list, cause = self.on_test_failure(test_key)
         else:
             fail_list, cause = [], None
-        self._test_key = None
+        if self._test_key == test_key:
+            self._test_key = None
         return success_list, fail_list, cause
 
     def on_test_failure(self, test_key):
@@ -128,19 +515,162 @@ class ChangeQueue(object):
                   returned changes will be removed from the queue. On ignored
                   calls empty lists are returned
         """
-        if not self.test_key_match(test_key):
+        tested_prefix = self._test_prefix(test_key)
+        if tested_prefix is None:
+            return [], [], None
+        # Parallel tests of longer prefixes would fail too
+        self._forget_prefix_tests(min_prefix=tested_prefix)
+        if tested_prefix > 1:
+            # We need to wait for the tests of shorter prefixes to know which
+            # section has the failure
+            self._failing_prefix = tested_prefix
             return [], [], None
         self._test_key = None
-        fail_list = list(self._state.popleft())
+        fail_list = list(self._popleft_batch())
+        in_lane = self._lane_sections > 0
         if len(fail_list) == 1:
-            self._state = deque([deque(chain.from_iterable(self._state))])
+            self._record_outcomes([], fail_list)
+            self._failing_prefix = 0
+            if in_lane:
+                # Only merge the rest of the lanes, the rest of the queue may
+                # have a suspended bisection
+                lanes_rest = deque(chain.from_iterable(
+                    self._popleft_batch()
+                    for _ in range(self._lane_sections - 1)
+                ))
+                self._lane_sections = 0
+                if lanes_rest:
+                    self._pushleft_batch(lanes_rest)
+                    self._lane_sections = 1
+                self._end_lane_sections(0)
+            else:
+                self._state = deque([deque(chain.from_iterable(self._state))])
+                self._rebuild_index()
             return [], fail_list, next(iter(fail_list), None)
-        self._state.extendleft([
-            deque(fail_list[int(len(fail_list)/2):]),
-            deque(fail_list[:int(len(fail_list)/2)])
-        ])
+        ways = max(2, min(self.bisect_ways, len(fail_list)))
+        points = [0] + self._split_points(fail_list, ways) + [len(fail_list)]
+        for start, end in reversed(list(zip(points, points[1:]))):
+            self._pushleft_batch(deque(fail_list[start:end]))
+        if in_lane:
+            self._lane_sections += ways - 1
+        self._failing_prefix = ways
         return [], [], None
 
+    def _split_points(self, changes, ways):
+        """Returns the indexes where the 2nd to last parts of a failed batch
+        should start when splitting it to 'ways' parts
+        """
+        if self.risk_weighted_bisection:
+            return self._failure_estimator.split_points(changes, ways)
+        return even_split_points(len(changes), ways)
+
+    def _record_outcomes(self, success_list, fail_list):
+        """Update the batch size model and the failure estimator with the
+        changes that were found to pass or fail
+        """
+        self._batch_model.record_outcomes(len(success_list), len(fail_list))
+        for change in success_list:
+            self._failure_estimator.record_outcome(change, False)
+        for change in fail_list:
+            self._failure_estimator.record_outcome(change, True)
+
+
+class AwaitingDeps(object):
+    """The side queue of changes that wait for their dependencies to be added
+    to a ChangeQueueWithDeps
+
+    Iterating over it yields (change, missing dependencies) pairs in the order
+    they were added. The pairs are indexed by the IDs of their changes and by
+    the IDs of the changes they wait for, so finding and removing pairs costs
+    time proportional to the amount of pairs found rather then to the size of
+    the side queue.
+
+    Constructor arguments:
+    :param Iterable entries: (Optional) The initial (change, missing
+                             dependencies) pairs
+    """
+    def __init__(self, entries=()):
+        # Maps serial numbers given to pairs as they are added to the pairs
+        # and to the dependency IDs they were indexed by
+        self._entries = dict()
+        # The serial numbers in the order pairs were added. Serial numbers of
+        # removed pairs are skipped over and cleaned up lazily
+        self._order = deque()
+        self._next_serial = 0
+        self._by_change = dict()
+        self._by_dep = dict()
+        for entry in entries:
+            self.append(entry)
+
+    def __getstate__(self):
+        # The indexes are derived data, so we only store the pairs
+        return dict(entries=list(self))
+
+    def __setstate__(self, state):
+        self.__init__(state['entries'])
+
+    def __iter__(self):
+        return (
+            self._entries[serial][0] for serial in self._order
+            if serial in self._entries
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, entry):
+        """Add a (change, missing dependencies) pair at the end of the side
+        queue
+        """
+        change, missing_deps = entry
+        serial = self._next_serial
+        self._next_serial += 1
+        dep_ids = tuple(missing_deps)
+        self._entries[serial] = (entry, dep_ids)
+        self._order.append(serial)
+        self._by_change.setdefault(
+            ChangeQueue._change_id(change), set()
+        ).add(serial)
+        for dep_id in dep_ids:
+            self._by_dep.setdefault(dep_id, set()).add(serial)
+
+    def waiting_for(self, dep_id):
+        """Returns the pairs of the changes that wait for the given change ID,
+        in the order they were added
+        """
+        return [
+            self._entries[serial][0]
+            for serial in sorted(self._by_dep.get(dep_id, ()))
+        ]
+
+    def remove_by_ids(self, change_ids):
+        """Remove the pairs of the changes with the given IDs
+
+        :param Iterable change_ids: The IDs of the changes to remove
+
+        :rtype: list
+        :returns: The removed pairs, in the order they were added
+        """
+        serials = sorted(set(chain.from_iterable(
+            self._by_change.pop(change_id, ()) for change_id in change_ids
+        )))
+        removed = []
+        for serial in serials:
+            entry, dep_ids = self._entries.pop(serial)
+            removed.append(entry)
+            for dep_id in dep_ids:
+                waiting = self._by_dep[dep_id]
+                waiting.discard(serial)
+                if not waiting:
+                    del self._by_dep[dep_id]
+        while self._order and self._order[0] not in self._entries:
+            self._order.popleft()
+        if len(self._order) > 2 * len(self._entries):
+            self._order = deque(
+                serial for serial in self._order if serial in self._entries
+            )
+        return removed
+
 
 class ChangeQueueWithDeps(ChangeQueue):
     """Class for managing a change queue where changes can have dependencies on
@@ -170,14 +700,19 @@ class ChangeQueueWithDeps(ChangeQueue):
 
     If test_key is specified (not None), then initial_state must have more then
     one member where the last member is the list of changes being tested
-    """
-    @staticmethod
-    def _change_id(change):
-        if hasattr(change, 'id'):
-            return change.id
-        else:
-            return change
 
+    The queue keeps a reverse dependency graph of the changes it holds (a
+    mapping of required change IDs to the IDs of changes requiring them) that
+    is stored with the queue state and updated as changes come and go. The
+    side queue is indexed by the IDs of the changes that are awaited (See
+    AwaitingDeps).
+
+    Changes that require changes which wait in priority lanes, but would be
+    placed in the queue themselves, are held back in the side queue until the
+    lanes are moved to the head of the queue, so they are never tested
+    before the changes they require. Such changes are returned as added by
+    'add', as they do not wait for any change to arrive.
+    """
     @staticmethod
     def _change_requirements(change):
         if hasattr(change, 'requirements'):
@@ -188,9 +723,78 @@ class ChangeQueueWithDeps(ChangeQueue):
     def __init__(self, initial_state=None, test_key=None, awaiting_deps=None):
         super(ChangeQueueWithDeps, self).__init__(initial_state, test_key)
         if awaiting_deps is None:
-            self._awaiting_deps = deque()
+            self._awaiting_deps = AwaitingDeps()
         else:
-            self._awaiting_deps = deque(awaiting_deps)
+            self._awaiting_deps = AwaitingDeps(awaiting_deps)
+        self._held_back = set()
+        self._rebuild_dep_graph()
+
+    def __setstate__(self, state):
+        super(ChangeQueueWithDeps, self).__setstate__(state)
+        if not isinstance(self._awaiting_deps, AwaitingDeps):
+            # Migrate queue state that was saved before we indexed the
+            # changes awaiting dependencies
+            self._awaiting_deps = AwaitingDeps(self._awaiting_deps)
+        if '_held_back' not in state:
+            # Migrate queue state that was saved before we held back changes
+            # that require changes in priority lanes
+            self._held_back = set()
+        if '_dependants' not in state:
+            # Migrate queue state that was saved before we had a dependency
+            # graph
+            self._rebuild_dep_graph()
+
+    def _rebuild_dep_graph(self):
+        self._dependants = dict()
+        for change in chain(
+            chain.from_iterable(self._state),
+            (chg for chg, _ in self._awaiting_deps)
+        ):
+            self._add_dep_edges(change)
+
+    def _add_dep_edges(self, change):
+        change_id = self._change_id(change)
+        for req_id in self._change_requirements(change):
+            self._dependants.setdefault(req_id, set()).add(change_id)
+
+    def _remove_dep_edges(self, changes):
+        for change in changes:
+            change_id = self._change_id(change)
+            for req_id in self._change_requirements(change):
+                req_dependants = self._dependants.get(req_id)
+                if req_dependants is None:
+                    continue
+                req_dependants.discard(change_id)
+                if not req_dependants:
+                    del self._dependants[req_id]
+
+    def _find_dependants(self, change_id, awaiting_only=False):
+        """Find all changes in the queue that directly or indirectly depend on
+        the given change ID
+
+        :param object change_id:   The ID of the change to look for
+                                   dependants of
+        :param bool awaiting_only: If True, only follow dependencies between
+                                   changes that are not in the main queue (so
+                                   are either awaiting dependencies or are
+                                   just being added)
+
+        :rtype: set
+        :returns: a set of dependant change IDs. The set will include
+                  change_id if it is part of a dependency loop
+        """
+        dependants = set()
+        recurse_into = deque([change_id])
+        while recurse_into:
+            c_id = recurse_into.popleft()
+            c_deps = self._dependants.get(c_id, set()) - dependants
+            if awaiting_only:
+                c_deps = set(
+                    dep for dep in c_deps if not self._in_queue(dep)
+                )
+            dependants.update(c_deps)
+            recurse_into.extend(c_deps)
+        return dependants
 
     def add(self, change):
         """Attempts to add a change to the queue
@@ -213,70 +817,112 @@ class ChangeQueueWithDeps(ChangeQueue):
         cyclic dependencies
         """
         change_id = self._change_id(change)
-        dependant_ids = self._find_dependants_on(
-            change_id,
-            chain([change], (chg for chg, _ in self._awaiting_deps))
-        )
+        self._add_dep_edges(change)
+        dependant_ids = self._find_dependants(change_id, awaiting_only=True)
         dependants = chain(
             [(change, self._get_missing_deps(change))],
             self._remove_awaiting_deps_by_ids(dependant_ids)
         )
         if change_id in dependant_ids:
             # Change depends on itself - a dependency loop
-            return [], [cng for cng, _ in dependants]
+            rejected = [cng for cng, _ in dependants]
+            self._remove_dep_edges(rejected)
+            self._held_back.difference_update(dependant_ids)
+            return [], rejected
         changes_added = deque()
         change_ids_added = set()
         for chg, mdeps in dependants:
+            chg_id = self._change_id(chg)
+            # Changes that were held back were already returned as added
+            was_held_back = chg_id in self._held_back
+            self._held_back.discard(chg_id)
             mdeps.difference_update(change_ids_added)
+            if not mdeps:
+                mdeps = self._lane_requirements(chg)
+                if mdeps:
+                    self._held_back.add(chg_id)
+            elif mdeps <= self._held_back:
+                self._held_back.add(chg_id)
             if mdeps:
                 self._awaiting_deps.append((chg, mdeps))
             else:
                 super(ChangeQueueWithDeps, self).add(chg)
+                change_ids_added.add(chg_id)
+            if not was_held_back and (
+                not mdeps or chg_id in self._held_back
+            ):
                 changes_added.append(chg)
-                change_ids_added.add(self._change_id(chg))
         return list(changes_added), []
 
     def _get_missing_deps(self, change):
         """Get a set of missing dependencies for the given change
         """
-        return \
-            self._change_requirements(change) - \
-            set(map(self._change_id, chain.from_iterable(self._state)))
+        return set(
+            req for req in self._change_requirements(change)
+            if not self._in_queue(req)
+        )
 
-    @staticmethod
-    def _find_dependants_on(change_id, changes):
-        """Find in the changes collection, all changes that are directly on
-        indirectly dependant on the given change ID. The collection should also
-        include the change whose Id is given if loop detection is desired.
+    def _lane_priority(self, change):
+        """Returns the priority lane a change should be placed in
 
-        :rtype: set
-        :returns: a set of dependant change IDs
+        A change is never placed in a lane that would get tested before the
+        changes it requires. So if a required change is in the queue the
+        change is placed in the queue as well, and if a required change is in
+        a priority lane the change is placed in the same lane or in a lower
+        priority one.
         """
-        depmap = dict()
-        for change in changes:
-            for cdid in ChangeQueueWithDeps._change_requirements(change):
-                depmap.setdefault(cdid, set()).add(
-                    ChangeQueueWithDeps._change_id(change)
-                )
-        dependants = set()
-        recurse_into = deque([change_id])
-        while recurse_into:
-            c_id = recurse_into.popleft()
-            c_deps = depmap.pop(c_id, set()) - dependants
-            dependants.update(c_deps)
-            recurse_into.extend(c_deps)
-        return dependants
+        priority = super(ChangeQueueWithDeps, self)._lane_priority(change)
+        for req in self._change_requirements(change):
+            if priority <= 0:
+                break
+            if req in self._change_index:
+                return 0
+            priority = min(priority, self._lane_index.get(req, priority))
+        return priority
+
+    def _lane_requirements(self, change):
+        """Returns the IDs of the changes in priority lanes that the given
+        change requires, if the change is going to be placed in the queue
+        rather then in a lane
+        """
+        if not self._lane_index or self._lane_priority(change) > 0:
+            return set()
+        return set(
+            req for req in self._change_requirements(change)
+            if req in self._lane_index
+        )
+
+    def _start_priority_lanes(self):
+        """Move the priority lanes to the head of the queue
+
+        Works like the superclass's method, but also adds the changes that
+        were held back because they require changes in the lanes
+        """
+        lane_ids = list(self._lane_index)
+        super(ChangeQueueWithDeps, self)._start_priority_lanes()
+        released = self._remove_awaiting_deps_by_ids(set(
+            self._change_id(chg)
+            for lane_id in lane_ids
+            for chg, _ in self._awaiting_deps.waiting_for(lane_id)
+        ))
+        # Changes that wait for the released changes are added along with
+        # them
+        for chg, _ in released:
+            self.add(chg)
 
     def _remove_awaiting_deps_by_ids(self, dep_ids):
-        self._awaiting_deps, removed_deps = reduce(
-            lambda res, dep:
-                (res[0], res[1] + [dep])
-                if self._change_id(dep[0]) in dep_ids else
-                (res[0] + [dep], res[1]),
-            self._awaiting_deps,
-            ([], [])
-        )
-        return removed_deps
+        return self._awaiting_deps.remove_by_ids(dep_ids)
+
+    def on_test_success(self, test_key):
+        """Updated the queue when a test is successful
+
+        Works like the superclass's method, but also drops successful changes
+        from the dependency graph
+        """
+        success_list, fail_list, cause = \
+            super(ChangeQueueWithDeps, self).on_test_success(test_key)
+        self._remove_dep_edges(success_list)
+        return success_list, fail_list, cause
 
     def on_test_failure(self, test_key):
         """Updated the queue when a test is successful
@@ -288,29 +934,49 @@ class ChangeQueueWithDeps(ChangeQueue):
             super(ChangeQueueWithDeps, self).on_test_failure(test_key)
         for failed_change in copy(fail_list):
             failed_change_id = self._change_id(failed_change)
-            dependant_ids = self._find_dependants_on(failed_change_id, chain(
-                chain.from_iterable(self._state),
-                (chg for chg, _ in self._awaiting_deps)
-            ))
+            dependant_ids = self._find_dependants(failed_change_id)
             fail_list.extend(self._remove_deps_by_ids(dependant_ids))
             fail_list.extend(
                 adep[0] for adep in
                 self._remove_awaiting_deps_by_ids(dependant_ids)
             )
+            self._held_back.difference_update(dependant_ids)
+        self._remove_dep_edges(fail_list)
+        if self._lane_sections:
+            self._drop_empty_lane_sections()
         return success_list, fail_list, cause
 
+    def _drop_empty_lane_sections(self):
+        """Drop the sections at the head of the queue that came from priority
+        lanes and were left empty after dependants of failed changes were
+        removed from them, so that we do not try to test empty sections
+        """
+        lane_sections = [
+            self._popleft_batch() for _ in range(self._lane_sections)
+        ]
+        lane_sections = [section for section in lane_sections if section]
+        for section in reversed(lane_sections):
+            self._pushleft_batch(section)
+        self._lane_sections = len(lane_sections)
+        self._end_lane_sections(0)
+
     def _remove_deps_by_ids(self, dep_ids):
+        # Use the index to only rebuild the sections that contain the changes
+        # we need to remove
+        sections = sorted(set(
+            serial - self._index_base
+            for dep_id in dep_ids
+            for serial, _ in self._change_index.get(dep_id, ())
+        ))
         removed_deps = deque()
-        for i in range(0, len(self._state)):
-            self._state[i], section_removed_deps = reduce(
-                lambda res, dep:
-                    (res[0], res[1] + [dep])
-                    if self._change_id(dep) in dep_ids else
-                    (res[0] + [dep], res[1]),
-                self._state[i],
-                ([], [])
-            )
-            removed_deps.extend(section_removed_deps)
+        for i in sections:
+            section = []
+            for dep in self._state[i]:
+                if self._change_id(dep) in dep_ids:
+                    removed_deps.append(dep)
+                else:
+                    section.append(dep)
+            self._replace_batch(i, section)
         return removed_deps
 
 
@@ -470,7 +1136,319 @@ class JenkinsChangeQueue(
     Changes and test results are submitted to the queue by triggering the queue
     job with specific parameters. Test instructions are also dumped to files to
     be passed to testing jobs as build artifacts.
+
+    Parallel bisection can be enabled by setting the 'CQ_BISECT_WAYS'
+    environment variable to the amount of parts failed batches should be split
+    to. Speculative testing can be enabled by setting 'CQ_SPECULATION_DEPTH'.
+    Adaptive batch sizes can be enabled by setting 'CQ_ADAPTIVE_BATCHING' to
+    'yes', and risk weighted bisection by setting
+    'CQ_RISK_WEIGHTED_BISECTION' to 'yes'.
+
+    Rather then saving the whole queue state on every action, the state is
+    kept as a snapshot and a journal of actions performed since the snapshot
+    was taken. See persist_in_artifacts for details. The settings above are
+    recorded with each journaled action, and actions are replayed with the
+    settings they were performed with, so changing the settings does not
+    change the outcome of actions that were already performed.
+
+    The queue status is written as HTML for display in Jenkins and as JSON
+    for other tools. See _write_status_file for details.
+
+    Changes that arrive close together can be coalesced into a single test
+    batch by setting the 'CQ_COALESCING_WINDOW' environment variable to the
+    maximal amount of seconds to delay testing by. See _coalescing_window
+    for details.
+
+    Changes can share their builds with other queues by setting the
+    'CQ_BUILD_REGISTRY' environment variable to the path of a BuildRegistry
+    file. See _register_builds for details.
+
+    Queue metrics are written in the Prometheus text format into the
+    'queue-metrics.prom' artifact whenever actions are saved, and into
+    '<queue name>_change_queue.prom' in the directory given in the
+    'CQ_METRICS_TEXTFILE_DIR' environment variable, if it is set. See
+    _write_metrics_file for details.
+
+    Test results are remembered by the builds that were tested and the tester
+    job that tested them, for up to 'result_cache_ttl' seconds. When a tester
+    asks for a test with the same builds as a remembered one, the remembered
+    result is applied instead and the tester gets the next test. Results
+    reported with 'on_test_infra_failure' are treated as failures, but are
+    not remembered, and make the queue forget earlier results for the same
+    builds.
     """
+    JOURNAL_SUFFIX = '.journal'
+    snapshot_interval = 50
+    STATUS_FILE = 'queue-status'
+    METRICS_FILE = 'queue-metrics.prom'
+    status_page_size = 100
+    coalescing_history = 20
+    coalescing_arrivals = 4
+    coalescing_duration_fraction = 0.25
+    result_cache_size = 200
+    result_cache_ttl = 24 * 60 * 60
+    time_in_queue_buckets = (
+        60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400, 259200,
+    )
+    test_duration_buckets = (60, 300, 600, 1200, 1800, 3600, 7200, 14400)
+    action_duration_buckets = (
+        0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    )
+    BATCH_ACTIONS = (
+        'add', 'on_test_success', 'on_test_failure', 'on_test_infra_failure',
+        'get_next_test',
+    )
+    JOURNALED_SETTINGS = (
+        'bisect_ways', 'speculation_depth', 'adaptive_batching',
+        'risk_weighted_bisection',
+    )
+
+    def __init__(self, *args, **kwargs):
+        super(JenkinsChangeQueue, self).__init__(*args, **kwargs)
+        self._init_journal()
+        self._init_timing_stats()
+        self._init_result_cache()
+        self._init_metrics()
+
+    def _init_journal(self):
+        self._journal_pending = []
+        self._journal_replayed = 0
+        self._replayed_test_keys = deque()
+        self._replayed_settings = {}
+        self._state_io = {}
+        self._action_time = None
+        if not hasattr(self, '_journal_seq'):
+            self._journal_seq = 0
+
+    def __getstate__(self):
+        state = super(JenkinsChangeQueue, self).__getstate__()
+        for attr in (
+            '_journal_pending', '_journal_replayed', '_replayed_test_keys',
+            '_replayed_settings', '_state_io', '_action_time',
+        ):
+            state.pop(attr, None)
+        return state
+
+    def _init_timing_stats(self):
+        if not hasattr(self, '_arrival_times'):
+            self._arrival_times = deque([], self.coalescing_history)
+            self._test_durations = deque([], self.coalescing_history)
+            self._test_start_times = dict()
+
+    def _init_result_cache(self):
+        if not hasattr(self, '_result_cache'):
+            self._result_cache = {}
+
+    def _init_metrics(self):
+        if not hasattr(self, '_added_times'):
+            self._added_times = {}
+            self._time_in_queue = Histogram(self.time_in_queue_buckets)
+            self._test_duration_histogram = \
+                Histogram(self.test_duration_buckets)
+            self._action_durations = {}
+
+    def __setstate__(self, state):
+        super(JenkinsChangeQueue, self).__setstate__(state)
+        self._init_journal()
+        self._init_timing_stats()
+        self._init_result_cache()
+        self._init_metrics()
+
+    @classmethod
+    @contextmanager
+    def persist_in_artifacts(cls, artifact_file=None):
+        """Load the queue state from a snapshot and a journal in the artifacts
+        directory and save it back when done
+
+        :param str artifact_file: (Optional) The snapshot file name, the
+                                  journal file name is derived from it
+
+        Loading the queue replays the actions in the journal on top of the
+        snapshot. Actions performed on the loaded queue via act_on_job_params
+        are appended to the journal when the context ends, which is much
+        cheaper then saving the whole state. Once the journal reaches
+        'snapshot_interval' actions, it is compacted into a new snapshot. If
+        no actions were performed via act_on_job_params, a new snapshot is
+        always saved since the queue may have been changed by calling its
+        methods directly.
+
+        Test keys generated while performing actions are recorded in the
+        journal, so replaying it always yields the same state.
+        """
+        artifact_file, journal_file = cls._journal_files(artifact_file)
+        queue = cls._load_with_journal(artifact_file, journal_file)
+        yield queue
+        queue._save_journal(artifact_file, journal_file)
+
+    @classmethod
+    def _load_with_journal(cls, artifact_file, journal_file):
+        """Load the queue from a snapshot and replay the journal on top of
+        it, while measuring how long it takes
+        """
+        start = default_timer()
+        queue = cls.load_from_artifact(artifact_file)
+        queue._replay_journal(journal_file)
+        queue._state_io['load_seconds'] = default_timer() - start
+        return queue
+
+    @classmethod
+    def _journal_files(cls, artifact_file=None):
+        """Get the snapshot file name and the journal file path
+
+        :param str artifact_file: (Optional) The snapshot file name
+
+        :rtype: tuple
+        :returns: The snapshot file name and the path to the journal file
+        """
+        if artifact_file is None:
+            artifact_file = cls.__name__ + '.dat'
+        journal_file = path.join(
+            cls.ARTIFACTS_DIR,
+            path.splitext(artifact_file)[0] + cls.JOURNAL_SUFFIX
+        )
+        return artifact_file, journal_file
+
+    def _replay_journal(self, journal_file):
+        try:
+            with open(journal_file) as fil:
+                entries = [json.loads(line) for line in fil if line.strip()]
+        except IOError as e:
+            # errno 2 is 'No such file or directory'
+            if e.errno == 2:
+                return
+            raise
+        for entry in entries:
+            if entry['seq'] <= self._journal_seq:
+                # Entry was already compacted into the snapshot
+                continue
+            self._replayed_test_keys = deque(entry['test_keys'])
+            # Entries written before we journaled the settings are replayed
+            # with the current ones
+            self._replayed_settings = entry.get('settings', {})
+            self._apply_action(
+                entry['action'], entry['arg'], entry['actor_url'], log=False,
+                now=entry.get('time'),
+            )
+            self._replayed_test_keys = deque()
+            self._replayed_settings = {}
+            self._observe_action_duration(
+                entry['action'], entry.get('duration')
+            )
+            self._journal_seq = entry['seq']
+            self._journal_replayed += 1
+
+    def _save_journal(self, artifact_file, journal_file):
+        """Save the actions performed on the queue, and write the queue
+        metrics if there were any
+        """
+        performed_actions = bool(self._journal_pending)
+        start = default_timer()
+        self._write_journal(artifact_file, journal_file)
+        self._state_io['save_seconds'] = default_timer() - start
+        self._state_io['state_bytes'] = sum(
+            path.getsize(state_file)
+            for state_file in (
+                path.join(self.ARTIFACTS_DIR, artifact_file), journal_file
+            )
+            if path.exists(state_file)
+        )
+        if performed_actions:
+            self._write_metrics_file()
+
+    def _write_journal(self, artifact_file, journal_file):
+        if not self._journal_pending:
+            # The queue may have been changed directly and not via
+            # act_on_job_params, so we save the whole state
+            self.compact_journal(artifact_file, journal_file)
+            return
+        self._journal_seq = self._journal_pending[-1]['seq']
+        if self._journal_replayed + len(self._journal_pending) >= \
+                self.snapshot_interval:
+            self.compact_journal(artifact_file, journal_file)
+            return
+        self.verify_artifacts_dir()
+        with open(journal_file, 'a') as fil:
+            for entry in self._journal_pending:
+                fil.write(json.dumps(entry) + '\n')
+            # Make sure actions are on disk before we report them as done
+            fil.flush()
+            fsync(fil.fileno())
+        self._journal_replayed += len(self._journal_pending)
+        self._journal_pending = []
+
+    def compact_journal(self, artifact_file, journal_file):
+        """Save the queue state into a new snapshot and remove the journal
+
+        :param str artifact_file: The snapshot file name
+        :param str journal_file:  The path to the journal file
+
+        The snapshot records the sequence number of the last action it
+        includes, so if we fail before removing the journal, the actions in it
+        will not be applied twice.
+        """
+        self._journal_pending = []
+        self.save_to_artifact(artifact_file)
+        if path.exists(journal_file):
+            unlink(journal_file)
+        self._journal_replayed = 0
+
+    def _new_test_key(self):
+        if self._replayed_test_keys:
+            return self._replayed_test_keys.popleft()
+        test_key = super(JenkinsChangeQueue, self)._new_test_key()
+        if self._journal_pending:
+            self._journal_pending[-1]['test_keys'].append(test_key)
+        return test_key
+
+    def _replayed_setting(self, name, default):
+        """Returns the value a setting had when the journal entry that is
+        being replayed was performed, or the given default if no entry is
+        being replayed
+        """
+        return self._replayed_settings.get(name, default)
+
+    def _journaled_settings(self):
+        return dict(
+            (name, getattr(self, name)) for name in self.JOURNALED_SETTINGS
+        )
+
+    @property
+    def bisect_ways(self):
+        return self._replayed_setting('bisect_ways', int(
+            environ.get('CQ_BISECT_WAYS', ChangeQueue.bisect_ways)
+        ))
+
+    @property
+    def speculation_depth(self):
+        return self._replayed_setting('speculation_depth', int(environ.get(
+            'CQ_SPECULATION_DEPTH', ChangeQueue.speculation_depth
+        )))
+
+    @staticmethod
+    def _env_flag(name):
+        return environ.get(name, '').lower() in ('1', 'yes', 'true')
+
+    @property
+    def adaptive_batching(self):
+        return self._replayed_setting(
+            'adaptive_batching', self._env_flag('CQ_ADAPTIVE_BATCHING')
+        )
+
+    @property
+    def risk_weighted_bisection(self):
+        return self._replayed_setting(
+            'risk_weighted_bisection',
+            self._env_flag('CQ_RISK_WEIGHTED_BISECTION'),
+        )
+
+    @property
+    def build_registry(self):
+        return BuildRegistry.from_env()
+
+    @property
+    def max_coalescing_window(self):
+        return float(environ.get('CQ_COALESCING_WINDOW', 0))
+
     def get_queue_name(self):
         queue_name = super(JenkinsChangeQueue, self).get_queue_name()
         if queue_name is None or \
@@ -482,8 +1460,9 @@ class JenkinsChangeQueue(
         """Perform the queue action according to parameters passed to the job
 
         :param str queue_action: The queue action to perform ('add',
-                                 'on_test_success', 'on_test_failure', or
-                                 'get_next_test')
+                                 'on_test_success', 'on_test_failure',
+                                 'on_test_infra_failure', 'get_next_test' or
+                                 'batch')
         :param str action_arg:   An argument to the queue_action if needed.
                                  Objects to be added need to be serialized with
                                  JenkinsObject.object_to_param_str
@@ -495,43 +1474,425 @@ class JenkinsChangeQueue(
         performing the queue action it will also run reporting methods on
         change objects to report their status, create changes list file if
         requested, and a status HTML file showing the state of the queue.
+
+        The action is also recorded in the queue journal so it can be replayed
+        when the queue is loaded by persist_in_artifacts.
+
+        The 'batch' action performs a list of actions in order. Its argument
+        is a list of (queue_action, action_arg, actor_url) tuples serialized
+        with JenkinsObject.object_to_param_str (See
+        JenkinsChangeQueueClient.start_batch). Tuples with no actor URL get
+        the one passed to this method. A 'get_next_test' action may only
+        appear at the end of the list. Tester runs are scheduled and status
+        files are written once, after all the actions were performed.
         """
         self._cleanup_result_files()
+        if queue_action == 'batch':
+            actions = self._parse_action_batch(action_arg, actor_url)
+        else:
+            actions = [(queue_action, action_arg, actor_url)]
+        tester_quiet_period = None
+        # Email notifications are collected and sent together when the
+        # dispatcher context ends
+        with EmailDispatcher():
+            for queue_action, action_arg, actor_url in actions:
+                start = default_timer()
+                entry = len(self._journal_pending)
+                if queue_action == 'add':
+                    self._register_builds(action_arg)
+                result = self._perform_action(
+                    queue_action, action_arg, actor_url
+                )
+                if queue_action == 'add':
+                    added, rejected = result
+                    qname = self.get_queue_name()
+                    self._report_changes_status(added, 'added', qname, None)
+                    self._report_changes_status(
+                        rejected, 'rejected', qname, None
+                    )
+                    tester_quiet_period = self._tester_quiet_period()
+                elif queue_action == 'get_next_test':
+                    test_key, change_list = self._reuse_test_results(
+                        *result, actor_url=actor_url
+                    )
+                    if test_key is not None:
+                        self._build_change_list(test_key, change_list)
+                else:
+                    self._post_test_report(*result)
+                    tester_quiet_period = 0
+                duration = default_timer() - start
+                self._journal_pending[entry]['duration'] = duration
+                self._observe_action_duration(queue_action, duration)
+        if tester_quiet_period is not None:
+            self._schedule_tester_run(tester_quiet_period)
+        self._write_status_file()
+
+    def _parse_action_batch(self, action_arg, actor_url=None):
+        """Parse the argument of a 'batch' queue action
+
+        :param str action_arg: The list of actions, serialized with
+                               JenkinsObject.object_to_param_str
+        :param str actor_url:  (Optional) The URL to use for actions that do
+                               not specify one
+
+        :rtype: list
+        :returns: A list of (queue_action, action_arg, actor_url) tuples
+        """
+        actions = []
+        batch = self.param_str_to_object(action_arg)
+        for position, action in enumerate(batch, 1):
+            queue_action, action_arg = action[:2]
+            action_actor_url = action[2] if len(action) > 2 else None
+            if queue_action not in self.BATCH_ACTIONS or (
+                queue_action == 'get_next_test' and position < len(batch)
+            ):
+                raise InvalidChangeQueueAction(queue_action)
+            actions.append(
+                (queue_action, action_arg, action_actor_url or actor_url)
+            )
+        return actions
+
+    def _register_builds(self, action_arg):
+        """Register the builds of an added change in the build registry, so
+        other queues can reuse them
+
+        Changes that are enqueued get registered builds attached to them
+        before they are built (See ChangeWithBuilds.set_builds_from_registry),
+        so the queue only needs to register the builds it gets.
+
+        :param str action_arg: The argument of the 'add' action
+        """
+        registry = self.build_registry
+        if registry is None:
+            return
+        change_with_builds = ChangeWithBuildsWrapper(
+            self.param_str_to_object(action_arg)
+        )
+        key = change_with_builds.build_key
+        if key is None or not change_with_builds.builds:
+            return
+        registry.register(
+            key, change_with_builds.builds, change_with_builds.build_duration,
+        )
+
+    def _tester_quiet_period(self):
+        if self._test_key is None:
+            # The tester will start a new batch, so give more changes a
+            # chance to join it
+            return self._coalescing_window()
+        return 0
+
+    def _perform_action(self, queue_action, action_arg, actor_url):
+        """Record a queue action in the journal and apply it
+
+        :returns: The return value of the queue method that was called
+        """
+        now = time()
+        self._journal_pending.append(dict(
+            seq=self._journal_seq + len(self._journal_pending) + 1,
+            action=queue_action, arg=action_arg, actor_url=actor_url,
+            test_keys=[], time=now, settings=self._journaled_settings(),
+        ))
+        return self._apply_action(
+            queue_action, action_arg, actor_url, now=now
+        )
+
+    def _reuse_test_results(self, test_key, change_list, actor_url=None):
+        """Apply remembered results to tests that were handed out, until we
+        get a test that needs to run
+
+        :param str test_key:     The key of the test that was handed out
+        :param list change_list: The changes to test
+        :param str actor_url:    The URL of the tester that asked for a test
+
+        :rtype: tuple
+        :returns: The test key and change list of the test to run
+        """
+        while test_key is not None and self._result_cache:
+            cached = self._cached_test_result(change_list, time())
+            if cached is None:
+                break
+            logger.info('Reusing result of {0} for {1} changes'.format(
+                cached['url'], len(change_list)
+            ))
+            self._post_test_report(*self._perform_action(
+                'on_test_' + cached['result'], test_key, cached['url']
+            ))
+            test_key, change_list = self._perform_action(
+                'get_next_test', '', actor_url
+            )
+        return test_key, change_list
+
+    def _apply_action(
+        self, queue_action, action_arg, actor_url, log=True, now=None
+    ):
+        """Apply a queue action to the queue state
+
+        :param str queue_action: The queue action to perform
+        :param str action_arg:   An argument to the queue_action if needed
+        :param str actor_url:    The URL of the thing that asked for the
+                                 queue action
+        :param bool log:         (Optional) Whether to log the action
+        :param float now:        (Optional) The time the action was performed
+                                 at. Used for collecting change arrival and
+                                 test duration statistics
+
+        :returns: The return value of the queue method that was called
+        """
+        self._action_time = now
         if queue_action == 'add':
             change = self.param_str_to_object(action_arg)
-            logger.info('Queue action: add {0}'.format(
-                DisplayableChangeWrapper(change).presentable_id
-            ))
-            added, rejected = self.add(change)
-            qname = self.get_queue_name()
-            self._report_changes_status(added, 'added', qname, None)
-            self._report_changes_status(rejected, 'rejected', qname, None)
-            self._schedule_tester_run()
+            if log:
+                logger.info('Queue action: add {0}'.format(
+                    DisplayableChangeWrapper(change).presentable_id
+                ))
+            if now is not None:
+                self._arrival_times.append(now)
+                self._added_times[self._change_id(change)] = now
+            return self.add(change)
         elif queue_action == 'on_test_success':
             test_key = action_arg
-            logger.info('Queue action: on_test_success {0}'.format(test_key))
+            if log:
+                logger.info(
+                    'Queue action: on_test_success {0}'.format(test_key)
+                )
             if self.test_key_match(test_key):
                 self._last_successful_test = actor_url
-            success_list, fail_list, cause = self.on_test_success(test_key)
-            self._post_test_report(success_list, fail_list, cause)
-            self._schedule_tester_run()
-        elif queue_action == 'on_test_failure':
+            self._record_test_duration(test_key, now)
+            self._cache_test_result(test_key, 'success', actor_url, now)
+            return self.on_test_success(test_key)
+        elif queue_action in ('on_test_failure', 'on_test_infra_failure'):
             test_key = action_arg
-            logger.info('Queue action: on_test_failure {0}'.format(test_key))
+            if log:
+                logger.info(
+                    'Queue action: {0} {1}'.format(queue_action, test_key)
+                )
             if self.test_key_match(test_key):
                 self._last_failed_test = actor_url
-            success_list, fail_list, cause = self.on_test_failure(test_key)
-            self._post_test_report(success_list, fail_list, cause)
-            self._schedule_tester_run()
+            self._record_test_duration(test_key, now)
+            if queue_action == 'on_test_failure':
+                self._cache_test_result(test_key, 'failure', actor_url, now)
+            else:
+                self._cache_test_result(test_key, None, actor_url, now)
+            return self.on_test_failure(test_key)
         elif queue_action == 'get_next_test':
-            logger.info('Queue action: get_next_test')
+            if log:
+                logger.info('Queue action: get_next_test')
             test_key, change_list = self.get_next_test()
             if test_key is not None:
-                self._build_change_list(test_key, change_list)
                 self._running_test_url = actor_url
+                if now is not None:
+                    self._test_start_times.setdefault(test_key, now)
+            return test_key, change_list
         else:
             raise InvalidChangeQueueAction(queue_action)
-        self._write_status_file()
+
+    def _record_test_duration(self, test_key, now):
+        start = self._test_start_times.pop(test_key, None)
+        if start is not None and now is not None:
+            self._test_durations.append(now - start)
+            self._test_duration_histogram.observe(now - start)
+            if self.test_key_match(test_key):
+                self.record_test_duration(
+                    len(self._prefix_changes(test_key)), now - start
+                )
+        # Forget about tests the queue is no longer interested in
+        self._test_start_times = dict(
+            (key, start) for key, start in self._test_start_times.items()
+            if self.test_key_match(key)
+        )
+
+    def _record_outcomes(self, success_list, fail_list):
+        super(JenkinsChangeQueue, self)._record_outcomes(
+            success_list, fail_list
+        )
+        # Record how long the changes spent in the queue
+        for change in chain(success_list, fail_list):
+            added = self._added_times.pop(self._change_id(change), None)
+            if added is not None and self._action_time is not None:
+                self._time_in_queue.observe(self._action_time - added)
+
+    def _observe_action_duration(self, queue_action, duration):
+        if duration is None:
+            return
+        if queue_action not in self._action_durations:
+            self._action_durations[queue_action] = \
+                Histogram(self.action_duration_buckets)
+        self._action_durations[queue_action].observe(duration)
+
+    def _write_metrics_file(self):
+        """Write the queue metrics in the Prometheus text format
+
+        The metrics include:
+        - The amount of changes in the queue per change stream
+        - The size of the batch under test and the amount of sections it was
+          split to while bisecting
+        - Histograms of the time changes spent in the queue until they were
+          merged or rejected, of tester run durations, and of the time it
+          took to perform each queue action
+        - How long loading and saving the queue state took, and its size
+        """
+        queue_name = self.get_queue_name()
+        metrics = TextfileMetrics(dict(queue=queue_name))
+        streams = {}
+        in_queue = set()
+        for change in chain(
+            chain.from_iterable(
+                changes for _, changes in self.priority_changes()
+            ),
+            chain.from_iterable(self._state),
+            (change for change, _ in self._awaiting_deps),
+        ):
+            stream = self._stream_label(
+                ChangeInStreamWrapper(change).stream_id
+            )
+            streams[stream] = streams.get(stream, 0) + 1
+            in_queue.add(self._change_id(change))
+        # Forget about changes that left the queue without being merged or
+        # rejected by a test, e.g. changes rejected because of dependencies
+        self._added_times = dict(
+            (change_id, added)
+            for change_id, added in self._added_times.items()
+            if change_id in in_queue
+        )
+        for stream in sorted(streams):
+            metrics.add_gauge(
+                'change_queue_changes', 'Changes in the queue',
+                streams[stream], dict(stream=stream),
+            )
+        metrics.add_gauge(
+            'change_queue_batch_size', 'Changes in the batch under test',
+            len(self._prefix_changes(self._test_key))
+            if self._test_key is not None else 0,
+        )
+        metrics.add_gauge(
+            'change_queue_bisection_sections',
+            'Sections the failing batch was split to while bisecting',
+            self._failing_prefix,
+        )
+        metrics.add_histogram(
+            'change_queue_time_in_queue_seconds',
+            'Time changes spent in the queue until merged or rejected',
+            self._time_in_queue,
+        )
+        metrics.add_histogram(
+            'change_queue_test_duration_seconds', 'Tester run durations',
+            self._test_duration_histogram,
+        )
+        for queue_action in sorted(self._action_durations):
+            metrics.add_histogram(
+                'change_queue_action_duration_seconds',
+                'Time it took to perform queue actions',
+                self._action_durations[queue_action],
+                dict(action=queue_action),
+            )
+        for key, name, help_text in (
+            ('load_seconds', 'change_queue_state_load_seconds',
+             'Time it took to load the queue state'),
+            ('save_seconds', 'change_queue_state_save_seconds',
+             'Time it took to save the queue state'),
+            ('state_bytes', 'change_queue_state_bytes',
+             'Size of the queue snapshot and journal'),
+        ):
+            if key in self._state_io:
+                metrics.add_gauge(name, help_text, self._state_io[key])
+        metrics.write(path.join(self.ARTIFACTS_DIR, self.METRICS_FILE))
+        textfile_dir = environ.get('CQ_METRICS_TEXTFILE_DIR')
+        if textfile_dir:
+            metrics.write(path.join(
+                textfile_dir, '{0}_change_queue.prom'.format(queue_name)
+            ))
+
+    @staticmethod
+    def _stream_label(stream_id):
+        if stream_id is None:
+            return ''
+        if isinstance(stream_id, tuple):
+            return '/'.join(map(str, stream_id))
+        return str(stream_id)
+
+    def _result_cache_key(self, change_list):
+        """Returns the key to remember the result of testing the given
+        changes by, or None if the result cannot be remembered because the
+        builds of the changes are unknown
+        """
+        builds = JenkinsTestedChangeList(None, change_list).visible_builds
+        identities, seen = [], set()
+        for build in builds:
+            if build.build_url is None:
+                return None
+            identity = (build.job_name, build.build_url)
+            if identity not in seen:
+                seen.add(identity)
+                identities.append(identity)
+        if not identities:
+            return None
+        return (self.tester_job_name(), tuple(identities))
+
+    def _cache_test_result(self, test_key, result, actor_url, now):
+        """Remember the result of a test
+
+        :param str test_key:  The key of the test
+        :param str result:    'success' or 'failure', or None to forget the
+                              result of testing the same builds
+        :param str actor_url: The URL of the test build
+        :param float now:     The time the result was reported at
+        """
+        if not self.test_key_match(test_key):
+            return
+        key = self._result_cache_key(self._prefix_changes(test_key))
+        if key is None:
+            return
+        self._result_cache.pop(key, None)
+        if result is None or now is None:
+            return
+        self._result_cache[key] = dict(result=result, time=now, url=actor_url)
+        while len(self._result_cache) > self.result_cache_size:
+            oldest = min(
+                self._result_cache,
+                key=lambda k: self._result_cache[k]['time'],
+            )
+            del self._result_cache[oldest]
+
+    def _cached_test_result(self, change_list, now):
+        """Returns the remembered result of testing the given changes or None
+        if there is no such result, or it is too old
+        """
+        cached = self._result_cache.get(self._result_cache_key(change_list))
+        if cached is None or now - cached['time'] > self.result_cache_ttl:
+            return None
+        return cached
+
+    def _coalescing_window(self):
+        """Calculate how long to delay the start of testing a new batch, so
+        that changes arriving close together get tested together
+
+        :rtype: int
+        :returns: The delay in seconds, 0 if testing should start right away
+
+        The delay adapts to the typical (median) time between recent change
+        arrivals, so that about 'coalescing_arrivals' more changes can join
+        the batch. It is never longer then 'max_coalescing_window', or then
+        'coalescing_duration_fraction' of the average recent test duration,
+        since it only pays off if it is short compared to running another
+        test. If changes do not typically arrive that close together, testing
+        is not delayed at all.
+        """
+        window = self.max_coalescing_window
+        if window <= 0 or len(self._arrival_times) < 2:
+            return 0
+        if self._test_durations:
+            window = min(window, (
+                sum(self._test_durations) / len(self._test_durations) *
+                self.coalescing_duration_fraction
+            ))
+        arrivals = list(self._arrival_times)
+        gaps = sorted(b - a for a, b in zip(arrivals, arrivals[1:]))
+        # Queue actions are not performed more often then once a second or so
+        typical_gap = max(gaps[len(gaps) // 2], 1)
+        if typical_gap > window:
+            return 0
+        return int(ceil(min(window, typical_gap * self.coalescing_arrivals)))
 
     @staticmethod
     def _cleanup_result_files():
@@ -570,30 +1931,195 @@ class JenkinsChangeQueue(
             status, qname, cause, test_url
         )
 
-    def _schedule_tester_run(self):
-        logger.info('Scheduling testes job run')
-        JobRunSpec(self.tester_job_name(), {}).as_pipeline_build_step_json()
+    def _schedule_tester_run(self, quiet_period=0):
+        runs = self.tests_to_dispatch()
+        if runs <= 1:
+            run_spec = JobRunSpec(self.tester_job_name(), {})
+            if quiet_period > 0:
+                logger.info(
+                    'Scheduling testes job run in {0}s'.format(quiet_period)
+                )
+                run_spec.as_pipeline_build_step_json(quiet_period=quiet_period)
+            else:
+                logger.info('Scheduling testes job run')
+                run_spec.as_pipeline_build_step_json()
+            return
+        logger.info('Scheduling {0} testes job runs'.format(runs))
+        # We pass a different parameter to each run so Jenkins does not merge
+        # them into a single build
+        JobRunSpec.as_pipeline_build_steps_json(
+            JobRunSpec(self.tester_job_name(), dict(TESTER_SLOT=str(slot)))
+            for slot in range(runs)
+        )
 
     @staticmethod
     def _build_change_list(test_key, change_list):
         JenkinsTestedChangeList(test_key, change_list).save_to_artifact()
 
     def _write_status_file(self):
+        """Write the queue status into HTML and JSON files
+
+        The JSON status is written into an index file with summary
+        information and into pages listing up to status_page_size changes
+        each. The HTML status only shows up to status_page_size changes from
+        each queue section.
+
+        The JSON index file includes a digest of the queue contents. If the
+        status files copied from the previous queue build were made from
+        the same contents, they are left as they are.
+        """
+        digest = self._status_digest()
+        if self._status_is_current(digest):
+            logger.info('Queue contents unchanged, not writing status files')
+            return
+        self._write_status_json(digest)
+        self._write_status_html()
+
+    def _status_digest(self):
+        return sha1(repr((
+            self._test_key,
+            getattr(self, '_running_test_url', None),
+            [list(map(self._change_id, section)) for section in self._state],
+            [
+                (self._change_id(chg), sorted(map(repr, deps)))
+                for chg, deps in self._awaiting_deps
+            ],
+            [
+                (priority, list(map(self._change_id, changes)))
+                for priority, changes in self.priority_changes()
+            ],
+        )).encode('utf8')).hexdigest()
+
+    def _status_is_current(self, digest):
+        html_file = path.join(self.ARTIFACTS_DIR, self.STATUS_FILE + '.html')
+        json_file = path.join(self.ARTIFACTS_DIR, self.STATUS_FILE + '.json')
+        if not (path.exists(html_file) and path.getsize(html_file)):
+            return False
+        try:
+            with open(json_file) as fil:
+                return json.load(fil).get('digest') == digest
+        except (IOError, ValueError):
+            return False
+
+    def _status_page_file(self, page):
+        return path.join(
+            self.ARTIFACTS_DIR, '{0}-{1}.json'.format(self.STATUS_FILE, page)
+        )
+
+    @classmethod
+    def _change_status_dict(cls, change, section, batch=None):
+        displayable_change = DisplayableChangeWrapper(change)
+        return dict(
+            id=cls._change_id(change),
+            presentable_id=displayable_change.presentable_id,
+            url=displayable_change.url, section=section, batch=batch,
+        )
+
+    def _iter_status_changes(self):
+        """Iterate over the changes in the queue in the order they appear in
+        the status, as dicts for the JSON status pages
+        """
+        for priority, changes in self.priority_changes():
+            for change in changes:
+                change_dict = self._change_status_dict(change, 'priority')
+                change_dict['priority'] = priority
+                yield change_dict
+        for batch, changes in enumerate(self._state):
+            if batch == 0 and len(self._state) > 1:
+                section = 'under_test'
+            elif batch == len(self._state) - 1:
+                section = 'untested'
+            else:
+                section = 'sected_off'
+            for change in changes:
+                yield self._change_status_dict(change, section, batch)
+        for change, deps in self._awaiting_deps:
+            change_dict = self._change_status_dict(change, 'awaiting_deps')
+            change_dict['awaiting_deps'] = sorted(deps, key=repr)
+            yield change_dict
+
+    def _count_changes(self):
+        return sum(
+            chain(
+                map(len, self._state), map(len, self._priority_lanes.values())
+            ),
+            len(self._awaiting_deps)
+        )
+
+    def _write_status_json(self, digest):
+        num_changes = self._count_changes()
+        pages = (num_changes - 1) // self.status_page_size + 1
+        status = dict(
+            digest=digest,
+            num_changes=num_changes,
+            test_key=self._test_key,
+            test_url=getattr(self, '_running_test_url', None),
+            batch_sizes=list(map(len, self._state)),
+            num_awaiting_deps=len(self._awaiting_deps),
+            priority_lane_sizes=[
+                [priority, len(changes)]
+                for priority, changes in self.priority_changes()
+            ],
+            page_size=self.status_page_size,
+            pages=[
+                path.basename(self._status_page_file(page))
+                for page in range(1, pages + 1)
+            ],
+        )
+        status_changes = self._iter_status_changes()
+        for page in range(1, pages + 1):
+            with open(self._status_page_file(page), 'w') as fil:
+                json.dump(dict(page=page, pages=pages, changes=list(
+                    islice(status_changes, self.status_page_size)
+                )), fil, default=str)
+        # Remove pages left over from when the queue was longer
+        page = pages + 1
+        while path.exists(self._status_page_file(page)):
+            unlink(self._status_page_file(page))
+            page += 1
+        # The index file is written last so that its digest is only found
+        # if all the other status files were written
+        json_file = path.join(self.ARTIFACTS_DIR, self.STATUS_FILE + '.json')
+        with open(json_file, 'w') as fil:
+            json.dump(status, fil, default=str)
+
+    def _status_section(self, changes):
+        """Prepare a queue section for display in the HTML status
+
+        :param Sequence changes: The changes in the section
+
+        :rtype: dict
+        :returns: A dict with the displayable changes to show in 'changes'
+                  and the amount of changes not shown in 'more'
+        """
+        shown = islice(changes, self.status_page_size)
+        return dict(
+            changes=list(map(DisplayableChangeWrapper, shown)),
+            more=max(0, len(changes) - self.status_page_size),
+        )
+
+    def _write_status_html(self):
         env = self._get_jinja_env()
         tmpl = env.get_template('queue-status.html.j2')
-        num_changes = sum(map(len, self._state), len(self._awaiting_deps))
-        displayable_state = \
-            [list(map(DisplayableChangeWrapper, subs)) for subs in self._state]
+        num_changes = self._count_changes()
+        displayable_state = list(map(self._status_section, self._state))
+        priority_changes = list(chain.from_iterable(
+            changes for _, changes in self.priority_changes()
+        ))
         displayable_awaiting_deps = [
             (DisplayableChangeWrapper(chg), deps)
-            for chg, deps in self._awaiting_deps
+            for chg, deps in islice(self._awaiting_deps, self.status_page_size)
         ]
-        result_file = path.join(self.ARTIFACTS_DIR, 'queue-status.html')
+        result_file = path.join(self.ARTIFACTS_DIR, self.STATUS_FILE + '.html')
         with open(result_file, 'w') as fil:
             fil.writelines(tmpl.generate(
                 num_changes=num_changes,
                 state=displayable_state,
+                priority_changes=self._status_section(priority_changes),
                 awaiting_deps=displayable_awaiting_deps,
+                more_awaiting_deps=max(
+                    0, len(self._awaiting_deps) - self.status_page_size
+                ),
                 test_key=self._test_key,
                 test_url=getattr(self, '_running_test_url', None),
             ))
@@ -601,7 +2127,14 @@ class JenkinsChangeQueue(
     @classmethod
     def _get_jinja_env(cls):
         if not hasattr(cls, '_jinja_env'):
-            cls._jinja_env = Environment(loader=PackageLoader(__name__))
+            # Compiled templates are cached on disk so that they do not need
+            # to be compiled again on every queue job run
+            cls._jinja_env = Environment(
+                loader=PackageLoader(__name__),
+                bytecode_cache=FileSystemBytecodeCache(
+                    environ.get('CQ_TEMPLATE_CACHE_DIR')
+                ),
+            )
         return cls._jinja_env
 
 
@@ -610,11 +2143,25 @@ class JenkinsChangeQueueClient(JenkinsChangeQueueObject):
     communicate with it via Jenkins` job triggering mechanisms
 
     Constructor arguments:
-    :param str queue_name: The name of the change queue we want to communicate
-                           with. It is represented as a job in Jenkins.
+    :param str queue_name:  The name of the change queue we want to communicate
+                            with. It is represented as a job in Jenkins.
+    :param str service_url: (Optional) The URL of a resident queue service
+                            (See change_queue.service) to send queue actions
+                            to, instead of triggering the queue job
+
+    When a service URL is given, queue actions are performed by the service
+    right away, and the methods return the results of the actions instead of
+    specifications of queue job runs.
+
+    Queue actions can also be collected into a batch that the queue performs
+    in a single job run or service request. See start_batch for details.
     """
-    def __init__(self, queue_name):
+    service_timeout = 60
+
+    def __init__(self, queue_name, service_url=None):
         self._queue_name = queue_name
+        self._service_url = service_url
+        self._batch = None
 
     def get_queue_name(self):
         # Override inherited method because we get queue name as parameter and
@@ -626,13 +2173,149 @@ class JenkinsChangeQueueClient(JenkinsChangeQueueObject):
 
         :rtype: JobRunSpec
         :returns: A specification of which job to run with what parameters in
-                  order to add the change to the queue
+                  order to add the change to the queue. When using a queue
+                  service, a list of JobRunSpec objects for tester job runs
+                  that need to be triggered is returned instead
         """
-        return self.get_queue_job_run_spec(
-            queue_action='add',
-            action_arg=self.object_to_param_str(change),
+        action_arg = self.object_to_param_str(change)
+        return self._send_action('add', action_arg)
+
+    def on_test_success(self, test_key, actor_url=None):
+        """Report a successful test to the queue
+
+        :param str test_key:  The key of the test that succeeded
+        :param str actor_url: (Optional) The URL of the test build
+
+        :rtype: JobRunSpec
+        :returns: A specification of which job to run with what parameters in
+                  order to report the result. When using a queue service, a
+                  list of JobRunSpec objects for tester job runs that need to
+                  be triggered is returned instead
+        """
+        return self._send_action('on_test_success', test_key, actor_url)
+
+    def on_test_failure(self, test_key, actor_url=None):
+        """Report a failed test to the queue
+
+        :param str test_key:  The key of the test that failed
+        :param str actor_url: (Optional) The URL of the test build
+
+        :rtype: JobRunSpec
+        :returns: A specification of which job to run with what parameters in
+                  order to report the result. When using a queue service, a
+                  list of JobRunSpec objects for tester job runs that need to
+                  be triggered is returned instead
+        """
+        return self._send_action('on_test_failure', test_key, actor_url)
+
+    def on_test_infra_failure(self, test_key, actor_url=None):
+        """Report a test that failed because of an infrastructure issue
+
+        :param str test_key:  The key of the test that failed
+        :param str actor_url: (Optional) The URL of the test build
+
+        :rtype: JobRunSpec
+        :returns: A specification of which job to run with what parameters in
+                  order to report the result. When using a queue service, a
+                  list of JobRunSpec objects for tester job runs that need to
+                  be triggered is returned instead
+        """
+        return self._send_action(
+            'on_test_infra_failure', test_key, actor_url
         )
 
+    def get_next_test(self, actor_url=None):
+        """Ask the queue for the next changes to test
+
+        :param str actor_url: (Optional) The URL of the test build
+
+        :rtype: JobRunSpec
+        :returns: A specification of which job to run with what parameters in
+                  order to get the changes. When using a queue service, the
+                  JenkinsTestedChangeList to test is returned instead, or None
+                  if there is nothing to test
+        """
+        if self._service_url is None:
+            return self.get_queue_job_run_spec('get_next_test', '')
+        return self._call_service('get_next_test', '', actor_url)
+
+    def start_batch(self):
+        """Start collecting queue actions into a batch
+
+        Until submit_batch is called, the 'add' and test result reporting
+        methods only add their actions to the batch and return None. Asking
+        for the next test is never batched, since its result is needed right
+        away.
+        """
+        self._batch = []
+
+    def submit_batch(self):
+        """Send the collected batch of actions to the queue
+
+        The queue performs all the actions in order in a single job run or
+        service request, and reports the status of the changes and schedules
+        tester runs once, when all the actions were performed.
+
+        :rtype: JobRunSpec
+        :returns: A specification of which job to run with what parameters in
+                  order to perform the actions, or None if no actions were
+                  collected. When using a queue service, a list of JobRunSpec
+                  objects for tester job runs that need to be triggered is
+                  returned instead
+        """
+        batch, self._batch = self._batch, None
+        if not batch:
+            return None
+        return self._send_action('batch', self.object_to_param_str(batch))
+
+    def _send_action(self, queue_action, action_arg, actor_url=None):
+        """Send a queue action to the queue, or add it to the current batch
+
+        :returns: See _call_service and get_queue_job_run_spec, or None if
+                  the action was added to a batch
+        """
+        if self._batch is not None:
+            self._batch.append((queue_action, action_arg, actor_url))
+            return None
+        if self._service_url is None:
+            return self.get_queue_job_run_spec(queue_action, action_arg)
+        return self._call_service(queue_action, action_arg, actor_url)
+
+    def _call_service(self, queue_action, action_arg, actor_url=None):
+        """Send a queue action to the queue service
+
+        :param str queue_action: The queue action to perform
+        :param str action_arg:   The argument to the queue action
+        :param str actor_url:    The URL of the thing that asked for the
+                                 queue action
+
+        :returns: For 'get_next_test' the JenkinsTestedChangeList to test or
+                  None, for other actions a list of JobRunSpec objects for
+                  the tester job runs to trigger
+        """
+        request = Request(
+            '{0}/{1}'.format(self._service_url.rstrip('/'), queue_action),
+            data=json.dumps(
+                dict(arg=action_arg, actor_url=actor_url)
+            ).encode('utf8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        response = urlopen(request, timeout=self.service_timeout)
+        try:
+            result = json.loads(response.read().decode('utf8'))
+        finally:
+            response.close()
+        if queue_action == 'get_next_test':
+            if result['tested_change_list'] is None:
+                return None
+            return self.param_str_to_object(result['tested_change_list'])
+        return [
+            JobRunSpec(
+                step['job_name'], step['params'], step.get('quiet_period')
+            )
+            for step in result['build_steps']
+        ]
+
 
 class JenkinsTestedChangeList(JenkinsChangeQueueObject, namedtuple(
     '_JenkinsTestedChangeList', ('test_key', 'change_list')
@@ -658,6 +2341,18 @@ class JenkinsTestedChangeList(JenkinsChangeQueueObject, namedtuple(
         """
         return self.get_queue_job_run_spec('on_test_failure', self.test_key)
 
+    def on_test_infra_failure(self):
+        """Report a test that failed because of an infrastructure issue
+        rather then because of the tested changes. The queue handles it like
+        a failed test, but does not reuse its result for other tests
+        :rtype: JobRunSpec
+        :returns: A specification of which job to run with what parameters in
+                  order to report the result
+        """
+        return self.get_queue_job_run_spec(
+            'on_test_infra_failure', self.test_key
+        )
+
     @property
     def visible_changes(self):
         """Changes in a change stream are not independed of one another. When
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""change_queue.batch_sizing - Pick test batch sizes from observed failure
+rates and test durations
+"""
+from __future__ import absolute_import, division
+from collections import deque
+from math import ceil, log
+
+
+class BatchSizeModel(object):
+    """A rolling model of how often changes fail and how long tests take,
+    used for choosing the size of test batches
+
+    Constructor arguments:
+    :param int history:     (Optional) The amount of recent change outcomes
+                            and test durations to keep
+    :param int min_history: (Optional) The amount of change outcomes that must
+                            be seen before the model limits batch sizes
+    :param int max_size:    (Optional) The largest batch size the model
+                            considers. If batches larger then that seem best,
+                            batch sizes are not limited at all
+
+    The model chooses the batch size that minimizes the expected tester time
+    spent per change, which is what determines how fast the queue can drain
+    a backlog of waiting changes. Large batches share a single test between
+    many changes, but are more likely to include a failing change and need a
+    long bisection. Once bisection finds the first failing change, the
+    changes before it are merged, and the ones after it go back to the queue
+    to be tested again. So for a batch of 'n' changes, the expected amount of
+    test runs is estimated as:
+
+        1 + (1 - (1 - p) ** n) * (ways - 1) * ceil(log(n, ways))
+
+    And the expected amount of changes that leave the queue as:
+
+        (1 - (1 - p) ** n) / p
+
+    Where 'p' is the observed fraction of changes that were rejected, and
+    'ways' is the amount of parts failed batches are split to. The duration
+    of each run is estimated with a linear fit of recent test durations over
+    batch sizes, so tests that take longer for larger batches make smaller
+    batches more attractive.
+    """
+    def __init__(self, history=200, min_history=20, max_size=200):
+        self.min_history = min_history
+        self.max_size = max_size
+        self._outcomes = deque([], history)
+        self._durations = deque([], history)
+        self._best_size_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_best_size_cache'] = None
+        return state
+
+    def record_outcomes(self, merged, rejected):
+        """Record the outcome of changes that left the queue
+
+        :param int merged:   The amount of changes that passed testing
+        :param int rejected: The amount of changes that were found to fail
+        """
+        if not (merged or rejected):
+            return
+        self._outcomes.extend([False] * merged)
+        self._outcomes.extend([True] * rejected)
+        self._best_size_cache = None
+
+    def record_test_duration(self, batch_size, duration):
+        """Record how long testing a batch of changes took
+
+        :param int batch_size:  The amount of changes tested
+        :param float duration:  How long the test took
+        """
+        if batch_size < 1 or duration <= 0:
+            return
+        self._durations.append((batch_size, duration))
+        self._best_size_cache = None
+
+    @property
+    def failure_rate(self):
+        """The fraction of recent changes that were rejected, or None if too
+        few changes were seen to tell
+        """
+        if len(self._outcomes) < self.min_history:
+            return None
+        return sum(self._outcomes) / len(self._outcomes)
+
+    def expected_duration(self, batch_size):
+        """Estimate how long testing a batch of the given size takes, in
+        the time units durations were recorded in, or 1.0 if no durations were
+        recorded
+        """
+        mean_size, mean_duration, slope = self._duration_fit()
+        return max(0.0, mean_duration + slope * (batch_size - mean_size))
+
+    def _duration_fit(self):
+        """Fit a line to the recorded test durations over batch sizes
+
+        :rtype: tuple
+        :returns: The mean batch size, the mean duration and the slope of the
+                  line
+        """
+        if not self._durations:
+            return 1.0, 1.0, 0.0
+        sizes, durations = zip(*self._durations)
+        mean_size = sum(sizes) / len(sizes)
+        mean_duration = sum(durations) / len(durations)
+        size_var = sum((s - mean_size) ** 2 for s in sizes)
+        if not size_var:
+            return mean_size, mean_duration, 0.0
+        slope = sum(
+            (s - mean_size) * (d - mean_duration)
+            for s, d in zip(sizes, durations)
+        ) / size_var
+        # Tests do not get faster for larger batches, if they seem to, it is
+        # just noise
+        return mean_size, mean_duration, max(0.0, slope)
+
+    @staticmethod
+    def expected_runs(batch_size, failure_rate, bisect_ways=2):
+        """Estimate the amount of test runs needed to test a batch and
+        bisect it if it fails
+        """
+        if batch_size <= 1:
+            return 1.0
+        ways = max(2, bisect_ways)
+        depth = int(ceil(log(batch_size) / log(ways) - 1e-9))
+        fail_prob = 1.0 - (1.0 - failure_rate) ** batch_size
+        return 1.0 + fail_prob * (ways - 1) * depth
+
+    @staticmethod
+    def expected_resolved(batch_size, failure_rate):
+        """Estimate the amount of changes that leave the queue after testing
+        a batch and bisecting it to find the first failing change
+        """
+        if failure_rate <= 0:
+            return float(batch_size)
+        return (1.0 - (1.0 - failure_rate) ** batch_size) / failure_rate
+
+    def best_batch_size(self, bisect_ways=2):
+        """Find the batch size with the lowest expected testing time per
+        change
+
+        :param int bisect_ways: The amount of parts failed batches are split
+                                to
+
+        :rtype: int
+        :returns: The best batch size, or None if batch sizes should not be
+                  limited, either because there is not enough information to
+                  tell or because even larger batches then 'max_size' would
+                  be better
+        """
+        if self._best_size_cache is not None and \
+                self._best_size_cache[0] == bisect_ways:
+            return self._best_size_cache[1]
+        failure_rate = self.failure_rate
+        best_size = None
+        if failure_rate is not None:
+            mean_size, mean_duration, slope = self._duration_fit()
+            costs = [
+                self.expected_runs(size, failure_rate, bisect_ways) *
+                max(0.0, mean_duration + slope * (size - mean_size)) /
+                self.expected_resolved(size, failure_rate)
+                for size in range(1, self.max_size + 1)
+            ]
+            best_size = costs.index(min(costs)) + 1
+            if best_size == self.max_size:
+                best_size = None
+        self._best_size_cache = (bisect_ways, best_size)
+        return best_size
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""change_queue.build_registry - A registry of change builds that is shared
+between change queues, so a change that is added to several queues is only
+built once
+
+The registry can also be run from the command line to print how much builder
+time it saved, run with '--help' for details.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+from contextlib import contextmanager
+from errno import ENOENT
+import fcntl
+import json
+from os import environ, fsync, rename
+import sys
+from time import time
+
+from stdci_libs.jenkins_objects import BuildsList
+
+
+class BuildRegistry(object):
+    """A registry of builds keyed by the project, the commit SHA and the build
+    spec they were made for
+
+    Constructor arguments:
+    :param str registry_file:     The JSON file to keep the registry in. It
+                                  should be placed where all the queue jobs
+                                  that share it can reach it, e.g. on the
+                                  node the jobs run on
+    :param float max_age:         (Optional) How long, in seconds, registered
+                                  builds can be reused for
+    :param float pending_max_age: (Optional) How long, in seconds, builds that
+                                  have not started running yet can be reused
+                                  for. Such builds may get dropped from the
+                                  Jenkins queue, so they go stale sooner
+
+    Builds that were marked as failed with mark_failed are not reused, and
+    are replaced by the next builds registered for the same key. The registry
+    keeps count of reused builds and of the builder time they saved, based on
+    the build durations given when builds were registered.
+
+    The registry file is locked while it is read and written, so it can be
+    used from several jobs at once.
+    """
+    max_age = 7 * 24 * 60 * 60
+    pending_max_age = 2 * 60 * 60
+
+    def __init__(self, registry_file, max_age=None, pending_max_age=None):
+        self.registry_file = registry_file
+        if max_age is not None:
+            self.max_age = max_age
+        if pending_max_age is not None:
+            self.pending_max_age = pending_max_age
+
+    @classmethod
+    def from_env(cls, env_var='CQ_BUILD_REGISTRY'):
+        """Get the registry whose file is given in an environment variable
+
+        :rtype: BuildRegistry
+        :returns: The registry or None if the variable is not set
+        """
+        registry_file = environ.get(env_var)
+        if not registry_file:
+            return None
+        return cls(registry_file)
+
+    @staticmethod
+    def _entry_key(key):
+        return json.dumps(list(key))
+
+    @contextmanager
+    def _locked_data(self, write=True):
+        """Lock the registry file and load its data
+
+        :param bool write: (Optional) Whether to save the data back when the
+                           context ends
+
+        The data is a dict with an 'entries' dict and the 'reuses' and
+        'saved_time' counters.
+        """
+        with open(self.registry_file + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                data = self._load()
+                yield data
+                if write:
+                    self._save(data)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.registry_file) as fil:
+                return json.load(fil)
+        except IOError as e:
+            if e.errno != ENOENT:
+                raise
+        return dict(entries={}, reuses=0, saved_time=0.0)
+
+    def _save(self, data):
+        # Write to a temporary file and rename it, so readers never see a
+        # partially written registry
+        tmp_path = self.registry_file + '.tmp'
+        with open(tmp_path, 'w') as fil:
+            json.dump(data, fil)
+            fil.flush()
+            fsync(fil.fileno())
+        rename(tmp_path, self.registry_file)
+
+    def _is_usable(self, entry, now):
+        if entry is None or entry['failed']:
+            return False
+        age = now - entry['time']
+        if any(build.get('build_url') is None for build in entry['builds']):
+            return age <= self.pending_max_age
+        return age <= self.max_age
+
+    def _prune(self, data, now):
+        data['entries'] = dict(
+            (entry_key, entry)
+            for entry_key, entry in data['entries'].items()
+            if now - entry['time'] <= self.max_age
+        )
+
+    def register(self, key, builds, duration=None, now=None):
+        """Register builds made for a change
+
+        :param tuple key:         The (project, sha, build spec) key
+        :param BuildsList builds: The builds
+        :param float duration:    (Optional) How long it took to make the
+                                  builds, in seconds
+        :param float now:         (Optional) The current time
+
+        :rtype: bool
+        :returns: True if the builds were registered, False if usable builds
+                  were already registered for the key
+        """
+        if not builds:
+            return False
+        if now is None:
+            now = time()
+        with self._locked_data() as data:
+            entry_key = self._entry_key(key)
+            if self._is_usable(data['entries'].get(entry_key), now):
+                return False
+            self._prune(data, now)
+            data['entries'][entry_key] = dict(
+                builds=BuildsList(builds).as_dict_list(), time=now,
+                duration=duration, failed=False,
+            )
+            return True
+
+    def attach(self, key, now=None):
+        """Get registered builds for reuse
+
+        :param tuple key:  The (project, sha, build spec) key
+        :param float now:  (Optional) The current time
+
+        :rtype: BuildsList
+        :returns: The registered builds, or None if there are no usable ones.
+                  If builds are returned, they are counted as reused
+        """
+        if now is None:
+            now = time()
+        with self._locked_data() as data:
+            entry = data['entries'].get(self._entry_key(key))
+            if not self._is_usable(entry, now):
+                return None
+            data['reuses'] += 1
+            data['saved_time'] += entry['duration'] or 0.0
+            return BuildsList.from_dict_list(entry['builds'])
+
+    def mark_failed(self, key):
+        """Mark the builds registered for a key as failed, so they are not
+        reused
+
+        :param tuple key:  The (project, sha, build spec) key
+        """
+        with self._locked_data() as data:
+            entry = data['entries'].get(self._entry_key(key))
+            if entry is not None:
+                entry['failed'] = True
+
+    def stats(self):
+        """Get registry statistics
+
+        :rtype: dict
+        :returns: The amount of registered builds, the amount of times builds
+                  were reused, and the builder time reusing them saved
+        """
+        with self._locked_data(write=False) as data:
+            return dict(
+                entries=len(data['entries']),
+                reuses=data['reuses'],
+                saved_time=data['saved_time'],
+            )
+
+
+def main(args=None):
+    args = parse_args(args)
+    json.dump(
+        BuildRegistry(args.registry_file).stats(), sys.stdout,
+        indent=2, sort_keys=True,
+    )
+    sys.stdout.write('\n')
+    return 0
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Print build registry statistics as JSON'
+    )
+    parser.add_argument('registry_file', help='The registry file')
+    args = parser.parse_args(args)
+    return args
+
+
+if __name__ == '__main__':
+    exit(main())
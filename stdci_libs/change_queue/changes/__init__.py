@@ -14,6 +14,7 @@ from os import environ
 from stdci_libs.object_utils import object_witp_opt_attrs, object_proxy
 from stdci_libs.gerrit import GerritPatchset
 from stdci_libs.jenkins_objects import BuildsList
+from stdci_libs.email_dispatcher import EmailDispatcher
 
 
 class DisplayableChange(object_witp_opt_attrs):
@@ -53,6 +54,44 @@ class ChangeInStreamWrapper(ChangeInStream, object_proxy):
     """
 
 
+class ChangeWithPriority(object_witp_opt_attrs):
+    """Base/Mixin class for changes that can be given a priority in the change
+    queue. Changes with a priority larger then 0 are tested before changes
+    with lower priorities. Changes have a priority of 0 by default
+    """
+    default_priority = 0
+
+    def _cast_priority(self, value):
+        return int(value)
+
+    def set_priority_from_env(self, env_var='CQ_CHANGE_PRIORITY'):
+        if env_var in environ:
+            self.priority = environ[env_var]
+
+
+class ChangeWithPriorityWrapper(ChangeWithPriority, object_proxy):
+    """Wrapper class to make changes without a priority look like they have
+    the default one
+    """
+
+
+class ChangeWithRisk(object_witp_opt_attrs):
+    """Base/Mixin class for changes that share attributes which make changes
+    more or less likely to fail, like the project they belong to or their
+    author. Such attributes are given as a tuple of hashable 'risk_keys'
+    """
+    default_risk_keys = ()
+
+    def _cast_risk_keys(self, value):
+        return tuple(value)
+
+
+class ChangeWithRiskWrapper(ChangeWithRisk, object_proxy):
+    """Wrapper class to make changes without risk keys look like they have
+    empty ones
+    """
+
+
 class EmailNotifyingChange(DisplayableChange):
     """Base/Mixin class for changes that can send email notifications on queue
     events
@@ -217,6 +256,9 @@ class EmailNotifyingChange(DisplayableChange):
         all other calls to this method. Be default the lock will only work at
         the class level, so calling code that may call this method on different
         classes needs to pass in its own lock.
+
+        If there is an active EmailDispatcher, the message is passed to it to
+        be sent later together with other messages.
         """
         if lock is None:
             lock = self._report_status_lock
@@ -225,6 +267,10 @@ class EmailNotifyingChange(DisplayableChange):
             if msg is None:
                 return
             smtp_host = getattr(self, 'smtp_host')
+        dispatcher = EmailDispatcher.active
+        if dispatcher is not None:
+            dispatcher.send(smtp_host, msg)
+            return
         smtp = None
         try:
             smtp = smtplib.SMTP(smtp_host)
@@ -250,8 +296,22 @@ class ChangeWithBuilds(object_witp_opt_attrs):
     artifacts
 
     Builds are specified as a BuildsList object
+
+    Changes that have a 'build_key' can share their builds with other change
+    queues via a BuildRegistry (See change_queue.build_registry). The key is
+    typically made of the project, the commit SHA and the 'build_spec' which
+    tells how the change was built. The time it took to make the builds can
+    be given in 'build_duration'. Changes can get builds that were registered
+    by other queues with set_builds_from_registry, so they do not need to be
+    built again.
     """
     default_builds = BuildsList()
+    default_build_spec = None
+    default_build_duration = None
+    default_build_key = None
+
+    def _cast_build_duration(self, value):
+        return None if value is None else float(value)
 
     def set_builds_from_env(self, env_var='BUILDS_LIST'):
         self.builds = BuildsList.from_env_json(env_var)
@@ -259,12 +319,41 @@ class ChangeWithBuilds(object_witp_opt_attrs):
     def set_current_build_from_env(self):
         self.builds = BuildsList.from_currnt_build_env()
 
+    def set_build_spec_from_env(
+        self, env_var='CQ_BUILD_SPEC', duration_env_var='CQ_BUILD_DURATION'
+    ):
+        if env_var in environ:
+            self.build_spec = environ[env_var]
+        if duration_env_var in environ:
+            self.build_duration = environ[duration_env_var]
+
+    def set_builds_from_registry(self, registry):
+        """Set the builds of the change to the ones registered for its build
+        key in a build registry, if there are usable ones
+
+        :param BuildRegistry registry: The registry to get builds from, may be
+                                       None
+
+        :rtype: bool
+        :returns: True if registered builds were set
+        """
+        key = self.build_key
+        if registry is None or key is None:
+            return False
+        builds = registry.attach(key)
+        if builds is None:
+            return False
+        self.builds = builds
+        return True
+
 
 class ChangeWithBuildsWrapper(ChangeWithBuilds, object_proxy):
     """Wrapper class to make changes appear like they have builds"""
 
 
-class GerritMergedChange(ChangeWithBuilds, EmailNotifyingChange):
+class GerritMergedChange(
+    ChangeWithBuilds, ChangeWithPriority, ChangeWithRisk, EmailNotifyingChange
+):
     """A change class for changes that get created as a result of merging
     patches to Gerrit repos
 
@@ -289,6 +378,8 @@ class GerritMergedChange(ChangeWithBuilds, EmailNotifyingChange):
     def from_jenkins_env(cls):
         o = cls(gerrit_patchset=GerritPatchset.from_jenkins_env())
         o.set_builds_from_env()
+        o.set_build_spec_from_env()
+        o.set_priority_from_env()
         o._set_originator_from_env()
         o._set_recipients_from_env()
         return o
@@ -332,6 +423,23 @@ class GerritMergedChange(ChangeWithBuilds, EmailNotifyingChange):
             self.gerrit_patchset.branch.name,
         )
 
+    @property
+    def risk_keys(self):
+        return (
+            ('project', self.gerrit_patchset.project.name),
+            ('owner', self.gerrit_patchset.change.owner.email),
+        )
+
+    @property
+    def build_key(self):
+        if self.build_spec is None:
+            return None
+        return (
+            self.gerrit_patchset.project.name,
+            self.gerrit_patchset.revision,
+            self.build_spec,
+        )
+
     def _set_recipients_from_env(self):
         """Set mail recipients from env vars
         """
@@ -347,7 +455,9 @@ class GerritMergedChange(ChangeWithBuilds, EmailNotifyingChange):
             self.originator = environ['CQ_GERRIT_ORIGINATOR']
 
 
-class GitMergedChange(ChangeWithBuilds, EmailNotifyingChange):
+class GitMergedChange(
+    ChangeWithBuilds, ChangeWithPriority, ChangeWithRisk, EmailNotifyingChange
+):
     """A change class for changes that get created as a result of merging
     patches to generic Git repos
 
@@ -391,3 +501,13 @@ class GitMergedChange(ChangeWithBuilds, EmailNotifyingChange):
     @property
     def stream_id(self):
         return (self.project, self.branch)
+
+    @property
+    def risk_keys(self):
+        return (('project', self.project),)
+
+    @property
+    def build_key(self):
+        if self.build_spec is None:
+            return None
+        return (self.project, self.sha, self.build_spec)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""change_queue.metrics - Collect change queue metrics and write them in the
+Prometheus text exposition format, so they can be picked up by the node
+exporter textfile collector
+"""
+from __future__ import absolute_import, division
+from bisect import bisect_left
+from collections import OrderedDict
+from os import fsync, rename
+
+
+class Histogram(object):
+    """A Prometheus style histogram of observed values
+
+    Constructor arguments:
+    :param Iterable buckets: The upper bounds of the histogram buckets. A
+                             bucket for all values is always added
+
+    Histograms are pickled along with the objects that own them, so their
+    counts keep growing across runs like Prometheus expects.
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Get the amount of observed values that fall into each bucket
+
+        :rtype: list
+        :returns: (upper bound, count) pairs, including values that fall
+                  into the smaller buckets, ending with the '+Inf' bucket
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((_format_value(bound), total))
+        result.append(('+Inf', self.count))
+        return result
+
+
+class TextfileMetrics(object):
+    """A collection of metric families to write into a textfile
+
+    Constructor arguments:
+    :param dict labels: (Optional) Labels to add to all samples
+    """
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self._families = OrderedDict()
+
+    def _family(self, name, metric_type, help_text):
+        return self._families.setdefault(name, (metric_type, help_text, []))[2]
+
+    def add_gauge(self, name, help_text, value, labels=None):
+        """Add a gauge sample
+
+        :param str name:      The metric name
+        :param str help_text: The metric description
+        :param float value:   The sample value
+        :param dict labels:   (Optional) Sample labels
+        """
+        self._family(name, 'gauge', help_text).append(
+            _format_sample(name, self._labels(labels), value)
+        )
+
+    def add_histogram(self, name, help_text, histogram, labels=None):
+        """Add the samples of a histogram
+
+        :param str name:            The metric name
+        :param str help_text:       The metric description
+        :param Histogram histogram: The histogram
+        :param dict labels:         (Optional) Labels for the samples
+        """
+        samples = self._family(name, 'histogram', help_text)
+        labels = self._labels(labels)
+        for bound, count in histogram.cumulative_counts():
+            samples.append(_format_sample(
+                name + '_bucket', dict(labels, le=bound), count
+            ))
+        samples.append(_format_sample(name + '_sum', labels, histogram.sum))
+        samples.append(
+            _format_sample(name + '_count', labels, histogram.count)
+        )
+
+    def _labels(self, labels):
+        return dict(self.labels, **(labels or {}))
+
+    def render(self):
+        """Render the metrics in the Prometheus text format
+
+        :rtype: str
+        """
+        lines = []
+        for name, (metric_type, help_text, samples) in self._families.items():
+            lines.append('# HELP {0} {1}'.format(name, _escape(help_text)))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            lines.extend(samples)
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, file_path):
+        """Write the metrics into a file
+
+        The file is written under a temporary name and renamed, so the
+        collector never reads a partially written file.
+        """
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as fil:
+            fil.write(self.render())
+            fil.flush()
+            fsync(fil.fileno())
+        rename(tmp_path, file_path)
+
+
+def _escape(text, quote=False):
+    text = text.replace('\\', r'\\').replace('\n', r'\n')
+    if quote:
+        text = text.replace('"', r'\"')
+    return text
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(label, _escape(str(labels[label]), True))
+            for label in sorted(labels)
+        ) + '}'
+    return '{0} {1}'.format(name, _format_value(value))
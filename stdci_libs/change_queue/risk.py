@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""change_queue.risk - Estimate how likely changes are to fail, and split
+failed batches according to it
+"""
+from __future__ import absolute_import, division
+
+from .changes import ChangeWithRiskWrapper
+
+
+class FailureEstimator(object):
+    """Estimate how likely changes are to fail from the outcomes of earlier
+    changes that share risk keys with them
+
+    Constructor arguments:
+    :param float prior_weight: (Optional) How many outcomes the overall
+                               failure rate counts as when estimating for a
+                               risk key. Keys with fewer outcomes then that
+                               get estimates close to the overall rate
+    :param int max_count:      (Optional) Counts for a risk key are halved
+                               when they reach this amount of outcomes, so
+                               that recent outcomes weigh more
+
+    Risk keys are taken from the 'risk_keys' attribute of changes (See
+    ChangeWithRisk). A change gets the estimate of its riskiest key, or the
+    overall failure rate if none of its keys were seen before. The
+    estimator is pickled along with the queue it belongs to, so it can keep
+    learning across queue runs.
+    """
+    def __init__(self, prior_weight=5.0, max_count=100):
+        self.prior_weight = prior_weight
+        self.max_count = max_count
+        self._counts = dict()
+        self._overall = [0.0, 0.0]
+
+    @staticmethod
+    def risk_keys(change):
+        return ChangeWithRiskWrapper(change).risk_keys
+
+    def record_outcome(self, change, failed):
+        """Record whether a change was found to fail
+
+        :param object change: The change
+        :param bool failed:   True if the change failed
+        """
+        for counts in [self._overall] + [
+            self._counts.setdefault(key, [0.0, 0.0])
+            for key in self.risk_keys(change)
+        ]:
+            counts[0] += int(failed)
+            counts[1] += 1
+            if counts[1] >= self.max_count:
+                counts[0] /= 2
+                counts[1] /= 2
+
+    def failure_probability(self, change):
+        """Estimate the probability of a change to fail
+
+        :param object change: The change
+
+        :rtype: float
+        :returns: The estimated probability. Before any outcomes were
+                  recorded, all changes get the same estimate
+        """
+        failed, total = self._overall
+        base = (failed + 1) / (total + 2)
+        estimates = [
+            (counts[0] + self.prior_weight * base) /
+            (counts[1] + self.prior_weight)
+            for counts in (
+                self._counts.get(key) for key in self.risk_keys(change)
+            )
+            if counts is not None
+        ]
+        return max(estimates) if estimates else base
+
+    def split_points(self, changes, ways):
+        """Find where to split a failed batch of changes
+
+        :param list changes: The changes in the batch, in queue order
+        :param int ways:     The amount of parts to split the batch to
+
+        :rtype: list
+        :returns: The indexes in changes where the 2nd to last parts start
+        """
+        return risk_split_points(
+            [self.failure_probability(change) for change in changes], ways
+        )
+
+
+def even_split_points(size, ways):
+    """Find where to split a list into parts of (almost) equal sizes
+
+    :param int size: The length of the list
+    :param int ways: The amount of parts to split the list to
+
+    :rtype: list
+    :returns: The indexes where the 2nd to last parts start
+    """
+    return [int(size * i / ways) for i in range(1, ways)]
+
+
+def risk_split_points(probabilities, ways):
+    """Find where to split a failed batch so that each part is about as
+    likely to hold the first failing change
+
+    :param list probabilities: The failure probability of each change in the
+                               batch
+    :param int ways:           The amount of parts to split the batch to
+
+    :rtype: list
+    :returns: The indexes where the 2nd to last parts start. Every part
+              includes at least one change
+    """
+    size = len(probabilities)
+    weights = []
+    all_pass = 1.0
+    for prob in probabilities:
+        weights.append(prob * all_pass)
+        all_pass *= 1.0 - prob
+    total = sum(weights)
+    if total <= 0:
+        return even_split_points(size, ways)
+    points = []
+    cumulative = 0.0
+    idx = 0
+    for part in range(1, ways):
+        target = total * part / ways
+        # Leave room for at least one change in each of the following parts
+        last_start = size - (ways - part)
+        while idx < last_start and (
+            idx < (points[-1] if points else 0) + 1 or
+            cumulative + weights[idx] / 2 < target
+        ):
+            cumulative += weights[idx]
+            idx += 1
+        points.append(idx)
+    return points
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""change_queue.service - A long-lived change queue service with a local HTTP
+API
+
+The service keeps the queue state in memory instead of loading and saving it
+on every queue job run, while still persisting every action to the queue
+journal before replying. It uses the same artifacts as the queue job, so a
+queue can move between the job and the service.
+
+Run with '--help' for details about running the service from the command
+line. JenkinsChangeQueueClient objects can be pointed at the service by
+passing them its URL.
+
+HTTP API:
+    POST /add, /on_test_success, /on_test_failure, /on_test_infra_failure,
+         /get_next_test, /batch
+        Perform a queue action. The request body is a JSON object with an
+        'arg' key holding the action argument and an optional 'actor_url'
+        key. The reply is a JSON object with a 'build_steps' key holding a
+        list of tester job runs to trigger ({'job_name', 'params',
+        'quiet_period'} objects),
+        and a 'tested_change_list' key holding the changes to test, encoded
+        with JenkinsObject.object_to_param_str, or null.
+    GET /status, /status/<page>
+        Get the queue status index or one of the status pages, in the format
+        JenkinsChangeQueue writes them.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+from errno import ENOENT
+import json
+import logging
+from os import chdir, environ, path
+from threading import Lock
+
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+from stdci_libs.change_queue import JenkinsChangeQueue, \
+    JenkinsTestedChangeList
+from stdci_libs.jenkins_objects import JobRunSpec
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeQueueService(object):
+    """A change queue that lives in memory and is served over HTTP
+
+    Constructor arguments:
+    :param str host:            (Optional) The address to listen on. Defaults
+                                to the local host only, since the API is not
+                                authenticated
+    :param int port:            (Optional) The port to listen on. If 0, a free
+                                port is picked
+    :param type queue_cls:      (Optional) The queue class to use
+    :param str artifact_file:   (Optional) The queue snapshot file name
+
+    The service must be run in the same environment and working directory a
+    queue job would run in, so the queue can find its name and artifacts.
+    Actions are performed one at a time. If performing an action fails, the
+    queue is reloaded from its snapshot and journal, so changes made by the
+    failed action are dropped just like when a queue job fails.
+    """
+    ACTIONS = JenkinsChangeQueue.BATCH_ACTIONS + ('batch',)
+
+    def __init__(
+        self, host='127.0.0.1', port=0, queue_cls=JenkinsChangeQueue,
+        artifact_file=None,
+    ):
+        self._queue_cls = queue_cls
+        self._artifact_file, self._journal_file = \
+            queue_cls._journal_files(artifact_file)
+        self._lock = Lock()
+        self._load_queue()
+        # Fail early if we're not running in the queue environment
+        self._queue.get_queue_name()
+        self._queue.verify_artifacts_dir()
+        self._queue._write_status_file()
+        self.httpd = _QueueHTTPServer((host, port), _QueueRequestHandler)
+        self.httpd.service = self
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.httpd.server_address[:2])
+
+    def _load_queue(self):
+        self._queue = self._queue_cls._load_with_journal(
+            self._artifact_file, self._journal_file
+        )
+
+    def serve_forever(self):
+        logger.info('Serving change queue at {0}'.format(self.url))
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop serving requests and close the listening socket
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def perform(self, queue_action, action_arg='', actor_url=None):
+        """Perform a queue action and persist it
+
+        :param str queue_action: The queue action to perform
+        :param str action_arg:   An argument to the queue_action if needed
+        :param str actor_url:    (Optional) The URL of the thing that asked for
+                                 the queue action
+
+        :rtype: dict
+        :returns: The action results, as described in the module docstring
+        """
+        with self._lock:
+            try:
+                self._queue.act_on_job_params(
+                    queue_action, action_arg, actor_url
+                )
+                self._queue._save_journal(
+                    self._artifact_file, self._journal_file
+                )
+            except Exception:
+                self._load_queue()
+                raise
+            return dict(
+                build_steps=self._read_build_steps(),
+                tested_change_list=self._read_tested_change_list(),
+            )
+
+    @staticmethod
+    def _read_build_steps():
+        try:
+            with open(JobRunSpec.default_pipelins_build_step_json_file) as f:
+                steps = json.load(f)
+        except IOError as e:
+            if e.errno == ENOENT:
+                return []
+            raise
+        if isinstance(steps, dict):
+            steps = [steps]
+        return [
+            dict(
+                job_name=step['job'],
+                params=dict(
+                    (param['name'], param['value'])
+                    for param in step['parameters']
+                ),
+                quiet_period=step.get('quietPeriod'),
+            )
+            for step in steps
+        ]
+
+    @staticmethod
+    def _read_tested_change_list():
+        try:
+            tested = JenkinsTestedChangeList.load_from_artifact(
+                fallback_to_new=False
+            )
+        except IOError as e:
+            if e.errno == ENOENT:
+                return None
+            raise
+        return JenkinsTestedChangeList.object_to_param_str(tested)
+
+    def get_status(self, page=None):
+        """Get the queue status
+
+        :param int page: (Optional) The status page to get. If not given, the
+                         status index is returned
+
+        :rtype: dict
+        :returns: The status data JenkinsChangeQueue writes to its JSON status
+                  files
+        """
+        with self._lock:
+            if page is None:
+                status_file = path.join(
+                    self._queue.ARTIFACTS_DIR,
+                    self._queue.STATUS_FILE + '.json',
+                )
+            else:
+                status_file = self._queue._status_page_file(page)
+            with open(status_file) as fil:
+                return json.load(fil)
+
+
+class _QueueHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _QueueRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[0] != 'status' or len(parts) > 2:
+            return self._reply(404, dict(error='Not found'))
+        try:
+            page = int(parts[1]) if len(parts) > 1 else None
+            status = self.server.service.get_status(page)
+        except ValueError:
+            return self._reply(404, dict(error='Not found'))
+        except IOError as e:
+            if e.errno == ENOENT:
+                return self._reply(404, dict(error='Not found'))
+            raise
+        self._reply(200, status)
+
+    def do_POST(self):
+        queue_action = self.path.strip('/')
+        if queue_action not in ChangeQueueService.ACTIONS:
+            return self._reply(404, dict(error='Not found'))
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf8') or '{}')
+            action_arg = body.get('arg', '')
+            actor_url = body.get('actor_url')
+        except (ValueError, AttributeError):
+            return self._reply(400, dict(error='Invalid request body'))
+        try:
+            result = self.server.service.perform(
+                queue_action, action_arg, actor_url
+            )
+        except Exception as e:
+            logger.exception('Failed to perform queue action')
+            return self._reply(500, dict(error=str(e)))
+        self._reply(200, result)
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    JenkinsChangeQueue.setup_logging()
+    if args.workdir:
+        chdir(args.workdir)
+    if args.queue:
+        environ['JOB_BASE_NAME'] = args.queue + \
+            JenkinsChangeQueue.QUEUE_JOB_SUFFIX
+    service = ChangeQueueService(args.host, args.port)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.httpd.server_close()
+    return 0
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run a change queue as a long-lived HTTP service'
+    )
+    parser.add_argument(
+        '--queue',
+        help='The name of the queue to serve. Taken from the queue job name '
+        'in $JOB_BASE_NAME if not given'
+    )
+    parser.add_argument(
+        '--workdir',
+        help='The directory to keep queue artifacts in '
+        '(default: the current directory)'
+    )
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='The address to listen on (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--port', type=int, default=8765,
+        help='The port to listen on (default: %(default)s)'
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""change_queue.simulator - Deterministic simulation of change queue
+behaviour for comparing queue algorithms and settings
+
+The simulator can also be run from the command line to get simulation results
+in JSON format, run with '--help' for details.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+from collections import namedtuple
+from heapq import heappush, heappop
+from itertools import count
+import json
+from math import ceil, log
+import random
+import sys
+import time
+
+from stdci_libs.change_queue import ChangeQueue, ChangeQueueWithDeps, \
+    ChangeQueueWithStreams
+
+# Use CPU time where possible, so measurements are not affected by other
+# processes
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+QUEUE_CLASSES = dict(
+    (cls.__name__, cls)
+    for cls in (ChangeQueue, ChangeQueueWithDeps, ChangeQueueWithStreams)
+)
+PERCENTILES = (50, 90, 95, 99)
+
+
+class SimulatedChange(namedtuple(
+    '_SimulatedChange', ('id', 'arrival', 'bad', 'requirements', 'stream_id')
+)):
+    """A change used in simulations
+
+    :param int id:              The change ID
+    :param float arrival:       The (simulated) time in which the change
+                                arrives to the queue
+    :param bool bad:            Whether the change causes tests to fail
+    :param tuple requirements:  (Optional) IDs of changes this change depends
+                                on
+    :param int stream_id:       (Optional) The change stream the change belongs
+                                to
+    """
+    def __new__(cls, id, arrival, bad, requirements=(), stream_id=None):
+        return super(SimulatedChange, cls).__new__(
+            cls, id, arrival, bad, requirements, stream_id
+        )
+
+
+def generate_changes(
+    num_changes, mean_interval, failure_rate, seed=0, dependency_rate=0,
+    dependency_distance=10, streams=0,
+):
+    """Generate a list of changes with exponentially distributed arrival
+    intervals (a Poisson arrival process)
+
+    :param int num_changes:         The amount of changes to generate
+    :param float mean_interval:     The mean time between change arrivals
+    :param float failure_rate:      The probability of a change being bad
+    :param int seed:                Seed for the pseudo random generator, the
+                                    same seed always generates the same changes
+    :param float dependency_rate:   (Optional) The probability of a change
+                                    depending on an earlier change
+    :param int dependency_distance: (Optional) How far back changes can be
+                                    from the changes that depend on them
+    :param int streams:             (Optional) The amount of change streams to
+                                    spread the changes between. If 0, changes
+                                    do not belong to streams
+
+    :rtype: list
+    :returns: A list of SimulatedChange objects sorted by arrival time
+    """
+    rnd = random.Random(seed)
+    # Dependencies and streams are drawn from a separate generator so that
+    # changing their distributions does not change arrivals and failures
+    struct_rnd = random.Random('{0}-structure'.format(seed))
+    changes = []
+    arrival = 0.0
+    for change_id in range(num_changes):
+        arrival += rnd.expovariate(1.0 / mean_interval)
+        bad = rnd.random() < failure_rate
+        requirements = ()
+        if change_id > 0 and struct_rnd.random() < dependency_rate:
+            requirements = (change_id - struct_rnd.randint(
+                1, min(change_id, dependency_distance)
+            ),)
+        stream_id = struct_rnd.randrange(streams) if streams else None
+        changes.append(SimulatedChange(
+            change_id, arrival, bad, requirements, stream_id
+        ))
+    return changes
+
+
+def percentile(sorted_values, pct):
+    """Find a percentile of a list of values using the nearest-rank method
+
+    :param list sorted_values: The values, sorted in ascending order
+    :param float pct:          The percentile to find
+
+    :returns: The value at the given percentile, or 0.0 for an empty list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class QueueSimulator(object):
+    """Discrete event simulator that drives a change queue object
+
+    Constructor arguments:
+    :param ChangeQueue queue:     The queue object to simulate
+    :param Iterable changes:      SimulatedChange objects to add to the queue
+    :param float test_duration:   How long a test run takes on average
+    :param int testers:           (Optional) The amount of test runs that can
+                                  run at the same time
+    :param float duration_sigma:  (Optional) If not 0, test durations are
+                                  drawn from a log-normal distribution with
+                                  this shape parameter and a mean of
+                                  test_duration
+    :param int seed:              (Optional) Seed for the pseudo random
+                                  generator used for test durations
+
+    Tests fail if they include a bad change. Results of tests that the queue
+    is no longer interested in are discarded, but such tests still occupy a
+    tester until they end.
+
+    Requirements of changes that were already merged or rejected by the time
+    the change arrives are dropped, since the queue can no longer see them.
+
+    Test durations are reported to the queue with record_test_duration, so
+    queues with 'adaptive_batching' set can take them into account.
+
+    All the simulation results are deterministic, except for the CPU time
+    measurements.
+    """
+    def __init__(
+        self, queue, changes, test_duration, testers=1, duration_sigma=0.0,
+        seed=0,
+    ):
+        self._queue = queue
+        self._changes = list(changes)
+        self._test_duration = test_duration
+        self._testers = testers
+        self._duration_sigma = duration_sigma
+        self._rnd = random.Random(seed)
+        self._cpu_times = {}
+
+    def _call(self, action, *args):
+        """Call a queue method while measuring the CPU time it takes
+        """
+        start = _cpu_time()
+        result = getattr(self._queue, action)(*args)
+        elapsed = _cpu_time() - start
+        calls, total = self._cpu_times.get(action, (0, 0.0))
+        self._cpu_times[action] = (calls + 1, total + elapsed)
+        return result
+
+    def _get_test_duration(self):
+        if not self._duration_sigma:
+            return self._test_duration
+        mu = log(self._test_duration) - self._duration_sigma ** 2 / 2.0
+        return self._rnd.lognormvariate(mu, self._duration_sigma)
+
+    def run(self):
+        """Run the simulation
+
+        :rtype: dict
+        :returns: Simulation statistics
+        """
+        events = []
+        seq = count()
+        for change in self._changes:
+            heappush(events, (change.arrival, next(seq), 'add', change))
+        running = set()
+        merged = {}
+        rejected = {}
+        failed_tests = {}
+        test_runs = 0
+        now = 0.0
+        while events:
+            now, _, event, arg = heappop(events)
+            if event == 'add':
+                arg = arg._replace(requirements=tuple(
+                    req for req in arg.requirements
+                    if req not in merged and req not in rejected
+                ))
+                add_result = self._call('add', arg)
+                # Only queues with dependencies return added and rejected
+                # changes
+                if add_result is not None:
+                    rejected.update(
+                        (chg.id, now - chg.arrival) for chg in add_result[1]
+                    )
+            elif event == 'test_done':
+                test_key, change_list, duration = arg
+                running.discard(test_key)
+                self._queue.record_test_duration(len(change_list), duration)
+                if any(chg.bad for chg in change_list):
+                    if self._queue.test_key_match(test_key):
+                        for chg in change_list:
+                            failed_tests[chg.id] = \
+                                failed_tests.get(chg.id, 0) + 1
+                    result = self._call('on_test_failure', test_key)
+                else:
+                    result = self._call('on_test_success', test_key)
+                success_list, fail_list, _ = result
+                merged.update(
+                    (chg.id, now - chg.arrival) for chg in success_list
+                )
+                rejected.update(
+                    (chg.id, now - chg.arrival) for chg in fail_list
+                )
+            while len(running) < self._testers:
+                test_key, change_list = self._call('get_next_test')
+                if test_key is None or test_key in running:
+                    break
+                running.add(test_key)
+                test_runs += 1
+                duration = self._get_test_duration()
+                heappush(events, (
+                    now + duration, next(seq), 'test_done',
+                    (test_key, change_list, duration)
+                ))
+        times_to_merge = sorted(merged.values())
+        bisection_depths = [failed_tests.get(chid, 0) for chid in rejected]
+        return dict(
+            changes=len(self._changes),
+            merged=len(merged),
+            rejected=len(rejected),
+            unresolved=len(self._changes) - len(merged) - len(rejected),
+            test_runs=test_runs,
+            test_runs_per_change=(
+                float(test_runs) / len(self._changes)
+                if self._changes else 0.0
+            ),
+            makespan=now,
+            mean_time_to_merge=(
+                sum(times_to_merge) / len(times_to_merge)
+                if times_to_merge else 0.0
+            ),
+            max_time_to_merge=times_to_merge[-1] if times_to_merge else 0.0,
+            time_to_merge_percentiles=dict(
+                ('p{0}'.format(pct), percentile(times_to_merge, pct))
+                for pct in PERCENTILES
+            ),
+            mean_bisection_depth=(
+                float(sum(bisection_depths)) / len(bisection_depths)
+                if bisection_depths else 0.0
+            ),
+            max_bisection_depth=max(bisection_depths or [0]),
+            action_cpu_time=dict(
+                (action, dict(calls=calls, total=total, mean=total / calls))
+                for action, (calls, total) in self._cpu_times.items()
+            ),
+        )
+
+
+def main(args=None):
+    args = parse_args(args)
+    queue = QUEUE_CLASSES[args.queue]()
+    queue.bisect_ways = args.bisect_ways
+    queue.speculation_depth = args.speculation_depth
+    queue.adaptive_batching = args.adaptive_batching
+    changes = generate_changes(
+        args.changes, args.interval, args.failure_rate, args.seed,
+        args.dependency_rate, args.dependency_distance, args.streams,
+    )
+    results = QueueSimulator(
+        queue, changes, args.test_duration, args.testers,
+        args.duration_sigma, args.seed,
+    ).run()
+    parameters = dict(
+        (name, value) for name, value in vars(args).items()
+        if name != 'output'
+    )
+    output = dict(parameters=parameters, results=results)
+    json.dump(output, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+    return 0
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate a change queue and print statistics as JSON'
+    )
+    parser.add_argument(
+        '--queue', choices=sorted(QUEUE_CLASSES), default='ChangeQueue',
+        help='The queue class to simulate (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--changes', type=int, default=1000,
+        help='The amount of changes to simulate (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--interval', type=float, default=60,
+        help='Mean time between change arrivals (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--failure-rate', type=float, default=0.05,
+        help='Probability of a change being bad (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--dependency-rate', type=float, default=0,
+        help='Probability of a change depending on an earlier change '
+        '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--dependency-distance', type=int, default=10,
+        help='How far back dependencies can be (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--streams', type=int, default=0,
+        help='Amount of change streams (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--test-duration', type=float, default=600,
+        help='Mean test run duration (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--duration-sigma', type=float, default=0,
+        help='Log-normal shape parameter for test durations '
+        '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--testers', type=int, default=1,
+        help='Amount of tests that can run at once (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--bisect-ways', type=int, default=ChangeQueue.bisect_ways,
+        help='Parts to split failed batches to (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--speculation-depth', type=int, default=ChangeQueue.speculation_depth,
+        help='Speculative test depth (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--adaptive-batching', action='store_true',
+        help='Limit batch sizes according to observed failure rates'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Pseudo random generator seed (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help='File to write results to (default: standard output)'
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+if __name__ == '__main__':
+    exit(main())
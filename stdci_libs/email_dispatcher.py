@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""email_dispatcher.py - Send many email messages efficiently
+"""
+from __future__ import absolute_import, print_function
+from collections import OrderedDict
+from threading import Thread, Lock
+import logging
+import re
+import smtplib
+
+from six.moves import queue, range
+
+
+logger = logging.getLogger(__name__)
+
+
+class EmailDispatcher(object):
+    """Collect email messages and send them over a pool of reused SMTP
+    connections
+
+    Constructor arguments:
+    :param int max_connections:         (Optional) The maximal amount of
+                                        connections to open to each SMTP host
+                                        at the same time
+    :param int messages_per_connection: (Optional) The maximal amount of
+                                        messages to send over a single SMTP
+                                        connection before opening a new one
+
+    Messages that are passed to `send` are only sent when `flush` is called.
+    Messages to the same recipients are sent one after the other over the
+    same connection. Messages to different recipients are sent in parallel
+    over up to `max_connections` connections per SMTP host.
+
+    A dispatcher can be used as a context manager. While in the context it
+    becomes the `active` dispatcher, and its messages are flushed when the
+    context ends.
+    """
+    active = None
+
+    def __init__(self, max_connections=4, messages_per_connection=100):
+        self.max_connections = max_connections
+        self.messages_per_connection = messages_per_connection
+        self._pending = OrderedDict()
+        self._lock = Lock()
+
+    def __enter__(self):
+        self._outer_dispatcher = EmailDispatcher.active
+        EmailDispatcher.active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        EmailDispatcher.active = self._outer_dispatcher
+        if exc_type is None:
+            self.flush()
+        else:
+            # Do not hide the original exception with errors from sending
+            # messages
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to send email messages')
+
+    def send(self, smtp_host, msg):
+        """Add a message to the messages to be sent
+
+        :param str smtp_host: The SMTP host to send the message through
+        :param Message msg:   The message to send. The message must have 'From'
+                              and 'To' headers
+        """
+        recipients = tuple(re.split(',\\s*', msg['To']))
+        with self._lock:
+            self._pending.setdefault(
+                (smtp_host, msg['From'], recipients), []
+            ).append(msg)
+
+    def flush(self):
+        """Send all the messages that were passed to `send`
+
+        :raises Exception: If sending any of the messages failed, the first
+                           error that was encountered is raised after trying
+                           to send all the other messages
+        """
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        if not pending:
+            return
+        batches_by_host = OrderedDict()
+        for (smtp_host, from_addr, recipients), msgs in pending.items():
+            batches_by_host.setdefault(smtp_host, queue.Queue()).put(
+                (from_addr, recipients, msgs)
+            )
+        errors = []
+        workers = [
+            Thread(
+                target=self._send_batches,
+                args=(smtp_host, batches, errors),
+            )
+            for smtp_host, batches in batches_by_host.items()
+            for worker in range(min(self.max_connections, batches.qsize()))
+        ]
+        logger.info('Sending {0} email messages over {1} connections'.format(
+            sum(map(len, pending.values())), len(workers)
+        ))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def _send_batches(self, smtp_host, batches, errors):
+        """Send batches of messages from the given queue over a single SMTP
+        connection until the queue is empty
+
+        :param str smtp_host:   The SMTP host to send messages through
+        :param Queue batches:   A queue of (from_addr, recipients, messages)
+                                tuples
+        :param list errors:     A list to append errors to
+        """
+        smtp = None
+        sent = 0
+        try:
+            while True:
+                try:
+                    from_addr, recipients, msgs = batches.get_nowait()
+                except queue.Empty:
+                    break
+                for msg in msgs:
+                    if smtp is not None and \
+                            sent >= self.messages_per_connection:
+                        self._close(smtp)
+                        smtp = None
+                    try:
+                        if smtp is None:
+                            smtp, sent = smtplib.SMTP(smtp_host), 0
+                        try:
+                            smtp.sendmail(from_addr, recipients, str(msg))
+                        except smtplib.SMTPServerDisconnected:
+                            # The server may close connections that were open
+                            # for too long, so we reconnect and retry once
+                            smtp, sent = smtplib.SMTP(smtp_host), 0
+                            smtp.sendmail(from_addr, recipients, str(msg))
+                        sent += 1
+                    except Exception as e:
+                        logger.error(
+                            'Failed sending email to %s: %s',
+                            ', '.join(recipients), e
+                        )
+                        errors.append(e)
+                        if smtp is not None:
+                            self._close(smtp)
+                            smtp = None
+        finally:
+            if smtp is not None:
+                self._close(smtp)
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, IOError):
+            smtp.close()
@@ -5,9 +5,9 @@ from __future__ import absolute_import, print_function
 from collections import namedtuple
 from six.moves import cPickle, map
 from six import iteritems
-from os import environ, path, makedirs, unlink
+from os import environ, path, makedirs, unlink, fsync, rename
 from base64 import b64decode, b64encode
-from bz2 import compress, decompress, BZ2File
+from bz2 import compress, decompress
 from contextlib import contextmanager
 from itertools import chain
 import json
@@ -15,6 +15,8 @@ import logging
 from six import BytesIO
 from importlib import import_module
 
+from stdci_libs import object_codec
+
 try:
     from cPickle import Unpickler
 except ImportError:
@@ -25,11 +27,28 @@ except ImportError:
     class Unpickler(cPickle.Unpickler):
         pass
 
-class JobRunSpec(namedtuple('_JobRunSpec', ('job_name', 'params'))):
-    """Class representing a specification for running a Jenkins job"""
+logger = logging.getLogger(__name__)
+
+
+class JobRunSpec(namedtuple(
+    '_JobRunSpec', ('job_name', 'params', 'quiet_period')
+)):
+    """Class representing a specification for running a Jenkins job
+
+    :param str job_name:     The name of the job to run
+    :param dict params:      The parameters to pass to the job
+    :param int quiet_period: (Optional) How many seconds Jenkins should wait
+                             before starting the build, see
+                             as_pipeline_build_step
+    """
     default_properties_file = 'job_params.properties'
     default_pipelins_build_step_json_file = 'build_args.json'
 
+    def __new__(cls, job_name, params, quiet_period=None):
+        return super(JobRunSpec, cls).__new__(
+            cls, job_name, params, quiet_period
+        )
+
     @staticmethod
     def _clean_file(file_name):
         if path.exists(file_name):
@@ -52,8 +71,20 @@ class JobRunSpec(namedtuple('_JobRunSpec', ('job_name', 'params'))):
             file_name = cls.default_properties_file
         cls._clean_file(file_name)
 
-    def as_pipeline_build_step(self):
+    def as_pipeline_build_step(self, quiet_period=None):
+        """Get a structure that a pipeline can pass to the 'build' step
+
+        :param int quiet_period: (Optional) How many seconds Jenkins should
+                                 wait before starting the build. Identical
+                                 builds triggered during that time are merged
+                                 into a single build. Defaults to the
+                                 quiet period of this object
+        """
+        if quiet_period is None:
+            quiet_period = self.quiet_period
         step_struct = dict(job=self.job_name, parameters=[])
+        if quiet_period is not None:
+            step_struct['quietPeriod'] = quiet_period
         for name, value in iteritems(self.params):
             param_struct = dict(name=name)
             if isinstance(value, bool):
@@ -65,11 +96,26 @@ class JobRunSpec(namedtuple('_JobRunSpec', ('job_name', 'params'))):
             step_struct['parameters'].append(param_struct)
         return step_struct
 
-    def as_pipeline_build_step_json(self, file_name=None):
+    def as_pipeline_build_step_json(self, file_name=None, quiet_period=None):
         if file_name is None:
             file_name = self.default_pipelins_build_step_json_file
         with open(file_name, 'w') as fil:
-            json.dump(self.as_pipeline_build_step(), fil)
+            json.dump(self.as_pipeline_build_step(quiet_period), fil)
+
+    @classmethod
+    def as_pipeline_build_steps_json(cls, run_specs, file_name=None):
+        """Write a list of job runs into a JSON file so that a pipeline can
+        trigger them all
+
+        :param Iterable run_specs: JobRunSpec objects for the runs to trigger
+        :param str file_name:      (Optional) The file to write, the same file
+                                   as_pipeline_build_step_json writes to by
+                                   default
+        """
+        if file_name is None:
+            file_name = cls.default_pipelins_build_step_json_file
+        with open(file_name, 'w') as fil:
+            json.dump([rs.as_pipeline_build_step() for rs in run_specs], fil)
 
     @classmethod
     def clean_pipeline_build_step_json(cls, file_name=None):
@@ -223,6 +269,27 @@ def _cpickle_loads(pkl_str):
     return pk.load()
 
 
+def _object_dumps(obj):
+    """Serialize an object with object_codec, falling back to compressed
+    pickle for objects object_codec cannot encode
+    """
+    try:
+        return object_codec.encode(obj)
+    except object_codec.CodecError as e:
+        logger.debug('Falling back to pickle: %s', e)
+        return compress(cPickle.dumps(obj))
+
+
+def _object_loads(data):
+    """Deserialize an object made by _object_dumps. Data in the older
+    compressed pickle format is also accepted, so that objects stored by
+    older versions of this code can still be read
+    """
+    if object_codec.is_encoded(data):
+        return object_codec.decode(data)
+    return _cpickle_loads(decompress(data))
+
+
 class JenkinsObject(object):
     """Base class for objects that run inside Jenkins
     """
@@ -233,14 +300,14 @@ class JenkinsObject(object):
         """Convert a string that supposedly came from a job parameter into a
         change object
         """
-        return _cpickle_loads(decompress(b64decode(param_str.encode('utf8'))))
+        return _object_loads(b64decode(param_str.encode('utf8')))
 
     @staticmethod
     def object_to_param_str(change):
         """Convert a change object into a format suitable for passing in job
         parameters
         """
-        return b64encode(compress(cPickle.dumps(change))).decode('utf8')
+        return b64encode(_object_dumps(change)).decode('utf8')
 
     @staticmethod
     def verify_in_jenkins():
@@ -264,29 +331,27 @@ class JenkinsObject(object):
 
     @classmethod
     def object_from_artifact(cls, artifact_file, fallback_cls=None):
-        fd = None
         try:
-            fd = BZ2File(path.join(cls.ARTIFACTS_DIR, artifact_file))
-            return _cpickle_loads(fd.read())
+            with open(path.join(cls.ARTIFACTS_DIR, artifact_file), 'rb') as fd:
+                return _object_loads(fd.read())
         except IOError as e:
             # errno 2 is 'No such file or directory'
             if e.errno == 2 and fallback_cls is not None:
                 return fallback_cls()
             raise
-        finally:
-            if fd is not None:
-                fd.close()
 
     @classmethod
     def object_to_artifact(cls, obj, artifact_file):
         cls.verify_artifacts_dir()
-        fd = None
-        try:
-            fd = BZ2File(path.join(cls.ARTIFACTS_DIR, artifact_file), 'w')
-            fd.write(cPickle.dumps(obj))
-        finally:
-            if fd is not None:
-                fd.close()
+        artifact_path = path.join(cls.ARTIFACTS_DIR, artifact_file)
+        # Write to a temporary file and rename it, so a crash never leaves a
+        # partially written artifact behind
+        tmp_path = artifact_path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(_object_dumps(obj))
+            fd.flush()
+            fsync(fd.fileno())
+        rename(tmp_path, artifact_path)
 
     @classmethod
     def load_from_artifact(cls, artifact_file=None, fallback_to_new=True):
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""object_codec.py - A safe and compact serialization format for objects
+that need to be passed between Jenkins jobs or stored in build artifacts
+
+Unlike pickle, decoding data in this format never runs arbitrary code. Objects
+can only be created for classes that live in trusted modules, and are restored
+by setting their state directly without calling their constructors.
+
+The encoded data is a short header with the format version followed by
+bzip2-compressed JSON. The JSON contains a table of the classes of the encoded
+objects in 'c', a table of attribute name lists in 'k' and the encoded object
+in 'o'. Objects are encoded as tagged JSON objects:
+- Lists are encoded as JSON arrays, strings, numbers, booleans and None are
+  encoded as themselves
+- Other built-in containers are encoded as {<tag>: <items>} where the tag
+  is 'T' for tuples, 'S' for sets, 'F' for frozensets, 'Q' for deques, 'D'
+  for dicts (as a list of key/value pairs) and 'B' for bytes (in base64)
+- Instances of trusted classes are encoded as {'O': <class index>, ...}
+  with their tuple or list items in 'i' and their state (__getstate__ or
+  __dict__) in 's', or, if the state is a dict with string keys, as an index
+  into the attribute name table followed by the attribute values in 'a'
+- An instance that appears more then once, or a tuple instance that is equal
+  to one that appeared before, is given a number in '#', and later
+  appearances are encoded as {'R': <number>}
+
+The class table also stores the fields of named tuple classes so that named
+tuples can be decoded by field name if their class changed after they were
+encoded.
+"""
+from __future__ import absolute_import, print_function
+from base64 import b64encode, b64decode
+from bz2 import compress, decompress
+from collections import deque
+from importlib import import_module
+import json
+
+from six import integer_types, binary_type, text_type, iteritems
+
+MAGIC = b'JOC'
+VERSION = 1
+# Classes can only be decoded if they are defined in these modules
+TRUSTED_MODULE_PREFIXES = ('stdci_libs.', 'stdci_tools.')
+# Modules that were renamed since objects may have been saved
+MODULE_RENAMES = (('scripts.', 'stdci_libs.'),)
+
+_SCALAR_TYPES = frozenset((bool, float, str, text_type) + integer_types)
+
+
+class CodecError(Exception):
+    pass
+
+
+def is_encoded(data):
+    """Check if the given bytes are in the format made by `encode`
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode(obj):
+    """Encode an object
+
+    :param object obj: The object to encode
+
+    :raises CodecError: If the object contains data that cannot be encoded
+    :rtype: bytes
+    :returns: The encoded object
+    """
+    encoder = _Encoder()
+    encoded = encoder.encode(obj)
+    payload = json.dumps(
+        dict(v=VERSION, c=encoder.classes, k=encoder.shapes, o=encoded),
+        separators=(',', ':'),
+    ).encode('utf8')
+    return MAGIC + str(VERSION).encode('ascii') + compress(payload)
+
+
+def decode(data):
+    """Decode an object
+
+    :param bytes data: Data made by `encode`
+
+    :raises CodecError: If the data is malformed, is of an unknown version or
+                        refers to classes that are not trusted
+    :returns: The decoded object
+    """
+    if not is_encoded(data):
+        raise CodecError('Data is not in a known encoding')
+    try:
+        version = int(data[len(MAGIC):len(MAGIC) + 1])
+    except ValueError:
+        raise CodecError('Malformed encoding version')
+    if version > VERSION:
+        raise CodecError('Unsupported encoding version: {0}'.format(version))
+    try:
+        payload = json.loads(
+            decompress(data[len(MAGIC) + 1:]).decode('utf8')
+        )
+        decoder = _Decoder(payload['c'], payload['k'])
+        encoded = payload['o']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        raise CodecError('Malformed encoded data: {0}'.format(e))
+    return decoder.decode(encoded)
+
+
+def _class_name(cls):
+    return '{0}:{1}'.format(cls.__module__, cls.__name__)
+
+
+def _trusted_class(name):
+    """Find a class by its name, making sure it is in a trusted module
+    """
+    try:
+        module_name, class_name = name.split(':')
+    except ValueError:
+        raise CodecError('Malformed class name: {0}'.format(name))
+    for old_prefix, new_prefix in MODULE_RENAMES:
+        if module_name.startswith(old_prefix):
+            module_name = new_prefix + module_name[len(old_prefix):]
+    if not module_name.startswith(TRUSTED_MODULE_PREFIXES):
+        raise CodecError('Untrusted class: {0}'.format(name))
+    try:
+        cls = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError):
+        raise CodecError('Class not found: {0}'.format(name))
+    if not isinstance(cls, type):
+        raise CodecError('Not a class: {0}'.format(name))
+    return cls
+
+
+class _Encoder(object):
+    def __init__(self):
+        # The classes of the objects we encoded, and their named tuple fields
+        self.classes = []
+        self._class_idx = {}
+        # The attribute name lists of the object states we encoded
+        self.shapes = []
+        self._shape_idx = {}
+        # Maps ids of objects we already encoded to their encoded form, we
+        # keep a reference to the objects themselves to make sure the ids
+        # remain valid while we're encoding
+        self._memo = {}
+        # Maps the values of immutable objects to their encoded form so that
+        # equal objects only get stored once
+        self._values = {}
+        # Maps reference numbers to the encoded objects they refer to
+        self._refs = {}
+
+    def encode(self, obj):
+        if obj is None or type(obj) in _SCALAR_TYPES:
+            return obj
+        if type(obj) is binary_type:
+            return dict(B=b64encode(obj).decode('ascii'))
+        if type(obj) is list:
+            return [self.encode(item) for item in obj]
+        if type(obj) is tuple:
+            return dict(T=[self.encode(item) for item in obj])
+        if type(obj) is set:
+            return dict(S=[self.encode(item) for item in obj])
+        if type(obj) is frozenset:
+            return dict(F=[self.encode(item) for item in obj])
+        if type(obj) is deque:
+            return dict(
+                Q=[self.encode(item) for item in obj], m=obj.maxlen
+            )
+        if type(obj) is dict:
+            return dict(D=[
+                [self.encode(key), self.encode(value)]
+                for key, value in iteritems(obj)
+            ])
+        return self._encode_instance(obj)
+
+    def _ref(self, encoded):
+        if '#' not in encoded:
+            encoded['#'] = len(self._refs) + 1
+            self._refs[encoded['#']] = encoded
+        return dict(R=encoded['#'])
+
+    def _value_key(self, class_idx, items, encoded_items):
+        """Make a key that identifies the value of a tuple instance, or
+        return None if the tuple contains mutable data
+
+        Instances within the tuple are identified by their encoded form,
+        which is shared between all equal instances
+        """
+        key = [class_idx]
+        for item, encoded_item in zip(items, encoded_items):
+            if item is None or type(item) in _SCALAR_TYPES:
+                key.append((type(item), item))
+            elif type(encoded_item) is dict and 'O' in encoded_item:
+                key.append(id(encoded_item))
+            elif type(encoded_item) is dict and 'R' in encoded_item:
+                key.append(id(self._refs[encoded_item['R']]))
+            else:
+                return None
+        return tuple(key)
+
+    def _encode_class(self, cls):
+        try:
+            return self._class_idx[cls]
+        except KeyError:
+            pass
+        name = _class_name(cls)
+        if not name.startswith(TRUSTED_MODULE_PREFIXES):
+            raise CodecError('Cannot encode object of class {0}'.format(name))
+        fields = list(cls._fields) \
+            if issubclass(cls, tuple) and hasattr(cls, '_fields') else None
+        self._class_idx[cls] = len(self.classes)
+        self.classes.append([name, fields])
+        return self._class_idx[cls]
+
+    def _encode_state(self, encoded, state):
+        """Encode the state of an object. States that are dicts with string
+        keys are encoded as an index to the shapes table, which holds their
+        keys, followed by their values
+        """
+        if type(state) is dict and \
+                all(type(key) in (str, text_type) for key in state):
+            shape = tuple(state)
+            try:
+                shape_idx = self._shape_idx[shape]
+            except KeyError:
+                shape_idx = self._shape_idx[shape] = len(self.shapes)
+                self.shapes.append(shape)
+            encoded['a'] = [shape_idx]
+            encoded['a'].extend(self.encode(state[key]) for key in shape)
+        else:
+            encoded['s'] = self.encode(state)
+
+    def _encode_instance(self, obj):
+        cls = type(obj)
+        memo = self._memo.get(id(obj))
+        if memo is not None:
+            return self._ref(memo[1])
+        class_idx = self._encode_class(cls)
+        encoded = dict(O=class_idx)
+        self._memo[id(obj)] = (obj, encoded)
+        # We check the class rather then the object and use
+        # object.__getattribute__ to avoid the attribute lookup hooks some
+        # of our classes have
+        is_sequence = issubclass(cls, (tuple, list))
+        if is_sequence:
+            encoded['i'] = [self.encode(item) for item in obj]
+        getstate = getattr(cls, '__getstate__', None)
+        if getstate is not None and \
+                getstate is not getattr(object, '__getstate__', None):
+            self._encode_state(encoded, getstate(obj))
+        else:
+            try:
+                obj_dict = object.__getattribute__(obj, '__dict__')
+            except AttributeError:
+                if not is_sequence:
+                    raise CodecError(
+                        'Cannot encode state of {0}'.format(_class_name(cls))
+                    )
+            else:
+                if obj_dict:
+                    self._encode_state(encoded, obj_dict)
+        if issubclass(cls, tuple) and 's' not in encoded and \
+                'a' not in encoded:
+            value_key = self._value_key(class_idx, obj, encoded['i'])
+            if value_key is not None:
+                stored = self._values.setdefault(value_key, encoded)
+                if stored is not encoded:
+                    self._memo[id(obj)] = (obj, stored)
+                    return self._ref(stored)
+        return encoded
+
+
+class _Decoder(object):
+    def __init__(self, classes, shapes):
+        self._shapes = shapes
+        self._classes = [None] * len(classes)
+        self._class_specs = classes
+        self._refs = {}
+
+    def decode(self, data):
+        if isinstance(data, list):
+            return [self.decode(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        if 'O' in data:
+            return self._decode_instance(data)
+        if 'R' in data:
+            try:
+                return self._refs[data['R']]
+            except KeyError:
+                raise CodecError('Unknown reference: {0}'.format(data['R']))
+        if 'T' in data:
+            return tuple(self.decode(item) for item in data['T'])
+        if 'S' in data:
+            return set(self.decode(item) for item in data['S'])
+        if 'F' in data:
+            return frozenset(self.decode(item) for item in data['F'])
+        if 'Q' in data:
+            return deque(
+                (self.decode(item) for item in data['Q']), data.get('m')
+            )
+        if 'D' in data:
+            return dict(
+                (self.decode(key), self.decode(value))
+                for key, value in data['D']
+            )
+        if 'B' in data:
+            return b64decode(data['B'].encode('ascii'))
+        raise CodecError('Malformed encoded object')
+
+    def _decode_class(self, class_idx):
+        """Find the class with the given index in the class table, and a
+        mapping from the stored named tuple fields to its current fields
+        """
+        if self._classes[class_idx] is None:
+            name, fields = self._class_specs[class_idx]
+            cls = _trusted_class(name)
+            field_map = None
+            if fields is not None and list(cls._fields) != fields:
+                # We look up fields by name so objects that were encoded
+                # before fields were added to their class can still be decoded
+                field_pos = dict((field, i) for i, field in enumerate(fields))
+                field_map = [field_pos.get(field) for field in cls._fields]
+            self._classes[class_idx] = (cls, field_map)
+        return self._classes[class_idx]
+
+    def _decode_state(self, data):
+        if 's' in data:
+            return self.decode(data['s'])
+        try:
+            shape = self._shapes[data['a'][0]]
+        except (IndexError, TypeError):
+            raise CodecError('Malformed object state: {0}'.format(data))
+        return dict(zip(shape, (self.decode(v) for v in data['a'][1:])))
+
+    def _decode_instance(self, data):
+        try:
+            cls, field_map = self._decode_class(data['O'])
+        except (IndexError, TypeError, ValueError):
+            raise CodecError('Malformed class reference: {0}'.format(data))
+        if issubclass(cls, tuple):
+            items = [self.decode(item) for item in data.get('i', ())]
+            if field_map is not None:
+                items = [
+                    None if pos is None else items[pos] for pos in field_map
+                ]
+            obj = tuple.__new__(cls, items)
+        elif issubclass(cls, list):
+            obj = list.__new__(cls)
+        else:
+            obj = object.__new__(cls)
+        if '#' in data:
+            self._refs[data['#']] = obj
+        if 'i' in data and issubclass(cls, list):
+            list.extend(obj, (self.decode(item) for item in data['i']))
+        if 'a' in data or 's' in data:
+            state = self._decode_state(data)
+            setstate = getattr(cls, '__setstate__', None)
+            if setstate is not None:
+                setstate(obj, state)
+            else:
+                object.__getattribute__(obj, '__dict__').update(state)
+        return obj
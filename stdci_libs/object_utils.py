@@ -4,7 +4,159 @@ classes
 """
 import operator
 
+from six import add_metaclass
 
+# Marks attributes that are not defined in a class
+_missing = object()
+
+
+class _opt_attr(object):
+    """A descriptor that implements attribute defaults and casts for a single
+    attribute. Instances are created by _opt_attrs_meta when classes are
+    created, so that reading the attribute does not require looking up the
+    default and cast methods by name.
+    """
+    __slots__ = [
+        'name', 'underlying', 'underlying_is_data', 'default_name',
+        'cast_name', 'cast_defaults', 'has_dict', 'is_proxy',
+    ]
+
+    def __init__(
+        self, name, underlying, default_name, cast_name, cast_defaults,
+        has_dict, is_proxy,
+    ):
+        self.name = name
+        self.underlying = underlying
+        self.underlying_is_data = (
+            hasattr(type(underlying), '__set__') or
+            hasattr(type(underlying), '__delete__')
+        )
+        self.default_name = default_name
+        self.cast_name = cast_name
+        self.cast_defaults = cast_defaults
+        self.has_dict = has_dict
+        self.is_proxy = is_proxy
+
+    def _get_underlying(self, obj, objtype):
+        getter = getattr(type(self.underlying), '__get__', None)
+        if getter is None:
+            return self.underlying
+        return getter(self.underlying, obj, objtype)
+
+    def _get_raw(self, obj, objtype):
+        # Mimic the lookup order of object.__getattribute__, falling back to
+        # the proxied object if there is one
+        if self.underlying_is_data:
+            return self._get_underlying(obj, objtype)
+        if self.has_dict:
+            try:
+                return obj.__dict__[self.name]
+            except KeyError:
+                pass
+        if self.underlying is not _missing:
+            return self._get_underlying(obj, objtype)
+        if self.is_proxy:
+            return getattr(object.__getattribute__(obj, '_obj'), self.name)
+        raise AttributeError("'{0}' object has no attribute '{1}'".format(
+            type(obj).__name__, self.name
+        ))
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            if self.underlying is _missing:
+                raise AttributeError(self.name)
+            return self._get_underlying(None, objtype)
+        try:
+            value = self._get_raw(obj, objtype)
+        except AttributeError:
+            if self.default_name is None:
+                raise
+            value = getattr(obj, self.default_name)
+            if not self.cast_defaults:
+                return value
+        if self.cast_name is None:
+            return value
+        return getattr(obj, self.cast_name)(value)
+
+    def __set__(self, obj, value):
+        if self.underlying_is_data:
+            self.underlying.__set__(obj, value)
+        elif self.is_proxy and self.underlying is _missing:
+            setattr(object.__getattribute__(obj, '_obj'), self.name, value)
+        else:
+            obj.__dict__[self.name] = value
+
+    def __delete__(self, obj):
+        if self.underlying_is_data:
+            self.underlying.__delete__(obj)
+        elif self.is_proxy and self.underlying is _missing:
+            delattr(object.__getattribute__(obj, '_obj'), self.name)
+        else:
+            try:
+                del obj.__dict__[self.name]
+            except KeyError:
+                raise AttributeError(self.name)
+
+
+class _opt_attrs_meta(type):
+    """Metaclass for object_with_defaults and object_with_cast_attrs
+
+    When a class is created, an _opt_attr descriptor is placed in it for
+    every attribute that has a default value or a cast method, so those are
+    only looked up by name once per class rather then on every attribute
+    access.
+    """
+    def __init__(cls, name, bases, namespace):
+        super(_opt_attrs_meta, cls).__init__(name, bases, namespace)
+        defaults = {}
+        casts = {}
+        for attr in dir(cls):
+            if attr.startswith('default_'):
+                defaults[attr[len('default_'):]] = attr
+            elif attr.startswith('_default_'):
+                defaults['_' + attr[len('_default_'):]] = attr
+            elif attr.startswith('_cast_'):
+                casts[attr[len('_cast_'):]] = attr
+        for attr in list(defaults):
+            if attr.lstrip('_').startswith('default_'):
+                # Defaults do not have defaults of their own
+                del defaults[attr]
+        if not defaults and not casts:
+            # This is always the case for the mixin classes themselves, so
+            # we do not get here before they are defined
+            return
+        with_defaults = issubclass(cls, object_with_defaults)
+        with_casts = issubclass(cls, object_with_cast_attrs)
+        if not with_defaults:
+            defaults = {}
+        if not with_casts:
+            casts = {}
+        # Defaults are only cast if the casting mixin comes before the
+        # defaults mixin, since otherwise the defaults mixin would provide
+        # the value after the casting mixin was done
+        cast_defaults = with_defaults and with_casts and (
+            cls.__mro__.index(object_with_cast_attrs) <
+            cls.__mro__.index(object_with_defaults)
+        )
+        has_dict = cls.__dictoffset__ != 0
+        is_proxy = issubclass(cls, object_proxy)
+        for attr in set(defaults) | set(casts):
+            setattr(cls, attr, _opt_attr(
+                attr, cls._find_underlying_attr(attr), defaults.get(attr),
+                casts.get(attr), cast_defaults, has_dict, is_proxy,
+            ))
+
+    def _find_underlying_attr(cls, name):
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                attr = klass.__dict__[name]
+                if isinstance(attr, _opt_attr):
+                    return attr.underlying
+                return attr
+        return _missing
+
+
+@add_metaclass(_opt_attrs_meta)
 class object_with_defaults(object):
     """A class that allows setting default values for attributes so that those
     attributes appear to be available on instances even if they are not
@@ -13,27 +165,40 @@ class object_with_defaults(object):
     To define a default value for an attribute 'attr' one must simply define
     the attribute 'default_attr'. For attributes with a leading underscore such
     as '_attr' the default must have a leading underscore as well e.g.
-    '_default_attr'.    """
+    '_default_attr'.
+
+    Defaults that are defined in the class are resolved by descriptors that
+    are placed in the class when it is created. Defaults that are set on
+    instances are resolved by __getattr__.
+    """
     def __getattr__(self, name):
+        try:
+            # Let proxies find the attribute in the proxied object first
+            return super(object_with_defaults, self).__getattr__(name)
+        except AttributeError:
+            pass
         if name.startswith('_'):
             name_no_unders = name[1:]
             unders = '_'
         else:
             unders = ''
             name_no_unders = name
-        if name_no_unders.startswith('default_'):
-            # Fall back on superclass behaviour for defaults to prevent
+        if not name_no_unders.startswith('default_'):
+            # Defaults do not have defaults of their own, this also prevents
             # infinite recursion
-            return super(object_with_defaults, self).__getattribute__(name)
-        default_name = unders + 'default_' + name_no_unders
-        try:
-            return getattr(self, default_name)
-        except AttributeError:
-            # If retrieving the default attribute fails, simulate failure on
-            # accessing the originally requested attribute
-            return super(object_with_defaults, self).__getattribute__(name)
+            default_name = unders + 'default_' + name_no_unders
+            try:
+                return getattr(self, default_name)
+            except AttributeError:
+                pass
+        # If retrieving the default attribute fails, simulate failure on
+        # accessing the originally requested attribute
+        raise AttributeError("'{0}' object has no attribute '{1}'".format(
+            type(self).__name__, name
+        ))
 
 
+@add_metaclass(_opt_attrs_meta)
 class object_with_cast_attrs(object):
     """A class that allows intercepting of attribute value fetches and
     manipulating the value before it reaches the requester. This is useful when
@@ -42,17 +207,10 @@ class object_with_cast_attrs(object):
     To intercept access to attribute 'attr', define a method called
     '_cast_attr' that accepts the value returned from the attribute and returns
     the manipulated value.
+
+    Cast methods are found when the class is created, and descriptors are
+    placed in it for the attributes they cast.
     """
-    def __getattribute__(self, name):
-        try:
-            value = super(object_with_cast_attrs, self).__getattribute__(name)
-        except AttributeError:
-            value = super(object_with_cast_attrs, self).__getattr__(name)
-        try:
-            cast_method = getattr(self, '_cast_' + name)
-        except AttributeError:
-            return value
-        return cast_method(value)
 
 
 class object_witp_opt_attrs(object_with_cast_attrs, object_with_defaults):
@@ -72,11 +230,9 @@ class object_proxy(object):
         object.__setattr__(self, "_obj", obj)
 
     # proxying (special cases)
-    def __getattribute__(self, name):
-        try:
-            return super(object_proxy, self).__getattribute__(name)
-        except AttributeError:
-            return getattr(object.__getattribute__(self, "_obj"), name)
+    def __getattr__(self, name):
+        # Only called when the attribute is not found on the proxy itself
+        return getattr(object.__getattribute__(self, "_obj"), name)
 
     def __delattr__(self, name):
         delattr(object.__getattribute__(self, "_obj"), name)
@@ -148,7 +304,9 @@ class object_proxy(object):
         for name in cls._special_names:
             if hasattr(theclass, name):
                 ns[name] = make_method(name)
-        return type("%s(%s)" % (cls.__name__, theclass.__name__), (cls,), ns)
+        return type(cls)(
+            "%s(%s)" % (cls.__name__, theclass.__name__), (cls,), ns
+        )
 
     def __new__(cls, obj, *args, **kwargs):
         """
@@ -5,21 +5,29 @@ from __future__ import absolute_import, print_function
 import argparse
 import sys
 import os
+import stat
 from os.path import normpath, join, dirname, abspath
 import logging
 import logging.handlers
 import yaml
 import fnmatch
+import errno
+import fcntl
+import re
+import shutil
+import signal
+from tempfile import mkstemp
 from copy import copy
 from hashlib import sha1, md5
 from xdg.BaseDirectory import xdg_cache_home
-from time import time
+from time import time, sleep
+from threading import Lock, Timer
 from socket import gethostbyname, gethostname
 from subprocess import Popen, CalledProcessError, STDOUT, PIPE
 from six import string_types, iteritems, viewkeys, itervalues
 from six.moves import zip, reduce
 from collections import Iterable, Mapping, Set, namedtuple, OrderedDict
-from itertools import chain, tee
+from itertools import chain, tee, count
 from traceback import format_exception
 from textwrap import dedent
 from pprint import pformat
@@ -80,6 +88,42 @@ UPSTREAM_SOURCES_FILES = (
     'automation/upstream_sources.yaml',
 )
 CACHE_NAME = 'usrc'
+# File inside a source's cache dir where we keep the remote refs we've seen
+REMOTE_REFS_CACHE_FILE = 'usrc-remote-refs.yaml'
+# Ways to materialize upstream files into the workspace
+MATERIALIZE_MODES = ('checkout', 'hardlink', 'reflink')
+BLOB_STORE_NAME = 'blobs'
+BLOB_STORE_SAVINGS_FILE = 'savings.yaml'
+# The Linux ioctl request for cloning a file (from linux/fs.h)
+FICLONE = 0x40049409
+# Network operations settings
+DEFAULT_NETWORK_RETRIES = 2
+NETWORK_RETRY_BACKOFF = 5
+# How long to wait for git to exit after we asked it to terminate
+GIT_KILL_GRACE = 10
+# File inside a source's cache dir where we record network operation timings
+TIMINGS_FILE = 'usrc-timings.yaml'
+MAX_TIMING_RECORDS = 1000
+# File under the usrc cache where we track the health of upstream URLs
+URL_HEALTH_FILE = 'url-health.yaml'
+# The weight given to the latest fetch duration when averaging URL latency
+URL_LATENCY_WEIGHT = 0.3
+# Seconds to avoid a URL after it failed, doubled for each consecutive failure
+URL_FAILURE_COOLDOWN = 300
+MAX_URL_FAILURE_COOLDOWN = 24 * 60 * 60
+# Git error messages that indicate failures that may go away if we retry
+TRANSIENT_GIT_ERRORS = re.compile('|'.join((
+    r'Could not resolve host',
+    r'Connection (timed out|reset|refused)',
+    r'Operation timed out',
+    r'The remote end hung up unexpectedly',
+    r'early EOF',
+    r'RPC failed',
+    r'returned error: 5\d\d',
+    r'ssh_exchange_identification',
+    r'kex_exchange_identification',
+    r'Temporary failure in name resolution',
+)))
 POLICIES = ('static', 'tagged', 'latest')
 TagObject = namedtuple('TagObject', ['commit', 'annotated', 'name'])
 # UpstreamSourcesConfigPath allows us to keep track of configs and where
@@ -237,6 +281,7 @@ def parse_args():
             ' to connect to the remote SCM servers and push changes.'
         ),
     )
+    add_network_args(get_parser)
     update_parser = subparsers.add_parser(
         'update', help='Update upstream source versions',
         description=(
@@ -255,6 +300,7 @@ def parse_args():
             ' overwritten if it already exists'
         )
     )
+    add_network_args(update_parser)
     modify_entries_parser = subparsers.add_parser(
         'modify-entries',
         help='Update or create new upstream source entries',
@@ -310,6 +356,31 @@ def parse_args():
     return parser.parse_args()
 
 
+def add_network_args(parser):
+    """Add command line arguments for controlling network operations
+
+    :param ArgumentParser parser: An argument parser to add the parameters to
+    """
+    parser.add_argument(
+        '--timeout', type=float, default=None,
+        help=(
+            'Seconds to wait for each network operation, such as fetching an'
+            ' upstream source, before cancelling it. Applies to sources that'
+            ' do not specify their own timeout. By default there is no'
+            ' timeout.'
+        ),
+    )
+    parser.add_argument(
+        '--retries', type=int, default=None,
+        help=(
+            'How many times to retry network operations that fail due to'
+            ' transient errors, such as time outs or dropped connections.'
+            ' Applies to sources that do not specify their own retries.'
+            ' Defaults to {0}.'.format(DEFAULT_NETWORK_RETRIES)
+        ),
+    )
+
+
 def add_logging_args(parser):
     """Add logging-related command line argumenets
 
@@ -369,7 +440,7 @@ def setup_console_logging(args, logger=None):
 
 
 def get_main(args):
-    get_upstream_sources(args.push_map)
+    get_upstream_sources(args.push_map, args.timeout, args.retries)
 
 
 def update_main_cli(args):
@@ -377,7 +448,7 @@ def update_main_cli(args):
 
     :param argparse.Namespace args: Argument parsing results.
     """
-    update_main(args.commit)
+    update_main(args.commit, args.timeout, args.retries)
 
 
 class HookCaller(object):
@@ -457,13 +528,17 @@ class HookCaller(object):
         return None
 
 
-def update_main(commit=False):
+def update_main(commit=False, timeout=None, retries=None):
     """Update upstream source references in the config file
 
-    :param bool commit: if set to True, the updated config file will
-                        be committed.
+    :param bool commit:   if set to True, the updated config file will
+                          be committed.
+    :param float timeout: (Optional) Default timeout in seconds for network
+                          operations
+    :param int retries:   (Optional) Default amount of retries for network
+                          operations that fail due to transient errors
     """
-    updates, config_path = update_upstream_sources()
+    updates, config_path = update_upstream_sources(timeout, retries)
     hook_caller = HookCaller(config_path)
     hook_caller(POST_UPDATE_HOOK)
     if commit:
@@ -561,14 +636,22 @@ class GitUpstreamSource(object):
     :params : update_policy - the latest or tagged policy to be updated.
     :params : tag_filter - used to filter to specific tags you like.
     :params : annotated_tag_only - used to pick only annotated tags.
+    :params : timeout - seconds to wait for each network operation.
+    :params : retries - how many times to retry transient network failures.
+    :params : mirrors - alternate URLs to fetch the source from. The cache is
+                        still keyed by `url`.
     """
 
     _dest_fmt_default = {'files': None}
+    # Network settings for sources that do not specify their own, these can be
+    # overridden per instance with set_network_defaults()
+    default_timeout = None
+    default_retries = DEFAULT_NETWORK_RETRIES
 
     def __init__(
         self, url, branch, commit, automerge='no', dest_formats=None,
         files_dest_dir='', update_policy=None, tag_filter=None,
-        annotated_tag_only=None
+        annotated_tag_only=None, timeout=None, retries=None, mirrors=None
     ):
         self.url, self.branch, self.commit = url, branch, commit
         self.dest_formats = dest_formats or self._dest_fmt_default
@@ -600,6 +683,10 @@ class GitUpstreamSource(object):
                 self.automerge = 'no'
         else:
             self.automerge = 'yes' if automerge else 'no'
+        self.timeout, self.retries = timeout, retries
+        if isinstance(mirrors, string_types):
+            mirrors = [mirrors]
+        self.mirrors = list(mirrors or [])
         cache_dir_name = sha1(url.encode('utf-8')).hexdigest()
         cache_dir = os.path.join(xdg_cache_home, CACHE_NAME, cache_dir_name)
         self._cache_dir = cache_dir
@@ -608,8 +695,8 @@ class GitUpstreamSource(object):
             'blocks': pformat(self.to_yaml_struct())
         })
 
-    def _cache_git(self, *args):
-        return git('--git-dir=' + self._cache_git_dir, *args)
+    def _cache_git(self, *args, **kwargs):
+        return git('--git-dir=' + self._cache_git_dir, *args, **kwargs)
 
     def _init_cache(self):
         git('init', self._cache_dir)
@@ -630,6 +717,9 @@ class GitUpstreamSource(object):
             struct.get('update_policy', ('latest')),
             struct.get('tag_filter', None),
             struct.get('annotated_tag_only', 'no'),
+            struct.get('timeout', None),
+            struct.get('retries', None),
+            struct.get('mirrors', None),
         )
 
     def to_yaml_struct(self):
@@ -651,10 +741,115 @@ class GitUpstreamSource(object):
             struct['tag_filter'] = self.tag_filter
         if self.annotated_tag_only:
             struct['annotated_tag_only'] = 'yes'
+        if self.timeout is not None:
+            struct['timeout'] = self.timeout
+        if self.retries is not None:
+            struct['retries'] = self.retries
+        if self.mirrors:
+            struct['mirrors'] = list(self.mirrors)
         return struct
 
+    def set_network_defaults(self, timeout=None, retries=None):
+        """Set network settings for when the source does not specify its own
+
+        Unlike the `timeout` and `retries` attributes, these are not saved
+        into the upstream sources config.
+
+        :param float timeout: (Optional) Seconds to wait for each network
+                              operation
+        :param int retries:   (Optional) How many times to retry network
+                              operations that fail due to transient errors
+        """
+        if timeout is not None:
+            self.default_timeout = timeout
+        if retries is not None:
+            self.default_retries = retries
+
+    def _network_op(self, operation, func, url=None, retries=None):
+        """Run a network operation with the source's network settings
+
+        The operation is cancelled if it takes longer than the timeout, and
+        is retried if it fails due to a transient error. The time it took is
+        recorded in the source's cache dir.
+
+        :param str operation:   A name for the operation
+        :param callable func:   A function that does the operation. It is
+                                passed the timeout in seconds for each
+                                attempt, or None for no timeout.
+        :param str url:         (Optional) The URL the operation talks to if
+                                it is not the source's URL
+        :param int retries:     (Optional) Override the source's retries
+
+        :returns: Whatever `func` returns
+        """
+        url = url or self.url
+        timeout = self.default_timeout if self.timeout is None \
+            else self.timeout
+        if retries is None:
+            retries = self.default_retries if self.retries is None \
+                else self.retries
+        attempts = []
+
+        def attempt():
+            attempts.append(time())
+            return func(timeout)
+
+        start, status = time(), 'failed'
+        try:
+            out = retry_transient(
+                attempt, retries, '{0} of {1}'.format(operation, url)
+            )
+            status = 'ok'
+            return out
+        except GitTimeoutError:
+            status = 'timeout'
+            raise
+        finally:
+            self._record_timing(
+                operation, url, time() - start, len(attempts), status
+            )
+
+    def _record_timing(self, operation, url, seconds, attempts, status):
+        """Record how long a network operation took in the cache dir
+
+        Records are appended to a YAML list, which is trimmed once it grows
+        over MAX_TIMING_RECORDS records.
+
+        :param str operation: The name of the operation
+        :param str url:       The URL the operation talked to
+        :param float seconds: How many seconds the operation took
+        :param int attempts:  How many times was the operation attempted
+        :param str status:    How the operation ended
+        """
+        logger.info(
+            "%s of '%s' took %.2f seconds (%d attempts, %s)",
+            operation, url, seconds, attempts, status
+        )
+        try:
+            os.makedirs(self._cache_dir)
+        except OSError as os_error:
+            if os_error.errno != errno.EEXIST:
+                raise
+        timings_file = os.path.join(self._cache_dir, TIMINGS_FILE)
+        record = dict(
+            operation=operation, url=url, branch=self.branch,
+            seconds=round(seconds, 3), attempts=attempts, status=status,
+            timestamp=time(),
+        )
+        with open(timings_file, 'a+') as stream:
+            stream.write(yaml.safe_dump(
+                [record], default_flow_style=None, width=4096
+            ))
+            stream.seek(0)
+            records = stream.readlines()
+        if len(records) > MAX_TIMING_RECORDS:
+            write_file_atomically(
+                timings_file, ''.join(records[-(MAX_TIMING_RECORDS // 2):])
+            )
+
     def _files_format_handler(
-        self, dst_path, files_dest_dir=None, filter=None, **kwargs
+        self, dst_path, files_dest_dir=None, filter=None, materialize=None,
+        **kwargs
     ):
         """Get the upstream source files into the given path
 
@@ -670,10 +865,22 @@ class GitUpstreamSource(object):
                                   are given in a list, the patterns are OR-ed,
                                   this means that a file needs to match only
                                   one of the patterns to be included.
+        :param str materialize    How to place the files in dst_path. The
+                                  default, 'checkout', writes a fresh copy of
+                                  every file. 'hardlink' and 'reflink' extract
+                                  the files once into a node-local BlobStore
+                                  and link them from there.
 
         The OR behaviour of patterns lists is meant to allow using simple lists
         of file names if users need the kind of granularity.
         """
+        materialize = materialize or 'checkout'
+        if materialize not in MATERIALIZE_MODES:
+            raise ConfigError(
+                "Unknown materialize mode '{0}', should be one of: {1}".format(
+                    materialize, ', '.join(MATERIALIZE_MODES)
+                )
+            )
         dst_dir = files_dest_dir or self.files_dest_dir
         if dst_dir != '':
             dst_path = os.path.join(dst_path, dst_dir)
@@ -681,6 +888,23 @@ class GitUpstreamSource(object):
                 os.makedirs(dst_path)
             except OSError:
                 pass
+        if materialize != 'checkout':
+            files = git_ls_files(self.commit, git_func=self._cache_git)
+            if filter:
+                if isinstance(filter, string_types) \
+                        or not isinstance(filter, Iterable):
+                    filter = [filter]
+                files = dict(
+                    (path, files[path]) for path in set(chain.from_iterable(
+                        fnmatch.filter(files, str(subfil)) for subfil in filter
+                    ))
+                )
+            blob_store = BlobStore()
+            stats = blob_store.materialize(
+                self._cache_git_dir, files, dst_path, materialize
+            )
+            blob_store.record_savings(stats, self.url, self.commit)
+            return
         if filter:
             if isinstance(filter, string_types):
                 paths = ['--'] + fnmatch.filter(self.ls_files(), str(filter))
@@ -700,12 +924,16 @@ class GitUpstreamSource(object):
         )
 
     @only_if_imported_any('pusher', 'stdci_tools.pusher')
-    def _branch_format_handler(self, push_map, **kwargs):
+    def _branch_format_handler(self, push_map, branch_pusher=None, **kwargs):
         """Get the upstream source to branch
 
         :param str push_map: The path to a file containing information
                              about remote SCM servers that is needed to
                              push changes to them.
+        :param BranchPusher branch_pusher: (Optional) A BranchPusher object
+                                           to queue the push in. If not
+                                           specified, the push is done
+                                           immediately.
         :param str push_url: Choose a push url to use from the push_map.
         :param bool gen_source_repos: If set to True, after pushed sources to
                                       a remote branch, propogate the call to
@@ -714,12 +942,16 @@ class GitUpstreamSource(object):
         dst_branch = '_upstream_' + self.branch + '_' + self.commit[0:7]
         push_details = read_push_details(push_map, kwargs.get('push_url'))
         logger.info("Would push to: '%s'", push_details.push_url)
-        if push_details.host_key:
-            add_key_to_known_hosts(push_details.host_key)
-        self._cache_git(
-            'push', push_details.push_url,
-            '{0}:refs/heads/{1}'.format(self.commit, dst_branch)
-        )
+        if branch_pusher is None:
+            single_pusher = BranchPusher()
+            single_pusher.add(
+                push_details, self._cache_git_dir, self.commit, dst_branch
+            )
+            single_pusher.push()
+        else:
+            branch_pusher.add(
+                push_details, self._cache_git_dir, self.commit, dst_branch
+            )
         if kwargs.get('gen_source_repos'):
             self._source_repos_format_handler(push_map, **kwargs)
 
@@ -786,20 +1018,24 @@ class GitUpstreamSource(object):
             file_path=file_path, root_path=root_path
         ))
 
-    def get(self, dst_path, push_map):
+    def get(self, dst_path, push_map, branch_pusher=None):
         """Fetch the upstream source and call to the formatters
 
         :param str dst_path: The path to get source into
         :param str push_map: The path to a file containing information about
                              remote SCM servers that is needed to push changes
                              to them.
+        :param BranchPusher branch_pusher: (Optional) A BranchPusher object
+                                           to queue pushes to remote branches
+                                           in, instead of pushing them
+                                           immediately.
         """
         # TODO: check if git_commit is already available locally and skip
         #       fetching
         self._fetch()
-        self._call_format_handlers(dst_path, push_map)
+        self._call_format_handlers(dst_path, push_map, branch_pusher)
 
-    def _call_format_handlers(self, dst_path, push_map):
+    def _call_format_handlers(self, dst_path, push_map, branch_pusher=None):
         """Call all the format handlers as the user specified in the config
 
         Each format handler get's all the params so it is expected to accept
@@ -811,12 +1047,17 @@ class GitUpstreamSource(object):
         :param str push_map: The path to a file containing information about
                              remote SCM servers that is needed to push changes
                              to them.
+        :param BranchPusher branch_pusher: (Optional) A BranchPusher object
+                                           to pass to the handlers.
         """
+        common_params = dict(dst_path=dst_path, push_map=push_map)
+        if branch_pusher is not None:
+            common_params['branch_pusher'] = branch_pusher
         for handler_name, handler_params in iteritems(self.dest_formats):
             params = handler_params or {}  # avoid edge case
             formatter = '_{fmt}_format_handler'.format(fmt=handler_name)
             handler = getattr(self, formatter)
-            handler(dst_path=dst_path, push_map=push_map, **params)
+            handler(**dict(common_params, **params))
 
     def _validate_dst_fmt_exists(self):
         """Validate that all the requested dest formatters exists. If there is a
@@ -832,7 +1073,7 @@ class GitUpstreamSource(object):
             "Unknown destination formatters {missing}.".format(
                 missing=missing_formatters))
 
-    def updated(self):
+    def updated(self, remote_refs=None):
         """Look for the most up-to-date commit or tag of the upstream source
            depending on the user request.
 
@@ -844,12 +1085,47 @@ class GitUpstreamSource(object):
                         can follow tags of a specified glob pattern.
             - 'static': disable auto update.
 
+        :param dict remote_refs: (Optional) A mapping of refs to SHAs that are
+                                 currently found in the upstream repository,
+                                 as returned by `ls_remote`. If given, the refs
+                                 relevant to this source are compared to the
+                                 ones seen when it was last checked, and if
+                                 none of them had moved, the result of the last
+                                 check is reused without fetching anything.
+
         :returns: A new GitUpstreamSource instance representing the updated
             source. If self is already pointing to the most updated commit
             or tag, returns self
         :rtype: GitUpstreamSource
         """
-        self._fetch()
+        if remote_refs is None:
+            latest_commit = self._latest_commit()
+        else:
+            latest_commit = self._prechecked_latest_commit(remote_refs)
+        if latest_commit == self.commit:
+            return self
+        updated = self.__class__(
+            self.url, self.branch, latest_commit, self.automerge,
+            self.dest_formats, self.files_dest_dir, self.update_policy,
+            self.tag_filter, self.annotated_tag_only, self.timeout,
+            self.retries, self.mirrors
+        )
+        updated.set_network_defaults(
+            self.default_timeout, self.default_retries
+        )
+        return updated
+
+    def _latest_commit(self, required_commits=None):
+        """Fetch the upstream source and apply the update policies to it
+
+        :param Iterable required_commits: (Optional) Commits we know exist
+                                          upstream, passed to `_fetch`
+
+        :rtype: str
+        :returns: The commit the source should be updated to, or the current
+                  commit if there is nothing to update
+        """
+        self._fetch(required_commits)
         for policy in POLICIES:
             if policy not in self.update_policy:
                 continue
@@ -859,12 +1135,131 @@ class GitUpstreamSource(object):
                     "Latest {0} commit updated for branch {1} in repo"
                     "{2}".format(policy, self.branch, self.url)
                 )
-                return self.__class__(
-                    self.url, self.branch, latest_commit, self.automerge,
-                    self.dest_formats, self.files_dest_dir, self.update_policy,
-                    self.tag_filter, self.annotated_tag_only
-                )
-        return self
+                return latest_commit
+        return self.commit
+
+    def _prechecked_latest_commit(self, remote_refs):
+        """Like `_latest_commit` but skip fetching if the upstream refs that
+        are relevant to this source did not change since we last checked it
+
+        :param dict remote_refs: A mapping of refs to SHAs that are currently
+                                 found in the upstream repository
+
+        :rtype: str
+        :returns: The commit the source should be updated to, or the current
+                  commit if there is nothing to update
+        """
+        relevant_refs = self._relevant_remote_refs(remote_refs)
+        check_key = self._update_check_key()
+        refs_cache = self._load_remote_refs_cache()
+        last_check = refs_cache.setdefault('checks', {}).get(check_key)
+        if last_check and last_check.get('commit') == self.commit and \
+                last_check.get('refs') == relevant_refs:
+            logger.info(
+                "Upstream refs of branch %s in repo %s did not change since"
+                " %s, skipping fetch", self.branch, self.url,
+                last_check.get('timestamp')
+            )
+            return last_check['latest_commit']
+        branch_tip = relevant_refs.get('refs/heads/' + self.branch)
+        latest_commit = self._latest_commit(
+            [self.commit, branch_tip] if branch_tip else None
+        )
+        refs_cache = self._load_remote_refs_cache()
+        # The check replaces the one made for an earlier commit of the source,
+        # so the cache does not grow as the source gets updated
+        refs_cache.setdefault('checks', {})[check_key] = dict(
+            commit=self.commit, refs=relevant_refs,
+            latest_commit=latest_commit, timestamp=time(),
+        )
+        self._save_remote_refs_cache(refs_cache)
+        return latest_commit
+
+    def _ls_remote_patterns(self):
+        """Get the patterns of upstream refs the update policies look at
+
+        :rtype: list
+        :returns: A list of ref patterns that can be passed to `ls_remote`
+        """
+        patterns = ['refs/heads/' + self.branch]
+        if 'tagged' in self.update_policy:
+            tag_filter = self.tag_filter or '*'
+            patterns.append('refs/tags/' + tag_filter)
+            if '*' not in tag_filter:
+                # `git for-each-ref` also matches refs under a directory
+                # with the filter's name
+                patterns.append('refs/tags/' + tag_filter + '/*')
+        return patterns
+
+    def _relevant_remote_refs(self, remote_refs):
+        """Filter the upstream refs that the update policies look at
+
+        :param dict remote_refs: A mapping of refs to SHAs as returned by
+                                 `ls_remote`
+
+        :rtype: dict
+        :returns: A mapping of the relevant refs to their SHAs, including
+                  peeled tags
+        """
+        patterns = self._ls_remote_patterns()
+
+        def is_relevant(ref):
+            if ref.endswith('^{}'):
+                ref = ref[:-3]
+            return any(fnmatch.fnmatchcase(ref, ptn) for ptn in patterns)
+
+        return dict(
+            (ref, sha) for ref, sha in iteritems(remote_refs)
+            if is_relevant(ref)
+        )
+
+    def _update_check_key(self):
+        """Get a key identifying the update policies of the source. The
+        current commit of the source is stored in the check itself
+
+        :rtype: str
+        """
+        return '{0} {1} {2} {3}'.format(
+            self.branch, self.update_policy, self.tag_filter,
+            self.annotated_tag_only
+        )
+
+    def _load_remote_refs_cache(self):
+        """Load the upstream refs cache from the cache dir
+
+        :rtype: dict
+        :returns: The cache contents, or an empty dict if there are none
+        """
+        cache_file = os.path.join(self._cache_dir, REMOTE_REFS_CACHE_FILE)
+        try:
+            with open(cache_file) as stream:
+                refs_cache = yaml.safe_load(stream)
+        except IOError as io_error:
+            # errno 2 => file not found
+            if io_error.errno != 2:
+                raise
+            return {}
+        except yaml.YAMLError:
+            logger.warning('Ignoring corrupt refs cache: %s', cache_file)
+            return {}
+        if not isinstance(refs_cache, dict):
+            return {}
+        return refs_cache
+
+    def _save_remote_refs_cache(self, refs_cache):
+        """Save the upstream refs cache into the cache dir
+
+        :param dict refs_cache: The cache contents to save
+        """
+        try:
+            os.makedirs(self._cache_dir)
+        except OSError as os_error:
+            if os_error.errno != 17:
+                raise  # Directory already exist
+        write_file_atomically(
+            os.path.join(self._cache_dir, REMOTE_REFS_CACHE_FILE),
+            yaml.safe_dump(refs_cache, default_flow_style=False)
+        )
 
     def _update_policy_static(self):
         """Just return the current commit.
@@ -989,14 +1384,91 @@ class GitUpstreamSource(object):
             return -1
         return 1
 
-    def _fetch(self):
+    def _fetch(self, required_commits=None):
         """Fetch the remote branch into the local cache
+
+        If the source has mirrors, the URLs are tried from the fastest
+        healthy one to the slowest or recently failed one, and the time it
+        takes to fetch from each URL is tracked across runs. We move on to the
+        next URL if fetching fails, or if some required commits are missing
+        after fetching, which may happen if a mirror is lagging behind.
+        Transient failures are only retried on the last URL.
+
+        :param Iterable required_commits: (Optional) Commits we expect the
+                                          cache to have after fetching.
+                                          Defaults to the source's commit.
         """
         self._init_cache()
-        self._cache_git(
-            'fetch', '--tags', self.url,
-            '+{0}:refs/remotes/origin/{0}'.format(self.branch)
-        )
+        branch_refspec = '+{0}:refs/remotes/origin/{0}'.format(self.branch)
+        tag_refspec = self._tag_refspec()
+        if tag_refspec is None:
+            fetch_opt, refspecs = '--tags', (branch_refspec,)
+        else:
+            fetch_opt, refspecs = '--no-tags', (branch_refspec, tag_refspec)
+        if not self.mirrors:
+            self._network_op('fetch', lambda timeout: self._cache_git(
+                'fetch', fetch_opt, self.url, *refspecs, timeout=timeout
+            ))
+            return
+        if required_commits is None:
+            required_commits = [self.commit]
+        url_health = UrlHealth()
+        urls = url_health.rank(self.mirrors + [self.url])
+        for url_idx, url in enumerate(urls):
+            is_last = (url_idx == len(urls) - 1)
+            start = time()
+            try:
+                self._network_op(
+                    'fetch',
+                    lambda timeout: self._cache_git(
+                        'fetch', fetch_opt, url, *refspecs, timeout=timeout
+                    ),
+                    url=url, retries=(None if is_last else 0),
+                )
+            except GitProcessError:
+                url_health.record(url, failed=True)
+                if is_last:
+                    raise
+                logger.warning("Failed to fetch from '%s'", url)
+                continue
+            url_health.record(url, time() - start)
+            if is_last or all(self._has_commit(c) for c in required_commits):
+                return
+            logger.warning("'%s' is missing required commits", url)
+
+    def _has_commit(self, commit):
+        """Check if the cache contains a given commit
+
+        :param str commit: The commit to look for
+        :rtype: bool
+        """
+        try:
+            self._cache_git('cat-file', '-e', commit + '^{commit}')
+            return True
+        except GitProcessError:
+            return False
+
+    def _tag_refspec(self):
+        """Get a refspec for fetching only the tags matching `tag_filter`
+
+        Narrowing the fetched tags this way ensures unrelated tags are never
+        transferred into the cache. Git refspecs only support a single `*`
+        wildcard, so for filters that cannot be expressed as a refspec we
+        fall back to fetching all the tags. Filters without a wildcard are
+        turned into prefix patterns so that, like with `git for-each-ref`,
+        they match tags under a directory with that name as well, and so
+        that fetching does not fail if no such tag exists yet.
+
+        :rtype: str
+        :returns: A tag refspec or None if all tags should be fetched
+        """
+        tag_filter = self.tag_filter
+        if not tag_filter or tag_filter.count('*') > 1 \
+                or any(c in tag_filter for c in '?[]\\'):
+            return None
+        if '*' not in tag_filter:
+            tag_filter += '*'
+        return '+refs/tags/{0}:refs/tags/{0}'.format(tag_filter)
 
     def _merge_base(self, object_a, object_b):
         """Returns the ancestor commit between 2 commits.
@@ -1080,6 +1552,464 @@ class GitUpstreamSource(object):
         return git_ls_files(self.commit, git_func=self._cache_git)
 
 
+class BlobStore(object):
+    """A node-local, content-addressed store of upstream source files
+
+    Files are extracted from the upstream sources caches into the store once,
+    keyed by their blob SHA and file mode, and are then hard-linked or
+    reflinked into workspaces. This way concurrent jobs on the same node share
+    the storage for the upstream files they use.
+
+    Files in the store are made read-only, so that hard-linked files cannot be
+    modified in place by mistake. Since root can write to read-only files,
+    files are reflinked rather then hard-linked when running as root. When a
+    link cannot be made, for example if the workspace is on a different file
+    system or the OS does not permit it, the file is copied from the store
+    instead.
+
+    Files are verified against their blob SHA before they are placed, and
+    files that were modified in the store are extracted again.
+    """
+    def __init__(self, path=None):
+        """
+        :param str path: (Optional) Where the store resides, defaults to a
+                         directory under the usrc cache
+        """
+        self.path = path or os.path.join(
+            xdg_cache_home, CACHE_NAME, BLOB_STORE_NAME
+        )
+
+    def blob_path(self, git_file):
+        """Get the path of a file in the store
+
+        :param GitFile git_file: The file to get the path for
+
+        :rtype: str
+        """
+        return os.path.join(
+            self.path, git_file.file_hash[:2],
+            '{0}-{1:o}'.format(git_file.file_hash[2:], git_file.file_type)
+        )
+
+    @staticmethod
+    def _blob_hash(blob_path):
+        """Calculate the git blob SHA of a file in the store
+
+        :param str blob_path: The path of the file
+
+        :rtype: str
+        """
+        blob_hash = sha1(
+            'blob {0}\0'.format(os.path.getsize(blob_path)).encode()
+        )
+        with open(blob_path, 'rb') as blob_file:
+            for chunk in iter(lambda: blob_file.read(65536), b''):
+                blob_hash.update(chunk)
+        return blob_hash.hexdigest()
+
+    def _verify_blob(self, git_dir, git_file):
+        """Make sure a file in the store was not modified since it was
+        extracted, and extract it again if it was
+
+        :param str git_dir:       The git dir to extract the file from
+        :param GitFile git_file:  The file to verify
+        """
+        blob_path = self.blob_path(git_file)
+        if self._blob_hash(blob_path) == git_file.file_hash:
+            return
+        logger.warning('Replacing modified blob store file: %s', blob_path)
+        os.unlink(blob_path)
+        self.add_files(git_dir, [git_file])
+
+    @staticmethod
+    def _hardlinks_safe():
+        """Check if read-only permissions protect hard-linked files from
+        being modified, which is not the case for root
+        """
+        return os.geteuid() != 0
+
+    def add_files(self, git_dir, git_files):
+        """Extract files that are missing from the store
+
+        :param str git_dir:          The git dir to extract the files from
+        :param Iterable git_files:   GitFile objects of the files to extract
+        """
+        missing = OrderedDict(
+            (self.blob_path(gf), gf) for gf in git_files
+            if stat.S_ISREG(gf.file_type)
+            and not os.path.exists(self.blob_path(gf))
+        )
+        if not missing:
+            return
+        logger.info('Adding %d files to blob store', len(missing))
+        git_command = ['git', '--git-dir=' + git_dir, 'cat-file', '--batch']
+        process = Popen(git_command, stdin=PIPE, stdout=PIPE)
+        try:
+            for blob_path, git_file in iteritems(missing):
+                process.stdin.write((git_file.file_hash + '\n').encode())
+                process.stdin.flush()
+                header = process.stdout.readline().split()
+                if len(header) != 3 or header[1] != b'blob':
+                    raise GitProcessError(1, git_command)
+                self._write_blob(
+                    blob_path, process.stdout, int(header[2]),
+                    git_file.file_type & 0o111 | 0o444,
+                )
+                process.stdout.read(1)  # Trailing newline
+        finally:
+            process.stdin.close()
+            process.wait()
+
+    @staticmethod
+    def _write_blob(blob_path, stream, size, mode):
+        """Atomically write a file into the store
+
+        :param str blob_path: Where to write the file
+        :param file stream:   A stream to read the file contents from
+        :param int size:      The amount of bytes to read from the stream
+        :param int mode:      The permissions to set on the file
+        """
+        try:
+            os.makedirs(os.path.dirname(blob_path))
+        except OSError as os_error:
+            if os_error.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = mkstemp(dir=os.path.dirname(blob_path))
+        try:
+            with os.fdopen(fd, 'wb') as blob_file:
+                while size > 0:
+                    chunk = stream.read(min(size, 65536))
+                    if not chunk:
+                        raise IOError(errno.EIO, 'Truncated blob', blob_path)
+                    blob_file.write(chunk)
+                    size -= len(chunk)
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, blob_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def materialize(self, git_dir, files, dst_path, link_mode):
+        """Place files in a given path by linking them from the store
+
+        :param str git_dir:      The git dir to extract missing files from
+        :param Mapping files:    A mapping of file paths to GitFile objects as
+                                 returned by git_ls_files()
+        :param str dst_path:     The path to place the files in
+        :param str link_mode:    Either 'hardlink' or 'reflink'
+
+        :rtype: dict
+        :returns: Statistics about how the files were placed and how many
+                  inodes and bytes were saved by linking them
+        """
+        self.add_files(git_dir, itervalues(files))
+        stats = dict(
+            hardlink=0, reflink=0, copy=0, symlink=0,
+            inodes_saved=0, bytes_saved=0,
+        )
+        for path, git_file in iteritems(files):
+            file_dst = os.path.join(dst_path, path)
+            try:
+                os.makedirs(os.path.dirname(file_dst))
+            except OSError as os_error:
+                if os_error.errno != errno.EEXIST:
+                    raise
+            if os.path.islink(file_dst) or os.path.isfile(file_dst):
+                os.unlink(file_dst)
+            if stat.S_ISLNK(git_file.file_type):
+                os.symlink(git_file.read_file(), file_dst)
+                stats['symlink'] += 1
+                continue
+            elif not stat.S_ISREG(git_file.file_type):
+                # Submodules are not checked out either
+                continue
+            self._verify_blob(git_dir, git_file)
+            blob_path = self.blob_path(git_file)
+            method = self._link(blob_path, file_dst, link_mode)
+            stats[method] += 1
+            if method != 'copy':
+                stats['bytes_saved'] += os.path.getsize(blob_path)
+            if method == 'hardlink':
+                stats['inodes_saved'] += 1
+        logger.info('Materialized files from blob store', extra={
+            'blocks': pformat(stats)
+        })
+        return stats
+
+    @classmethod
+    def _link(cls, blob_path, file_dst, link_mode):
+        """Link a file from the store, falling back to copying it
+
+        :param str blob_path: The path of the file in the store
+        :param str file_dst:  The path to link the file into
+        :param str link_mode: Either 'hardlink' or 'reflink'
+
+        :rtype: str
+        :returns: How the file was placed - 'hardlink', 'reflink' or 'copy'
+        """
+        if link_mode == 'hardlink' and not cls._hardlinks_safe():
+            link_mode = 'reflink'
+        if link_mode == 'hardlink':
+            try:
+                os.link(blob_path, file_dst)
+                return 'hardlink'
+            except OSError as os_error:
+                if os_error.errno not in (
+                    errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK
+                ):
+                    raise
+        # Links and copies we make have their own inode, so they are made
+        # writable
+        mode = os.stat(blob_path).st_mode & 0o777 | 0o200
+        with open(blob_path, 'rb') as src:
+            fd = os.open(file_dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            with os.fdopen(fd, 'wb') as dst:
+                if link_mode == 'reflink':
+                    try:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                        return 'reflink'
+                    except (IOError, OSError) as os_error:
+                        if os_error.errno not in (
+                            errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                            errno.ENOTTY, errno.EPERM,
+                        ):
+                            raise
+                shutil.copyfileobj(src, dst)
+        return 'copy'
+
+    def record_savings(self, stats, url, commit):
+        """Record the savings made by materializing files from the store
+
+        Records are appended to a YAML list in the store directory.
+
+        :param dict stats: Statistics as returned by materialize()
+        :param str url:    The URL of the upstream source the files came from
+        :param str commit: The upstream commit the files came from
+        """
+        record = dict(stats, url=url, commit=commit, timestamp=time())
+        try:
+            os.makedirs(self.path)
+        except OSError as os_error:
+            if os_error.errno != errno.EEXIST:
+                raise
+        savings_file = os.path.join(self.path, BLOB_STORE_SAVINGS_FILE)
+        with open(savings_file, 'a') as stream:
+            stream.write(yaml.safe_dump(
+                [record], default_flow_style=None, width=4096
+            ))
+
+
+class UrlHealth(object):
+    """Tracks how fast and how reliable upstream URLs are across runs
+
+    The data is kept in a YAML file in the usrc cache, mapping each URL to a
+    moving average of the time it took to fetch from it, and to the number
+    and time of its recent consecutive failures. The file is locked while it
+    is updated, so concurrent usrc runs do not lose each other's updates.
+    """
+    def __init__(self, path=None):
+        """
+        :param str path: (Optional) Where to keep the data, defaults to a
+                         file under the usrc cache
+        """
+        self.path = path or os.path.join(
+            xdg_cache_home, CACHE_NAME, URL_HEALTH_FILE
+        )
+
+    def load(self):
+        """Load the URL health data
+
+        :rtype: dict
+        :returns: A mapping from URLs to their health data
+        """
+        try:
+            with open(self.path) as stream:
+                health = yaml.safe_load(stream)
+        except IOError as io_error:
+            if io_error.errno != errno.ENOENT:
+                raise
+            return {}
+        except yaml.YAMLError:
+            logger.warning('Ignoring corrupt URL health data: %s', self.path)
+            return {}
+        return health if isinstance(health, dict) else {}
+
+    @contextmanager
+    def _locked(self):
+        """Lock the URL health data for updating
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as os_error:
+            if os_error.errno != errno.EEXIST:
+                raise
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def rank(self, urls):
+        """Sort URLs from the most to the least preferable one
+
+        URLs that are in their failure cool down period come last. The
+        rest are sorted by their average fetch time. URLs we have no data
+        about are preferred so we get to measure them, and the given order
+        is kept between URLs with the same score.
+
+        :param list urls: The URLs to sort
+
+        :rtype: list
+        """
+        health = self.load()
+        now = time()
+
+        def url_key(url_idx_and_url):
+            url_idx, url = url_idx_and_url
+            url_health = health.get(url, {})
+            failures = url_health.get('failures', 0)
+            cooling_down = failures > 0 and now < (
+                url_health.get('last_failure', 0) + min(
+                    URL_FAILURE_COOLDOWN * 2 ** (failures - 1),
+                    MAX_URL_FAILURE_COOLDOWN
+                )
+            )
+            return (cooling_down, url_health.get('latency', 0), url_idx)
+
+        return [url for _, url in sorted(enumerate(urls), key=url_key)]
+
+    def record(self, url, seconds=None, failed=False):
+        """Record the outcome of fetching from a URL
+
+        :param str url:       The URL we fetched from
+        :param float seconds: (Optional) How long a successful fetch took
+        :param bool failed:   (Optional) Set to True if the fetch failed
+        """
+        with self._locked():
+            health = self.load()
+            url_health = health.setdefault(url, {})
+            if failed:
+                url_health['failures'] = url_health.get('failures', 0) + 1
+                url_health['last_failure'] = time()
+            else:
+                url_health['failures'] = 0
+                if 'latency' in url_health:
+                    url_health['latency'] = round(
+                        URL_LATENCY_WEIGHT * seconds +
+                        (1 - URL_LATENCY_WEIGHT) * url_health['latency'], 3
+                    )
+                else:
+                    url_health['latency'] = round(seconds, 3)
+            write_file_atomically(
+                self.path, yaml.safe_dump(health, default_flow_style=False)
+            )
+
+
+class BranchPusher(object):
+    """Collects upstream commits that need to be pushed into branches in
+    remote repositories, and pushes them with a single `git push` per remote
+
+    The commits may come from the caches of different upstream sources, so
+    when pushing, the caches' object stores are made available to git as
+    alternates of the one we push from.
+    """
+    def __init__(self, timeout=None, retries=None):
+        """
+        :param float timeout: (Optional) Seconds to wait for each push
+        :param int retries:   (Optional) How many times to retry pushes that
+                              fail due to transient errors
+        """
+        self._pushes = OrderedDict()
+        self._timeout = timeout
+        self._retries = DEFAULT_NETWORK_RETRIES if retries is None \
+            else retries
+
+    def add(self, push_details, git_dir, commit, dst_branch):
+        """Queue a commit to be pushed into a remote branch
+
+        :param PushDetails push_details: Details about the remote to push to
+        :param str git_dir:              The git dir the commit can be found
+                                         in
+        :param str commit:               The commit to push
+        :param str dst_branch:           The name of the remote branch to
+                                         push into
+        """
+        _, git_dirs, branches = self._pushes.setdefault(
+            push_details.push_url, (push_details, [], OrderedDict())
+        )
+        if git_dir not in git_dirs:
+            git_dirs.append(git_dir)
+        branches[dst_branch] = commit
+
+    def push(self):
+        """Push all the queued commits
+
+        Branches that already exist in the remote and point to the queued
+        commit are skipped.
+        """
+        for push_url, (push_details, git_dirs, branches) in \
+                iteritems(self._pushes):
+            if push_details.host_key:
+                add_key_to_known_hosts(push_details.host_key)
+            try:
+                remote_refs = retry_transient(
+                    lambda: ls_remote(
+                        push_url, ['refs/heads/' + br for br in branches],
+                        self._timeout
+                    ),
+                    self._retries, 'ls-remote of ' + push_url
+                )
+            except GitProcessError:
+                logger.warning('Failed to list refs of %s', push_url)
+                remote_refs = {}
+            refspecs = [
+                '{0}:refs/heads/{1}'.format(commit, dst_branch)
+                for dst_branch, commit in iteritems(branches)
+                if remote_refs.get('refs/heads/' + dst_branch) != commit
+            ]
+            if not refspecs:
+                logger.info("All branches already exist in: '%s'", push_url)
+                continue
+            env = None
+            if len(git_dirs) > 1:
+                env = {'GIT_ALTERNATE_OBJECT_DIRECTORIES': os.pathsep.join(
+                    os.path.join(git_dir, 'objects')
+                    for git_dir in git_dirs[1:]
+                )}
+            logger.info(
+                "Pushing %d branches to: '%s'", len(refspecs), push_url
+            )
+            retry_transient(
+                lambda: git(
+                    '--git-dir=' + git_dirs[0], 'push', push_url, *refspecs,
+                    env=env, timeout=self._timeout
+                ),
+                self._retries, 'push to ' + push_url
+            )
+        self._pushes.clear()
+
+
+def write_file_atomically(path, content):
+    """Replace the contents of a file so readers never see a partial file
+
+    The contents are written to a temporary file that is then renamed over
+    the given file, so concurrent jobs on the same node can safely share it.
+
+    :param str path:    The path of the file to write
+    :param str content: The text to write into the file
+    """
+    fd, tmp_path = mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            stream.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
 def load_upstream_sources(commit=None):
     """Load upstream source objects from configuration file
 
@@ -1136,17 +2066,25 @@ def save_upstream_sources(upstream_sources, config_path):
         yaml.safe_dump(sources_doc, usrc_config, default_flow_style=False)
 
 
-def get_upstream_sources(push_map):
+def get_upstream_sources(push_map, timeout=None, retries=None):
     """Download the US sources listed in upstream_sources.yaml
 
-    :param str push_map: The path to a file containing information about remote
-                         SCM servers that is needed to push changes to them.
+    :param str push_map:  The path to a file containing information about
+                          remote SCM servers that is needed to push changes to
+                          them.
+    :param float timeout: (Optional) Default timeout in seconds for network
+                          operations
+    :param int retries:   (Optional) Default amount of retries for network
+                          operations that fail due to transient errors
     """
     upstream_sources, _ = load_upstream_sources()
     dst_path = os.getcwd()
 
+    branch_pusher = BranchPusher(timeout, retries)
     for usrc in upstream_sources:
-        usrc.get(dst_path, push_map)
+        usrc.set_network_defaults(timeout, retries)
+        usrc.get(dst_path, push_map, branch_pusher)
+    branch_pusher.push()
 
     # the below code will 'prefer' ds changes over us ones
     git(
@@ -1156,15 +2094,26 @@ def get_upstream_sources(push_map):
     )
 
 
-def update_upstream_sources():
+def update_upstream_sources(timeout=None, retries=None):
     """Update the commit hashes for US sources listed in upstream_sources.yaml
 
+    :param float timeout: (Optional) Default timeout in seconds for network
+                          operations
+    :param int retries:   (Optional) Default amount of retries for network
+                          operations that fail due to transient errors
+
     :returns: Generator upstream_sources: A collection of upstream source
         objects
     :returns: str config_path: Path to the upstream sources config
     """
     upstream_sources, config_path = load_upstream_sources()
-    updated_sources, us2 = tee(usrc.updated() for usrc in upstream_sources)
+    for usrc in upstream_sources:
+        usrc.set_network_defaults(timeout, retries)
+    remote_refs = ls_remote_upstream_sources(upstream_sources)
+    updated_sources, us2 = tee(
+        usrc.updated(remote_refs.get(usrc.url))
+        for usrc in upstream_sources
+    )
     modified_sources, ms2 = tee(
         new for new, old in zip(us2, upstream_sources) if new != old
     )
@@ -1176,6 +2125,54 @@ def update_upstream_sources():
     return modified_sources, config_path
 
 
+def ls_remote_upstream_sources(upstream_sources):
+    """List the upstream refs the given upstream sources depend on
+
+    A single `git ls-remote` is invoked for each upstream URL, covering the
+    refs needed by all the sources that use that URL.
+
+    :param Iterable upstream_sources: A collection of upstream source objects
+
+    :rtype: dict
+    :returns: A mapping from upstream URLs to mappings of refs to SHAs. URLs
+              that could not be queried are omitted.
+    """
+    patterns_by_url = OrderedDict()
+    for usrc in upstream_sources:
+        _, patterns = patterns_by_url.setdefault(usrc.url, (usrc, set()))
+        patterns.update(usrc._ls_remote_patterns())
+    remote_refs = dict()
+    for url, (usrc, patterns) in iteritems(patterns_by_url):
+        try:
+            remote_refs[url] = usrc._network_op(
+                'ls-remote',
+                lambda timeout: ls_remote(url, sorted(patterns), timeout)
+            )
+        except GitProcessError:
+            logger.warning(
+                'Failed to list refs of %s, will fetch it instead', url
+            )
+    return remote_refs
+
+
+def ls_remote(url, patterns=None, timeout=None):
+    """List the refs in a remote git repository
+
+    :param str url:           The URL of the remote repository
+    :param Iterable patterns: (Optional) Ref patterns to limit the listed
+                              refs to. If unspecified, all refs are listed.
+    :param float timeout:     (Optional) Seconds to wait for git
+
+    :rtype: dict
+    :returns: A mapping from ref names to SHAs
+    """
+    out = git('ls-remote', url, *(patterns or ()), timeout=timeout)
+    return dict(
+        (ref, sha) for sha, ref in
+        (line.split(u'\t', 1) for line in out.splitlines() if line)
+    )
+
+
 def get_modified_files(new_commit=None, old_commit=None, resolve_links=None):
     """Gets the list of files modified locally or in upstreams between commits
 
@@ -1540,12 +2537,91 @@ class GitProcessError(CalledProcessError):
     pass
 
 
+class GitTimeoutError(GitProcessError):
+    """Raised when git was cancelled because it took too long"""
+    def __init__(self, returncode, cmd, timeout):
+        super(GitTimeoutError, self).__init__(returncode, cmd)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '{0}' timed out after {1} seconds".format(
+            ' '.join(self.cmd), self.timeout
+        )
+
+
+def is_transient_git_error(error):
+    """Check if a git failure may go away if the command is retried
+
+    :param GitProcessError error: The error raised by git()
+    :rtype: bool
+    """
+    if isinstance(error, GitTimeoutError):
+        return True
+    stderr = getattr(error, 'stderr', None) or ''
+    return bool(TRANSIENT_GIT_ERRORS.search(stderr))
+
+
+def retry_transient(func, retries, description):
+    """Call a function that runs git, retrying it on transient failures
+
+    Retries are done with an exponential backoff.
+
+    :param callable func:    The function to call
+    :param int retries:      How many times to retry the function
+    :param str description:  A description of what the function does for
+                             logging
+
+    :returns: Whatever `func` returns
+    """
+    for attempt in count():
+        try:
+            return func()
+        except GitProcessError as error:
+            if attempt >= retries or not is_transient_git_error(error):
+                raise
+            delay = NETWORK_RETRY_BACKOFF * 2 ** attempt
+            logger.warning(
+                '%s failed with a transient error, retrying in %d seconds: %s',
+                description, delay, error
+            )
+            sleep(delay)
+
+
+def _terminate_process_group(process, sig, terminated, lock):
+    """Send a signal to a process group, used for cancelling commands
+
+    :param Popen process:     The process leading the group
+    :param int sig:           The signal to send
+    :param list terminated:   A list to append to if the signal was sent. If
+                              None is in the list the command is done and no
+                              signal is sent, since the process group ID may
+                              have been reused already
+    :param Lock lock:         A lock the command holds while marking itself
+                              as done
+    """
+    with lock:
+        if None in terminated or process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, sig)
+            terminated.append(sig)
+        except OSError as os_error:
+            if os_error.errno != errno.ESRCH:
+                raise
+
+
 def git(*args, **kwargs):
     """
     Util function to execute git commands
 
     :param list *args:         A list of git command line args
     :param bool append_stderr: If set to true, append STDERR to the output
+    :param dict env:           (Optional) Environment variables to add to the
+                               environment git is run with
+    :param float timeout:      (Optional) Seconds to wait for git to finish.
+                               If it takes longer, git and any processes it
+                               started are terminated and GitTimeoutError is
+                               raised.
 
     Executes git commands and return output. Raise GitProcessError if Git fails
 
@@ -1556,9 +2632,40 @@ def git(*args, **kwargs):
     git_command.extend(args)
 
     stderr = (STDOUT if kwargs.get('append_stderr', False) else PIPE)
+    env = None
+    if kwargs.get('env'):
+        env = dict(os.environ)
+        env.update(kwargs['env'])
+    timeout = kwargs.get('timeout')
     logger.info("Executing command: '%s'", ' '.join(git_command))
-    process = Popen(git_command, stdout=PIPE, stderr=stderr)
-    output, error = process.communicate()
+    process = Popen(
+        git_command, stdout=PIPE, stderr=stderr, env=env,
+        # Run in a new process group so we can cancel any children git starts
+        preexec_fn=os.setsid if timeout else None,
+    )
+    timers, terminated, lock = [], [], Lock()
+    if timeout:
+        timers = [
+            Timer(
+                delay, _terminate_process_group,
+                (process, sig, terminated, lock)
+            )
+            for delay, sig in (
+                (timeout, signal.SIGTERM),
+                (timeout + GIT_KILL_GRACE, signal.SIGKILL),
+            )
+        ]
+        for timer in timers:
+            timer.daemon = True
+            timer.start()
+    try:
+        output, error = process.communicate()
+    finally:
+        with lock:
+            timed_out = bool(terminated)
+            terminated.append(None)
+        for timer in timers:
+            timer.cancel()
     retcode = process.poll()
     if error is None:
         error = ''
@@ -1568,8 +2675,13 @@ def git(*args, **kwargs):
     logger.debug('Git exited with status: %d', retcode, extra={'blocks': (
         ('stderr', error), ('stdout', output)
     )},)
+    # A command that finished just as it was being terminated has succeeded
+    if timed_out and retcode:
+        raise GitTimeoutError(retcode, git_command, timeout)
     if retcode:
-        raise GitProcessError(retcode, git_command)
+        git_error = GitProcessError(retcode, git_command)
+        git_error.stderr = error
+        raise git_error
     return output
 
 
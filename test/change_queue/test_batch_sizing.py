@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""change_queue/test_batch_sizing.py - Tests for change_queue.batch_sizing
+"""
+import pytest
+from six.moves import cPickle as pickle
+
+from stdci_libs.change_queue.batch_sizing import BatchSizeModel
+
+
+def test_failure_rate():
+    model = BatchSizeModel(history=10, min_history=4)
+    assert model.failure_rate is None
+    model.record_outcomes(2, 1)
+    assert model.failure_rate is None
+    assert model.best_batch_size() is None
+    model.record_outcomes(2, 1)
+    assert 1 / 3.0 == pytest.approx(model.failure_rate)
+    # Only recent outcomes are kept
+    model.record_outcomes(10, 0)
+    assert 0 == model.failure_rate
+
+
+@pytest.mark.parametrize(('size', 'rate', 'ways', 'exp_runs', 'exp_res'), [
+    (1, 0.5, 2, 1, 1),
+    (4, 0, 2, 1, 4),
+    (4, 0.5, 2, 1 + 0.9375 * 2, 1.875),
+    (9, 0.1, 3, 1 + (1 - 0.9 ** 9) * 4, (1 - 0.9 ** 9) / 0.1),
+])
+def test_expected_runs_and_resolved(size, rate, ways, exp_runs, exp_res):
+    assert exp_runs == pytest.approx(
+        BatchSizeModel.expected_runs(size, rate, ways)
+    )
+    assert exp_res == pytest.approx(
+        BatchSizeModel.expected_resolved(size, rate)
+    )
+
+
+def test_expected_duration():
+    model = BatchSizeModel()
+    assert 1.0 == model.expected_duration(10)
+    model.record_test_duration(2, 100)
+    model.record_test_duration(4, 100)
+    assert 100 == model.expected_duration(10)
+    model.record_test_duration(2, 80)
+    model.record_test_duration(4, 120)
+    assert 130 == pytest.approx(model.expected_duration(6))
+    # Durations that are shorter for larger batches are taken as noise
+    model = BatchSizeModel()
+    model.record_test_duration(2, 120)
+    model.record_test_duration(4, 80)
+    assert 100 == model.expected_duration(10)
+
+
+@pytest.mark.parametrize(('merged', 'rejected', 'ways', 'exp_size'), [
+    (100, 0, 2, None),
+    (990, 10, 2, 64),
+    (98, 2, 2, 32),
+    (98, 2, 4, 16),
+    (95, 5, 2, 16),
+    (80, 20, 2, 4),
+    (50, 50, 2, 1),
+])
+def test_best_batch_size(merged, rejected, ways, exp_size):
+    model = BatchSizeModel(history=1000)
+    model.record_outcomes(merged, rejected)
+    assert exp_size == model.best_batch_size(ways)
+    assert exp_size == model.best_batch_size(ways)
+
+
+def test_best_batch_size_with_durations():
+    model = BatchSizeModel()
+    model.record_outcomes(990, 10)
+    before = model.best_batch_size()
+    # When larger batches take longer to test, smaller ones are better
+    for size in range(1, 20):
+        model.record_test_duration(size, 60 + 10 * size)
+    assert model.best_batch_size() < before
+
+
+def test_pickle():
+    model = BatchSizeModel()
+    model.record_outcomes(95, 5)
+    model.record_test_duration(3, 60)
+    assert 16 == model.best_batch_size()
+    assert model._best_size_cache is not None
+    loaded = pickle.loads(pickle.dumps(model))
+    assert loaded._best_size_cache is None
+    assert 16 == loaded.best_batch_size()
+    assert 0.05 == loaded.failure_rate
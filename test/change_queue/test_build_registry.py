@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""change_queue/test_build_registry.py - Tests for change_queue.build_registry
+"""
+import pytest
+import json
+
+from stdci_libs.change_queue.build_registry import BuildRegistry, main
+from stdci_libs.jenkins_objects import BuildPtr, BuildsList
+
+
+KEY = ('project1', '1234567', 'el8')
+
+
+@pytest.fixture
+def registry(tmpdir):
+    return BuildRegistry(str(tmpdir / 'builds.json'))
+
+
+def _builds(build_url='job/build/1', queue_id=None):
+    return BuildsList([BuildPtr(
+        'build', 'job/build', queue_id=queue_id, build_id='1',
+        build_url=build_url,
+    )])
+
+
+def test_register_and_attach(registry):
+    assert registry.attach(KEY, now=0) is None
+    assert registry.register(KEY, _builds(), duration=300, now=0)
+    assert _builds() == registry.attach(KEY, now=10)
+    assert _builds() == registry.attach(KEY, now=20)
+    # Other commits and build specs are not affected
+    assert registry.attach(('project1', '1234567', 'el7'), now=20) is None
+    assert registry.attach(('project1', '7654321', 'el8'), now=20) is None
+    assert dict(entries=1, reuses=2, saved_time=600) == registry.stats()
+
+
+def test_register_existing(registry):
+    assert registry.register(KEY, _builds(), now=0)
+    assert not registry.register(KEY, _builds('job/build/2'), now=10)
+    assert _builds() == registry.attach(KEY, now=20)
+    assert not registry.register(KEY, BuildsList(), now=20)
+
+
+@pytest.mark.parametrize(('builds', 'age', 'usable'), [
+    (_builds(), BuildRegistry.max_age, True),
+    (_builds(), BuildRegistry.max_age + 1, False),
+    (_builds(queue_id=5), BuildRegistry.pending_max_age, True),
+    (_builds(queue_id=5), BuildRegistry.pending_max_age + 1, False),
+])
+def test_freshness(registry, builds, age, usable):
+    registry.register(KEY, builds, now=1000)
+    assert usable == (registry.attach(KEY, now=1000 + age) is not None)
+    # Stale builds get replaced
+    assert usable != registry.register(
+        KEY, _builds('job/build/2'), now=1000 + age
+    )
+
+
+def test_mark_failed(registry):
+    registry.register(KEY, _builds(), now=0)
+    registry.mark_failed(KEY)
+    registry.mark_failed(('project1', '7654321', 'el8'))
+    assert registry.attach(KEY, now=0) is None
+    assert registry.register(KEY, _builds('job/build/2'), now=0)
+    assert _builds('job/build/2') == registry.attach(KEY, now=0)
+
+
+def test_pruning(registry):
+    registry.register(KEY, _builds(), now=0)
+    registry.register(
+        ('project1', '7654321', 'el8'), _builds(),
+        now=BuildRegistry.max_age + 1,
+    )
+    assert 1 == registry.stats()['entries']
+
+
+def test_from_env(monkeypatch, tmpdir):
+    monkeypatch.delenv('CQ_BUILD_REGISTRY', raising=False)
+    assert BuildRegistry.from_env() is None
+    registry_file = str(tmpdir / 'builds.json')
+    monkeypatch.setenv('CQ_BUILD_REGISTRY', registry_file)
+    assert registry_file == BuildRegistry.from_env().registry_file
+
+
+def test_main(registry, capsys):
+    registry.register(KEY, _builds(), duration=60, now=0)
+    registry.attach(KEY, now=0)
+    assert 0 == main([registry.registry_file])
+    out, err = capsys.readouterr()
+    assert dict(entries=1, reuses=1, saved_time=60) == json.loads(out)
@@ -112,6 +112,8 @@ class TestGerritMergedChange(object):
             'branch.name': 'some_branch',
             'server.host': 'some.gerrit',
             'server.port': 29418,
+            'change.owner.email': 'someone@example.com',
+            'revision': 'abcdef1234567890abcdef1234567890abcdef12',
         })
 
     @pytest.fixture
@@ -132,6 +134,11 @@ class TestGerritMergedChange(object):
         assert a_gerrit_merged_change.stream_id == \
             ('some.gerrit', 29418, 'some_project', 'some_branch')
 
+    def test_risk_keys(self, a_gerrit_merged_change):
+        assert a_gerrit_merged_change.risk_keys == (
+            ('project', 'some_project'), ('owner', 'someone@example.com'),
+        )
+
     def test_mail_recipents(self, a_gerrit_merged_change):
         infra = ('infra@ovirt.org',)
         assert not a_gerrit_merged_change.added_recipients
@@ -176,6 +183,24 @@ class TestGerritMergedChange(object):
         assert a_gerrit_merged_change.successful_originator == originator
         assert a_gerrit_merged_change.failed_originator == originator
 
+    def test_build_key(self, a_gerrit_merged_change, monkeypatch):
+        assert a_gerrit_merged_change.build_key is None
+        assert a_gerrit_merged_change.build_duration is None
+        monkeypatch.setenv('CQ_BUILD_SPEC', 'el8')
+        monkeypatch.setenv('CQ_BUILD_DURATION', '300')
+        a_gerrit_merged_change.set_build_spec_from_env()
+        assert a_gerrit_merged_change.build_key == (
+            'some_project', 'abcdef1234567890abcdef1234567890abcdef12', 'el8'
+        )
+        assert 300.0 == a_gerrit_merged_change.build_duration
+
+    def test_set_priority_from_env(self, a_gerrit_merged_change, monkeypatch):
+        a_gerrit_merged_change.set_priority_from_env()
+        assert 0 == a_gerrit_merged_change.priority
+        monkeypatch.setenv('CQ_CHANGE_PRIORITY', '3')
+        a_gerrit_merged_change.set_priority_from_env()
+        assert 3 == a_gerrit_merged_change.priority
+
 
 class TestGitMergedChange(object):
     @pytest.fixture
@@ -197,3 +222,27 @@ class TestGitMergedChange(object):
 
     def test_stream_id(self, a_git_merged_change):
         assert a_git_merged_change.stream_id == ('project1', 'master')
+
+    def test_risk_keys(self, a_git_merged_change):
+        assert a_git_merged_change.risk_keys == (('project', 'project1'),)
+
+    def test_build_key(self, a_git_merged_change):
+        assert a_git_merged_change.build_key is None
+        a_git_merged_change.build_spec = 'el8'
+        assert a_git_merged_change.build_key == (
+            'project1', '1234567890abcdef1234567890abcdef1234567', 'el8'
+        )
+
+    def test_set_builds_from_registry(self, a_git_merged_change):
+        registry = MagicMock()
+        registry.attach.return_value = None
+        assert not a_git_merged_change.set_builds_from_registry(registry)
+        assert not registry.attach.called
+        a_git_merged_change.build_spec = 'el8'
+        assert not a_git_merged_change.set_builds_from_registry(None)
+        assert not a_git_merged_change.set_builds_from_registry(registry)
+        assert [] == list(a_git_merged_change.builds)
+        registry.attach.return_value = sentinel.builds
+        assert a_git_merged_change.set_builds_from_registry(registry)
+        registry.attach.assert_called_with(a_git_merged_change.build_key)
+        assert sentinel.builds == a_git_merged_change.builds
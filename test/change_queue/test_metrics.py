@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""change_queue/test_metrics.py - Tests for change_queue.metrics
+"""
+from textwrap import dedent
+
+from six.moves import cPickle as pickle
+
+from stdci_libs.change_queue.metrics import Histogram, TextfileMetrics
+
+
+def test_histogram():
+    histogram = Histogram([10, 1, 5])
+    for value in [0.5, 1, 3, 7, 20, 30]:
+        histogram.observe(value)
+    assert [
+        ('1', 2), ('5', 3), ('10', 4), ('+Inf', 6)
+    ] == histogram.cumulative_counts()
+    assert 61.5 == histogram.sum
+    assert 6 == histogram.count
+    histogram = pickle.loads(pickle.dumps(histogram))
+    histogram.observe(2)
+    assert [
+        ('1', 2), ('5', 4), ('10', 5), ('+Inf', 7)
+    ] == histogram.cumulative_counts()
+
+
+def test_render():
+    metrics = TextfileMetrics(dict(queue='q1'))
+    metrics.add_gauge('some_gauge', 'A gauge', 3, dict(stream='a'))
+    metrics.add_gauge('some_gauge', 'A gauge', 0.5, dict(stream='b"\\\n'))
+    histogram = Histogram([0.5, 1])
+    histogram.observe(0.25)
+    histogram.observe(2)
+    metrics.add_histogram(
+        'some_seconds', 'A histogram\nof times', histogram, dict(action='x')
+    )
+    assert dedent('''\
+        # HELP some_gauge A gauge
+        # TYPE some_gauge gauge
+        some_gauge{queue="q1",stream="a"} 3
+        some_gauge{queue="q1",stream="b\\"\\\\\\n"} 0.5
+        # HELP some_seconds A histogram\\nof times
+        # TYPE some_seconds histogram
+        some_seconds_bucket{action="x",le="0.5",queue="q1"} 1
+        some_seconds_bucket{action="x",le="1",queue="q1"} 1
+        some_seconds_bucket{action="x",le="+Inf",queue="q1"} 2
+        some_seconds_sum{action="x",queue="q1"} 2.25
+        some_seconds_count{action="x",queue="q1"} 2
+    ''') == metrics.render()
+
+
+def test_write(tmpdir):
+    metrics = TextfileMetrics()
+    metrics.add_gauge('some_gauge', 'A gauge', 1)
+    metrics.write(str(tmpdir / 'metrics.prom'))
+    assert metrics.render() == (tmpdir / 'metrics.prom').read()
+    assert ['metrics.prom'] == [f.basename for f in tmpdir.listdir()]
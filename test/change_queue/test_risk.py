@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""change_queue/test_risk.py - Tests for change_queue.risk
+"""
+import pytest
+from collections import namedtuple
+from six.moves import cPickle as pickle
+
+from stdci_libs.change_queue.risk import FailureEstimator, \
+    even_split_points, risk_split_points
+
+
+class RiskyChange(namedtuple('_RiskyChange', ('id', 'risk_keys'))):
+    pass
+
+
+def _chg(chid, *risk_keys):
+    return RiskyChange(chid, risk_keys)
+
+
+def test_failure_probability():
+    estimator = FailureEstimator(prior_weight=2)
+    assert 0.5 == estimator.failure_probability(_chg(1, 'a'))
+    assert 0.5 == estimator.failure_probability(1)
+    for chid in range(8):
+        estimator.record_outcome(_chg(chid, 'a'), False)
+    estimator.record_outcome(_chg(9, 'b'), True)
+    estimator.record_outcome(_chg(10, 'b'), True)
+    # Overall: 2 failures in 10 changes
+    base = 3 / 12.0
+    assert base == estimator.failure_probability(_chg(11, 'c'))
+    assert base == estimator.failure_probability(11)
+    assert (2 * base) / 10 == \
+        pytest.approx(estimator.failure_probability(_chg(11, 'a', 'c')))
+    assert (2 + 2 * base) / 4 == \
+        pytest.approx(estimator.failure_probability(_chg(11, 'b')))
+    # Changes get the estimate of their riskiest key
+    assert estimator.failure_probability(_chg(11, 'b')) == \
+        estimator.failure_probability(_chg(11, 'a', 'b'))
+
+
+def test_counts_decay():
+    estimator = FailureEstimator(max_count=10)
+    for chid in range(9):
+        estimator.record_outcome(_chg(chid, 'a'), True)
+    assert [9, 9] == estimator._counts['a']
+    estimator.record_outcome(_chg(9, 'a'), False)
+    assert [4.5, 5] == estimator._counts['a']
+    assert [4.5, 5] == estimator._overall
+
+
+def test_pickle():
+    estimator = FailureEstimator()
+    estimator.record_outcome(_chg(1, 'a'), True)
+    loaded = pickle.loads(pickle.dumps(estimator))
+    assert estimator.failure_probability(_chg(2, 'a')) == \
+        loaded.failure_probability(_chg(2, 'a'))
+
+
+@pytest.mark.parametrize(('size', 'ways', 'expected'), [
+    (2, 2, [1]),
+    (7, 2, [3]),
+    (8, 4, [2, 4, 6]),
+    (5, 3, [1, 3]),
+])
+def test_even_split_points(size, ways, expected):
+    assert expected == even_split_points(size, ways)
+
+
+@pytest.mark.parametrize(('probabilities', 'ways', 'expected'), [
+    ([0.1] * 8, 2, [3]),
+    ([0, 0, 0, 0], 2, [2]),
+    ([0.01] * 7 + [0.9], 2, [7]),
+    ([0.9] + [0.01] * 7, 2, [1]),
+    ([0.01] * 3 + [0.5] + [0.01] * 4, 2, [3]),
+    ([0.01] * 6 + [0.9, 0.9], 3, [6, 7]),
+    ([0.9, 0.9, 0.9], 3, [1, 2]),
+    ([0.01] * 8, 4, [2, 4, 6]),
+])
+def test_risk_split_points(probabilities, ways, expected):
+    assert expected == risk_split_points(probabilities, ways)
+
+
+def test_split_points():
+    estimator = FailureEstimator()
+    for chid in range(50):
+        estimator.record_outcome(_chg(chid, 'safe'), False)
+        estimator.record_outcome(_chg(chid, 'risky'), chid % 2 == 0)
+    changes = [_chg(chid, 'safe') for chid in range(7)] + [_chg(7, 'risky')]
+    assert [7] == estimator.split_points(changes, 2)
+    changes = [_chg(chid, 'safe') for chid in range(8)]
+    assert [4] == estimator.split_points(changes, 2)
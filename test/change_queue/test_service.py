@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""change_queue/test_service.py - Tests for change_queue.service
+"""
+import pytest
+import json
+from threading import Thread
+
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+from stdci_libs.change_queue import JenkinsChangeQueue, \
+    JenkinsChangeQueueClient, JenkinsTestedChangeList
+from stdci_libs.change_queue.service import ChangeQueueService
+from stdci_libs.jenkins_objects import JobRunSpec, NotInJenkins
+
+
+@pytest.fixture
+def queue_env(jenkins_env, monkeypatch):
+    monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+    return jenkins_env
+
+
+def start_service():
+    service = ChangeQueueService()
+    thread = Thread(target=service.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return service, thread
+
+
+@pytest.fixture
+def service(queue_env):
+    service, thread = start_service()
+    yield service
+    service.shutdown()
+    thread.join()
+
+
+def get_json(url):
+    response = urlopen(url)
+    try:
+        return json.loads(response.read().decode('utf8'))
+    finally:
+        response.close()
+
+
+def post(url, data):
+    return urlopen(Request(url, data=data))
+
+
+def enlist_state(state):
+    return [list(batch) for batch in state]
+
+
+def test_client_actions(service):
+    tester_run = JobRunSpec('some_change-queue-tester', {})
+    client = JenkinsChangeQueueClient('some', service.url)
+    assert [tester_run] == client.add(1)
+    assert [tester_run] == client.add(2)
+    assert [tester_run] == client.add(3)
+    tested = client.get_next_test('http://tester/1')
+    assert isinstance(tested, JenkinsTestedChangeList)
+    assert [1, 2, 3] == list(tested.change_list)
+    assert [tester_run] == client.on_test_failure(
+        tested.test_key, 'http://tester/1'
+    )
+    tested = client.get_next_test('http://tester/2')
+    assert [1] == list(tested.change_list)
+    client.on_test_success(tested.test_key, 'http://tester/2')
+    status = get_json(service.url + '/status')
+    assert 2 == status['num_changes']
+    page = get_json(service.url + '/status/1')
+    assert [2, 3] == [chg['id'] for chg in page['changes']]
+    # The queue state is persisted in the artifacts
+    with JenkinsChangeQueue.persist_in_artifacts() as queue:
+        assert [[2], [3], []] == enlist_state(queue._state)
+        assert 'http://tester/2' == queue._last_successful_test
+
+
+def test_client_batch(service):
+    tester_run = JobRunSpec('some_change-queue-tester', {})
+    client = JenkinsChangeQueueClient('some', service.url)
+    client.start_batch()
+    for change in [1, 2, 3]:
+        assert client.add(change) is None
+    assert [tester_run] == client.submit_batch()
+    tested = client.get_next_test('http://tester/1')
+    assert [1, 2, 3] == list(tested.change_list)
+    client.start_batch()
+    client.on_test_success(tested.test_key, 'http://tester/1')
+    client.add(4)
+    assert [tester_run] == client.submit_batch()
+    page = get_json(service.url + '/status/1')
+    assert [4] == [chg['id'] for chg in page['changes']]
+    with JenkinsChangeQueue.persist_in_artifacts() as queue:
+        assert 'http://tester/1' == queue._last_successful_test
+
+
+def test_client_quiet_period(queue_env, monkeypatch):
+    monkeypatch.setenv('CQ_COALESCING_WINDOW', '60')
+    times = iter(range(0, 1000, 2))
+    monkeypatch.setattr('stdci_libs.change_queue.time', lambda: next(times))
+    service, thread = start_service()
+    try:
+        client = JenkinsChangeQueueClient('some', service.url)
+        assert [JobRunSpec('some_change-queue-tester', {})] == client.add(1)
+        tester_runs = client.add(2)
+        assert [
+            JobRunSpec('some_change-queue-tester', {}, 8)
+        ] == tester_runs
+        assert 8 == tester_runs[0].as_pipeline_build_step()['quietPeriod']
+    finally:
+        service.shutdown()
+        thread.join()
+
+
+def test_nothing_to_test(service):
+    client = JenkinsChangeQueueClient('some', service.url)
+    assert client.get_next_test() is None
+
+
+def test_restart(queue_env):
+    service, thread = start_service()
+    client = JenkinsChangeQueueClient('some', service.url)
+    for change in [1, 2, 3]:
+        client.add(change)
+    test_key = client.get_next_test().test_key
+    service.shutdown()
+    thread.join()
+    service, thread = start_service()
+    try:
+        client = JenkinsChangeQueueClient('some', service.url)
+        client.on_test_success(test_key)
+        assert 0 == get_json(service.url + '/status')['num_changes']
+    finally:
+        service.shutdown()
+        thread.join()
+
+
+@pytest.mark.parametrize(('method', 'path', 'data', 'exp_code'), [
+    ('GET', '/nothing', None, 404),
+    ('GET', '/status/nope', None, 404),
+    ('GET', '/status/7', None, 404),
+    ('POST', '/nothing', b'{}', 404),
+    ('POST', '/add', b'not json', 400),
+    ('POST', '/add', b'[]', 400),
+    ('POST', '/add', b'{"arg": "not a change"}', 500),
+])
+def test_bad_requests(service, method, path, data, exp_code):
+    client = JenkinsChangeQueueClient('some', service.url)
+    client.add(1)
+    with pytest.raises(HTTPError) as excinfo:
+        if method == 'GET':
+            urlopen(service.url + path)
+        else:
+            post(service.url + path, data)
+    assert exp_code == excinfo.value.code
+    # Failed requests do not change the queue
+    assert 1 == get_json(service.url + '/status')['num_changes']
+    client.add(2)
+    assert 2 == get_json(service.url + '/status')['num_changes']
+
+
+def test_failed_action_is_dropped(service, monkeypatch):
+    client = JenkinsChangeQueueClient('some', service.url)
+    client.add(1)
+
+    def fail(*args):
+        raise RuntimeError('reporting failed')
+    report = JenkinsChangeQueue.__dict__['_report_changes_status']
+    monkeypatch.setattr(JenkinsChangeQueue, '_report_changes_status', fail)
+    with pytest.raises(HTTPError):
+        client.add(2)
+    monkeypatch.setattr(JenkinsChangeQueue, '_report_changes_status', report)
+    with JenkinsChangeQueue.persist_in_artifacts() as queue:
+        assert [[1]] == enlist_state(queue._state)
+    assert [1] == list(client.get_next_test().change_list)
+
+
+def test_not_in_queue_env(not_jenkins_env):
+    with pytest.raises(NotInJenkins):
+        ChangeQueueService()
+
+
+def test_client_without_service():
+    client = JenkinsChangeQueueClient('some')
+    assert JobRunSpec(
+        'some_change-queue', dict(QUEUE_ACTION='on_test_success',
+                                  ACTION_ARG='tk')
+    ) == client.on_test_success('tk')
+    assert JobRunSpec(
+        'some_change-queue', dict(QUEUE_ACTION='get_next_test',
+                                  ACTION_ARG='')
+    ) == client.get_next_test()
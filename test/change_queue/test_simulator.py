@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""change_queue/test_simulator.py - Tests for change_queue.simulator
+"""
+import pytest
+import json
+from collections import namedtuple
+import random
+
+from stdci_libs.change_queue import ChangeQueue, ChangeQueueWithDeps, \
+    ChangeQueueWithStreams
+from stdci_libs.change_queue.simulator import SimulatedChange, \
+    QueueSimulator, generate_changes, percentile, main
+
+
+def test_generate_changes():
+    changes = generate_changes(100, 10, 0.1, seed=7)
+    assert changes == generate_changes(100, 10, 0.1, seed=7)
+    assert changes != generate_changes(100, 10, 0.1, seed=8)
+    assert list(range(100)) == [chg.id for chg in changes]
+    assert sorted(chg.arrival for chg in changes) == \
+        [chg.arrival for chg in changes]
+    assert all(not chg.bad for chg in generate_changes(100, 10, 0))
+    assert all(
+        chg.requirements == () and chg.stream_id is None for chg in changes
+    )
+
+
+def test_generate_changes_with_deps_and_streams():
+    changes = generate_changes(
+        1000, 10, 0.1, seed=7, dependency_rate=0.3, dependency_distance=5,
+        streams=3,
+    )
+    with_deps = [chg for chg in changes if chg.requirements]
+    assert 200 < len(with_deps) < 400
+    assert all(
+        0 < chg.id - req <= 5
+        for chg in with_deps for req in chg.requirements
+    )
+    assert set([0, 1, 2]) == set(chg.stream_id for chg in changes)
+    # Changing the distributions does not change arrivals or failures
+    assert [
+        (chg.arrival, chg.bad) for chg in generate_changes(1000, 10, 0.1, 7)
+    ] == [(chg.arrival, chg.bad) for chg in changes]
+
+
+@pytest.mark.parametrize(('values', 'pct', 'expected'), [
+    ([], 50, 0.0),
+    ([1], 99, 1),
+    ([1, 2, 3, 4], 50, 2),
+    ([1, 2, 3, 4], 75, 3),
+    ([1, 2, 3, 4], 99, 4),
+    (list(range(1, 101)), 90, 90),
+])
+def test_percentile(values, pct, expected):
+    assert expected == percentile(values, pct)
+
+
+def test_simulator():
+    changes = [
+        SimulatedChange(0, 0, False),
+        SimulatedChange(1, 1, True),
+        SimulatedChange(2, 2, False),
+    ]
+    result = QueueSimulator(ChangeQueue(), changes, 10).run()
+    action_cpu_time = result.pop('action_cpu_time')
+    # Test [0] at 0, then [1, 2] at 10, which fails, then [1] at 20, then [2]
+    # at 30
+    assert dict(
+        changes=3,
+        merged=2,
+        rejected=1,
+        unresolved=0,
+        test_runs=4,
+        test_runs_per_change=4 / 3.0,
+        makespan=40,
+        mean_time_to_merge=(10 + 38) / 2.0,
+        max_time_to_merge=38,
+        time_to_merge_percentiles=dict(p50=10, p90=38, p95=38, p99=38),
+        mean_bisection_depth=2.0,
+        max_bisection_depth=2,
+    ) == result
+    assert dict(
+        add=3, get_next_test=5, on_test_success=2, on_test_failure=2,
+    ) == dict(
+        (action, times['calls'])
+        for action, times in action_cpu_time.items()
+    )
+    assert all(
+        times['total'] >= 0 and times['mean'] >= 0
+        for times in action_cpu_time.values()
+    )
+
+
+@pytest.mark.parametrize('queue_class', [
+    ChangeQueue, ChangeQueueWithDeps, ChangeQueueWithStreams
+])
+def test_simulate_queue_classes(queue_class):
+    def simulate():
+        changes = generate_changes(
+            300, 20, 0.05, seed=3, dependency_rate=0.2, streams=4
+        )
+        result = QueueSimulator(
+            queue_class(), changes, 60, testers=2, duration_sigma=0.5, seed=3
+        ).run()
+        result.pop('action_cpu_time')
+        return result
+    result = simulate()
+    assert result == simulate()
+    assert 300 == result['merged'] + result['rejected']
+    assert 0 == result['unresolved']
+    assert result['rejected'] > 0
+    assert result['max_bisection_depth'] >= result['mean_bisection_depth']
+    percentiles = result['time_to_merge_percentiles']
+    assert percentiles['p50'] <= percentiles['p90'] <= percentiles['p99'] \
+        <= result['max_time_to_merge']
+
+
+def test_main(tmpdir):
+    output = tmpdir / 'results.json'
+    assert 0 == main([
+        '--queue', 'ChangeQueueWithDeps', '--changes', '100',
+        '--dependency-rate', '0.1', '--testers', '2',
+        '--output', str(output),
+    ])
+    data = json.loads(output.read())
+    assert 'ChangeQueueWithDeps' == data['parameters']['queue']
+    assert 100 == data['parameters']['changes']
+    assert 'output' not in data['parameters']
+    assert 100 == data['results']['changes']
+    assert 'p95' in data['results']['time_to_merge_percentiles']
+    assert 'add' in data['results']['action_cpu_time']
+
+
+def _simulate(speculation_depth, failure_rate):
+    queue = ChangeQueue()
+    queue.speculation_depth = speculation_depth
+    changes = generate_changes(300, 20, failure_rate, seed=1)
+    result = QueueSimulator(queue, changes, 60, testers=4).run()
+    # CPU times are the only results that are not deterministic
+    result.pop('action_cpu_time')
+    return result
+
+
+@pytest.mark.parametrize('failure_rate', [0, 0.02, 0.1])
+def test_speculation_gain(failure_rate):
+    plain = _simulate(0, failure_rate)
+    assert plain == _simulate(0, failure_rate)
+    speculative = _simulate(2, failure_rate)
+    assert plain['merged'] == speculative['merged']
+    assert plain['rejected'] == speculative['rejected']
+    assert speculative['mean_time_to_merge'] < plain['mean_time_to_merge']
+    assert speculative['test_runs'] > plain['test_runs']
+
+
+def _simulate_batching(adaptive_batching, failure_rate):
+    queue = ChangeQueue()
+    queue.adaptive_batching = adaptive_batching
+    changes = generate_changes(500, 20, failure_rate, seed=1)
+    result = QueueSimulator(queue, changes, 60).run()
+    result.pop('action_cpu_time')
+    return result
+
+
+@pytest.mark.parametrize('failure_rate', [0.05, 0.1, 0.2])
+def test_adaptive_batching_gain(failure_rate):
+    fixed = _simulate_batching(False, failure_rate)
+    adaptive = _simulate_batching(True, failure_rate)
+    assert fixed['merged'] == adaptive['merged']
+    assert 0 == adaptive['unresolved']
+    assert adaptive['mean_time_to_merge'] < fixed['mean_time_to_merge']
+    assert adaptive['time_to_merge_percentiles']['p90'] < \
+        fixed['time_to_merge_percentiles']['p90']
+    assert adaptive['test_runs'] < fixed['test_runs']
+
+
+def test_adaptive_batching_without_failures():
+    assert _simulate_batching(False, 0) == _simulate_batching(True, 0)
+
+
+class PrioritySimulatedChange(namedtuple(
+    '_PrioritySimulatedChange', SimulatedChange._fields + ('priority',)
+)):
+    pass
+
+
+class MergeOrderQueue(ChangeQueueWithDeps):
+    """A queue that records the order in which changes were merged and how
+    many times priority lanes were started
+    """
+    def __init__(self):
+        super(MergeOrderQueue, self).__init__()
+        self.merged = []
+        self.lane_starts = 0
+
+    def on_test_success(self, test_key):
+        result = super(MergeOrderQueue, self).on_test_success(test_key)
+        self.merged.extend(chg.id for chg in result[0])
+        return result
+
+    def _start_priority_lanes(self):
+        self.lane_starts += 1
+        super(MergeOrderQueue, self)._start_priority_lanes()
+
+
+@pytest.mark.parametrize('seed', [0, 2, 4])
+def test_priority_lanes_with_speculation_and_deps(seed):
+    rnd = random.Random(seed)
+    changes = [
+        PrioritySimulatedChange(*change + (int(rnd.random() < 0.2),))
+        for change in generate_changes(
+            200, 10, 0.05, seed=seed, dependency_rate=0.3
+        )
+    ]
+    queue = MergeOrderQueue()
+    queue.bisect_ways = 3
+    queue.speculation_depth = 2
+    result = QueueSimulator(queue, changes, 60, testers=4).run()
+    assert 0 == result['unresolved']
+    assert queue.lane_starts > 0
+    merge_order = dict((chid, pos) for pos, chid in enumerate(queue.merged))
+    for change in changes:
+        if change.id not in merge_order:
+            continue
+        for req in change.requirements:
+            assert merge_order.get(req, -1) < merge_order[change.id]
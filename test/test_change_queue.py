@@ -5,11 +5,14 @@ from __future__ import absolute_import, print_function
 import pytest
 import random
 from math import log, ceil
+from time import time
 from copy import copy
 from six.moves import range
-from collections import namedtuple
+from collections import namedtuple, deque
+from six.moves import cPickle as pickle
 from textwrap import dedent
 import re
+import json
 try:
     from unittest.mock import MagicMock, call, sentinel
 except ImportError:
@@ -17,8 +20,10 @@ except ImportError:
 
 from stdci_libs.change_queue import ChangeQueue, ChangeQueueWithDeps, \
     JenkinsChangeQueueObject, JenkinsChangeQueue, ChangeQueueWithStreams, \
-    JenkinsTestedChangeList
-from stdci_libs.jenkins_objects import NotInJenkins
+    JenkinsTestedChangeList, JenkinsChangeQueueClient, \
+    InvalidChangeQueueAction, AwaitingDeps
+from stdci_libs.change_queue.changes import GitMergedChange
+from stdci_libs.jenkins_objects import NotInJenkins, BuildPtr, BuildsList
 
 
 def _enlist_state(state):
@@ -26,6 +31,44 @@ def _enlist_state(state):
     return list(list(st) for st in state)
 
 
+def _assert_index_in_sync(queue):
+    """Verify the queue's change index matches its state"""
+    exp_index = dict()
+    for batch_idx, batch in enumerate(queue._state):
+        for pos, change in enumerate(batch):
+            exp_index.setdefault(queue._change_id(change), []).append(
+                (batch_idx, pos)
+            )
+    out_index = dict(
+        (chid, sorted(
+            (serial - queue._index_base, pos) for serial, pos in locations
+        ))
+        for chid, locations in queue._change_index.items()
+    )
+    assert exp_index == out_index
+
+
+class PriorityChange(namedtuple('_PriorityChange', ('id', 'priority'))):
+    pass
+
+
+_pc = PriorityChange
+
+
+class RiskyChange(namedtuple('_RiskyChange', ('id', 'risk_keys'))):
+    pass
+
+
+class BuiltChange(namedtuple('_BuiltChange', ('id', 'builds'))):
+    pass
+
+
+def _bc(chid, build_url='http://build/{0}'):
+    return BuiltChange(chid, BuildsList([BuildPtr(
+        'build', 'http://build', build_url=build_url.format(chid),
+    )]))
+
+
 class TestChangeQueue(object):
     @pytest.mark.parametrize(
         ('initq', 'add_arg', 'expq'),
@@ -146,6 +189,360 @@ class TestChangeQueue(object):
             assert bad_changes == found_bad
             assert attempts <= (ceil(log(num_changes, 2)) + 1) * num_bad
 
+    @pytest.mark.parametrize(
+        ('initq', 'ways', 'expq', 'exp_tests'),
+        [
+            ([[1, 2, 3, 4], [5]], 2, [[1, 2], [3, 4], [5]], [[1, 2]]),
+            (
+                [[1, 2, 3, 4], [5]], 4, [[1], [2], [3], [4], [5]],
+                [[1], [1, 2], [1, 2, 3]]
+            ),
+            (
+                [[1, 2, 3, 4, 5, 6], [7]], 3, [[1, 2], [3, 4], [5, 6], [7]],
+                [[1, 2], [1, 2, 3, 4]]
+            ),
+            ([[1, 2], [3]], 4, [[1], [2], [3]], [[1]]),
+        ]
+    )
+    def test_parallel_split(self, initq, ways, expq, exp_tests):
+        queue = ChangeQueue(initq, 'k1')
+        queue.bisect_ways = ways
+        queue.on_test_failure('k1')
+        assert expq == _enlist_state(queue._state)
+        assert len(exp_tests) == queue.tests_to_dispatch()
+        tests = [queue.get_next_test() for _ in exp_tests]
+        assert exp_tests == [test_list for _, test_list in tests]
+        assert len(set(test_key for test_key, _ in tests)) == len(tests)
+        assert all(queue.test_key_match(test_key) for test_key, _ in tests)
+        assert 1 == queue.tests_to_dispatch()
+        # Once all tests were handed out we get the 1st one again
+        assert tests[0] == queue.get_next_test()
+
+    def test_parallel_results(self):
+        queue = ChangeQueue([[1, 2, 3, 4, 5, 6, 7, 8], [9]], 'k1')
+        queue.bisect_ways = 4
+        queue.on_test_failure('k1')
+        keys = [queue.get_next_test()[0] for _ in range(3)]
+        # Prefix [1..6] failed, so the test of [1..8] is moot
+        assert ([], [], None) == queue.on_test_failure(keys[2])
+        assert not queue.test_key_match(keys[2])
+        # Prefix [1..2] passed
+        assert ([1, 2], [], None) == queue.on_test_success(keys[0])
+        assert not queue.test_key_match(keys[0])
+        # The test for [1..4] now tests the head of the queue
+        assert queue.test_key_match(keys[1])
+        assert keys[1] == queue._test_key
+        # [3, 4] passed so the failure is in [5, 6]
+        assert ([3, 4], [], None) == queue.on_test_success(keys[1])
+        assert [[5], [6], [7, 8], [9]] == _enlist_state(queue._state)
+        test_key, test_list = queue.get_next_test()
+        assert [5] == test_list
+        assert ([5], [6], 6) == queue.on_test_success(test_key)
+        assert [[7, 8, 9]] == _enlist_state(queue._state)
+        _assert_index_in_sync(queue)
+
+    @pytest.mark.parametrize('ways', [3, 4, 8])
+    def test_parallel_bad_search(self, ways):
+        num_changes = 64
+        for time in range(1, 20):
+            bad_change = random.randrange(num_changes)
+            queue = ChangeQueue([range(0, num_changes)])
+            queue.bisect_ways = ways
+            rounds = 0
+            while True:
+                rounds += 1
+                tests = [
+                    queue.get_next_test()
+                    for _ in range(queue.tests_to_dispatch())
+                ]
+                random.shuffle(tests)
+                fail_list = []
+                for test_key, test_list in tests:
+                    if bad_change in test_list:
+                        _, fail_list, _ = queue.on_test_failure(test_key)
+                    else:
+                        _, fail_list, _ = queue.on_test_success(test_key)
+                    _assert_index_in_sync(queue)
+                    if fail_list:
+                        break
+                if fail_list:
+                    break
+            assert [bad_change] == fail_list
+            assert rounds <= ceil(log(num_changes, ways)) + 1
+
+    def test_speculation(self):
+        queue = ChangeQueue()
+        queue.speculation_depth = 2
+        queue.add(1)
+        k1, cl1 = queue.get_next_test()
+        assert [1] == cl1
+        # Nothing new to speculate on
+        assert (k1, cl1) == queue.get_next_test()
+        queue.add(2)
+        queue.add(3)
+        assert 1 == queue.tests_to_dispatch()
+        k2, cl2 = queue.get_next_test()
+        assert [1, 2, 3] == cl2
+        queue.add(4)
+        k3, cl3 = queue.get_next_test()
+        assert [1, 2, 3, 4] == cl3
+        queue.add(5)
+        # Speculation depth reached
+        assert (k1, cl1) == queue.get_next_test()
+        assert [[1], [2, 3], [4], [5]] == _enlist_state(queue._state)
+        assert ([1], [], None) == queue.on_test_success(k1)
+        assert k2 == queue._test_key
+        assert ([2, 3, 4], [], None) == queue.on_test_success(k3)
+        assert not queue.test_key_match(k2)
+        assert [[5]] == _enlist_state(queue._state)
+        _assert_index_in_sync(queue)
+
+    def test_speculation_after_failure(self):
+        queue = ChangeQueue()
+        queue.speculation_depth = 1
+        queue.add(1)
+        queue.add(2)
+        k1, _ = queue.get_next_test()
+        queue.add(3)
+        k2, cl2 = queue.get_next_test()
+        assert [1, 2, 3] == cl2
+        assert ([], [], None) == queue.on_test_failure(k1)
+        # Speculative test is discarded when the test it built on fails
+        assert not queue.test_key_match(k2)
+        assert ([], [], None) == queue.on_test_success(k2)
+        assert [[1], [2], [3], []] == _enlist_state(queue._state)
+        queue.add(4)
+        # No speculation while bisecting
+        k3, cl3 = queue.get_next_test()
+        assert [1] == cl3
+        assert (k3, cl3) == queue.get_next_test()
+        assert ([1], [2], 2) == queue.on_test_success(k3)
+        assert [[3, 4]] == _enlist_state(queue._state)
+        _assert_index_in_sync(queue)
+
+    def test_index_in_sync(self):
+        for time in range(1, 20):
+            queue = ChangeQueue()
+            bad_changes = set(random.sample(range(0, 40), 3))
+            for change in range(0, 40):
+                queue.add(change)
+                _assert_index_in_sync(queue)
+                if random.random() < 0.7:
+                    continue
+                test_key, test_list = queue.get_next_test()
+                _assert_index_in_sync(queue)
+                if bad_changes & set(test_list):
+                    queue.on_test_failure(test_key)
+                else:
+                    queue.on_test_success(test_key)
+                _assert_index_in_sync(queue)
+
+    @pytest.mark.parametrize(
+        ('initq', 'change_id', 'exp_loc'),
+        [
+            ([[]], 1, None),
+            ([[1, 2], [3]], 1, (0, 0)),
+            ([[1, 2], [3]], 2, (0, 1)),
+            ([[1, 2], [3]], 3, (1, 0)),
+            ([[1, 2], [3]], 4, None),
+            ([[1], [2, 1]], 1, (0, 0)),
+        ]
+    )
+    def test_locate(self, initq, change_id, exp_loc):
+        queue = ChangeQueue(initq)
+        assert exp_loc == queue.locate(change_id)
+
+    def test_locate_after_bisect(self):
+        queue = ChangeQueue([[1, 2, 3, 4], [5]], 'k1')
+        queue.on_test_failure('k1')
+        assert [[1, 2], [3, 4], [5]] == _enlist_state(queue._state)
+        assert (1, 1) == queue.locate(4)
+        assert (2, 0) == queue.locate(5)
+        test_key, _ = queue.get_next_test()
+        queue.on_test_success(test_key)
+        assert [[3], [4], [5]] == _enlist_state(queue._state)
+        assert queue.locate(1) is None
+        assert (1, 0) == queue.locate(4)
+        queue.add(6)
+        assert (2, 1) == queue.locate(6)
+        _assert_index_in_sync(queue)
+
+    def test_pickle(self):
+        queue = ChangeQueue([[1, 2], [3]], 'k1')
+        queue.on_test_failure('k1')
+        pkl = pickle.dumps(queue)
+        # The index should not be pickled, so pickles stay compatible with
+        # older versions of the class
+        assert '_change_index' not in pickle.loads(pkl).__getstate__()
+        loaded = pickle.loads(pkl)
+        assert _enlist_state(queue._state) == _enlist_state(loaded._state)
+        assert (1, 0) == loaded.locate(2)
+        _assert_index_in_sync(loaded)
+
+    def test_unpickle_old_state(self):
+        # Emulate a queue that was pickled before the index was introduced
+        queue = ChangeQueue.__new__(ChangeQueue)
+        queue.__dict__.update(
+            _state=deque([deque([1]), deque([2, 3])]), _test_key='k1'
+        )
+        pkl = pickle.dumps(queue)
+        loaded = pickle.loads(pkl)
+        assert (1, 1) == loaded.locate(3)
+        loaded.on_test_failure('k1')
+        assert [[2, 3]] == _enlist_state(loaded._state)
+        _assert_index_in_sync(loaded)
+
+    def test_priority_lanes(self):
+        queue = ChangeQueue()
+        changes = [1, _pc(2, 1), 3, _pc(4, 2), _pc(5, 1)]
+        for change in changes:
+            queue.add(change)
+        assert [[1, 3]] == _enlist_state(queue._state)
+        assert [
+            (2, [_pc(4, 2)]), (1, [_pc(2, 1), _pc(5, 1)])
+        ] == queue.priority_changes()
+        test_key, test_list = queue.get_next_test()
+        assert [_pc(4, 2)] == test_list
+        assert [] == queue.priority_changes()
+        _assert_index_in_sync(queue)
+        queue.add(_pc(6, 3))
+        # Lanes are not started while lane changes are tested
+        assert (test_key, test_list) == queue.get_next_test()
+        assert ([_pc(4, 2)], [], None) == queue.on_test_success(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [_pc(2, 1), _pc(5, 1)] == test_list
+        assert ([], [], None) == queue.on_test_failure(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [_pc(2, 1)] == test_list
+        assert ([_pc(2, 1)], [_pc(5, 1)], _pc(5, 1)) == \
+            queue.on_test_success(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [_pc(6, 3)] == test_list
+        queue.on_test_success(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [1, 3] == test_list
+        _assert_index_in_sync(queue)
+
+    def test_priority_lanes_during_bisection(self):
+        queue = ChangeQueue()
+        for change in range(1, 9):
+            queue.add(change)
+        test_key, _ = queue.get_next_test()
+        queue.on_test_failure(test_key)
+        assert 2 == queue._failing_prefix
+        queue.add(_pc(10, 1))
+        queue.add(_pc(11, 1))
+        test_key, test_list = queue.get_next_test()
+        assert [_pc(10, 1), _pc(11, 1)] == test_list
+        assert 0 == queue._failing_prefix
+        # Lane failures are bisected without losing what we know about the
+        # rest of the queue
+        queue.on_test_failure(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [_pc(10, 1)] == test_list
+        assert ([_pc(10, 1)], [_pc(11, 1)], _pc(11, 1)) == \
+            queue.on_test_success(test_key)
+        assert 2 == queue._failing_prefix
+        assert [[1, 2, 3, 4], [5, 6, 7, 8], []] == \
+            _enlist_state(queue._state)
+        _assert_index_in_sync(queue)
+        test_key, test_list = queue.get_next_test()
+        assert [1, 2, 3, 4] == test_list
+        assert ([1, 2, 3, 4], [], None) == queue.on_test_success(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [5, 6] == test_list
+
+    def test_priority_lanes_pickle(self):
+        queue = ChangeQueue()
+        queue.add(1)
+        queue.add(_pc(2, 1))
+        loaded = pickle.loads(pickle.dumps(queue))
+        assert '_lane_index' not in loaded.__getstate__()
+        assert [(1, [_pc(2, 1)])] == loaded.priority_changes()
+        assert 1 == loaded._lane_index[2]
+        # Queues pickled before priority lanes were introduced get empty lanes
+        state = queue.__getstate__()
+        for attr in (
+            '_priority_lanes', '_lane_sections', '_suspended_prefix',
+            '_batch_model', '_failure_estimator',
+        ):
+            del state[attr]
+        old_queue = ChangeQueue.__new__(ChangeQueue)
+        old_queue.__setstate__(state)
+        assert [] == old_queue.priority_changes()
+        assert [1] == old_queue.get_next_test()[1]
+
+    def test_adaptive_batching(self):
+        queue = ChangeQueue()
+        queue._batch_model.min_history = 4
+        for change in range(1, 9):
+            queue.add(change)
+        # Batch sizes are not limited until the model saw enough changes
+        queue.adaptive_batching = True
+        test_key, test_list = queue.get_next_test()
+        assert list(range(1, 9)) == test_list
+        queue.on_test_failure(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert ([1, 2, 3, 4], [], None) == queue.on_test_success(test_key)
+        for _ in range(2):
+            test_key, test_list = queue.get_next_test()
+            queue.on_test_failure(test_key)
+        assert [5] == test_list
+        assert 0.2 == queue._batch_model.failure_rate
+        for change in range(9, 30):
+            queue.add(change)
+        test_key, test_list = queue.get_next_test()
+        assert [6, 7, 8, 9] == test_list
+        assert [[6, 7, 8, 9], list(range(10, 30))] == \
+            _enlist_state(queue._state)
+        _assert_index_in_sync(queue)
+        queue.on_test_success(test_key)
+        queue.adaptive_batching = False
+        test_key, test_list = queue.get_next_test()
+        assert list(range(10, 30)) == test_list
+        loaded = pickle.loads(pickle.dumps(queue))
+        assert 1 / 9.0 == pytest.approx(loaded._batch_model.failure_rate)
+
+    @pytest.mark.parametrize(('risk_weighted', 'exp_runs'), [
+        (False, 5), (True, 3),
+    ])
+    def test_risk_weighted_bisection(self, risk_weighted, exp_runs):
+        queue = ChangeQueue()
+        for chid in range(40):
+            queue._failure_estimator.record_outcome(
+                RiskyChange(chid, ('safe',)), False
+            )
+            queue._failure_estimator.record_outcome(
+                RiskyChange(chid, ('risky',)), chid % 2 == 0
+            )
+        queue.risk_weighted_bisection = risk_weighted
+        changes = [RiskyChange(chid, ('safe',)) for chid in range(15)]
+        changes.insert(10, RiskyChange(15, ('risky',)))
+        for change in changes:
+            queue.add(change)
+        runs = 0
+        while True:
+            test_key, test_list = queue.get_next_test()
+            runs += 1
+            if any(chg.id == 15 for chg in test_list):
+                _, fail_list, _ = queue.on_test_failure(test_key)
+            else:
+                _, fail_list, _ = queue.on_test_success(test_key)
+            if fail_list:
+                break
+        assert [15] == [chg.id for chg in fail_list]
+        assert exp_runs == runs
+        _assert_index_in_sync(queue)
+        # The outcome is recorded
+        assert 21 == queue._failure_estimator._counts['risky'][0]
+
+
+def _assert_dep_graph_in_sync(queue):
+    """Verify the queue's dependency graph matches its state"""
+    out_graph = queue._dependants
+    queue._rebuild_dep_graph()
+    assert queue._dependants == out_graph
+
 
 class ChangeWithDeps(namedtuple('_ChangeWithDeps', ('id', 'requirements'))):
     @classmethod
@@ -208,6 +605,16 @@ def test_c2adep(change, exp_c_d_pair):
     assert exp_c_d_pair == out
 
 
+class PriorityChangeWithDeps(namedtuple(
+    '_PriorityChangeWithDeps', ('id', 'requirements', 'priority')
+)):
+    pass
+
+
+def _pcd(chid, requirements, priority):
+    return PriorityChangeWithDeps(chid, set(requirements), priority)
+
+
 class TestChangeQueueWithDeps(object):
     @pytest.mark.parametrize(
         ('change', 'exp'),
@@ -237,27 +644,6 @@ class TestChangeQueueWithDeps(object):
         out_deps = queue._get_missing_deps(_cwds_fv(change))
         assert set(exp_deps) == set(out_deps)
 
-    @pytest.mark.parametrize(
-        ('change_id', 'changes', 'exp_deps'),
-        [
-            (0, [], []),
-            (0, [0, 1, 2], []),
-            (0, [0, '1r0', '2r3'], [1]),
-            (0, [0, '1r0', '2r0', 3], [1, 2]),
-            (0, ['0r3,4', '1r0', '2r0', 3], [1, 2]),
-            (0, ['0r0', '1r0', '2r0', 3], [0, 1, 2]),
-            (0, ['0r1', '1r0', '2r0', 3], [0, 1, 2]),
-            (0, ['0r1', '1r2', '2r0', '3r1'], [0, 1, 2, 3]),
-            (0, ['0r1,4', '1r2', '2r0', '3r1', 4], [0, 1, 2, 3]),
-            (0, ['0r1,4,5', '1r2', '2r0', '3r1', '4r5'], [0, 1, 2, 3]),
-        ]
-    )
-    def test_find_dependants_on(self, change_id, changes, exp_deps):
-        deps = ChangeQueueWithDeps._find_dependants_on(
-            change_id, map(_cwds_fv, changes)
-        )
-        assert set(exp_deps) == set(deps)
-
     @pytest.mark.parametrize(
         ('adeps', 'dep_ids', 'exp_out', 'exp_a_deps'),
         [
@@ -272,6 +658,22 @@ class TestChangeQueueWithDeps(object):
         assert list(map(_c2adep, exp_out)) == out
         assert list(map(_c2adep, exp_a_deps)) == list(queue._awaiting_deps)
 
+    def test_awaiting_deps(self):
+        adeps = AwaitingDeps(map(_c2adep, ['1r5', '2r5,6', '3r6', '4r7']))
+        assert [_c2adep('1r5'), _c2adep('2r5,6')] == adeps.waiting_for(5)
+        assert [] == adeps.waiting_for(1)
+        assert [_c2adep('2r5,6')] == adeps.remove_by_ids([2, 8])
+        assert [_c2adep('3r6')] == adeps.waiting_for(6)
+        adeps.append(_c2adep('2r6'))
+        assert [_c2adep('3r6'), _c2adep('2r6')] == adeps.waiting_for(6)
+        assert [_c2adep('1r5'), _c2adep('3r6')] == adeps.remove_by_ids([3, 1])
+        loaded = pickle.loads(pickle.dumps(adeps))
+        for awaiting in (adeps, loaded):
+            assert 2 == len(awaiting)
+            assert [_c2adep('4r7'), _c2adep('2r6')] == list(awaiting)
+            assert [_c2adep('2r6')] == awaiting.waiting_for(6)
+            assert [] == awaiting.waiting_for(5)
+
     @pytest.mark.parametrize(
         ('add_sequence', 'exp_state_ids', 'exp_loop_ids'),
         [
@@ -306,6 +708,7 @@ class TestChangeQueueWithDeps(object):
         assert exp_state_ids == \
             list(map(ChangeQueueWithDeps._change_id, queue._state[0]))
         assert exp_loop_ids == loop_ids
+        _assert_dep_graph_in_sync(queue)
 
     @pytest.mark.parametrize(
         ('initq', 'initwd', 'expfl', 'expq', 'expwd'),
@@ -345,6 +748,223 @@ class TestChangeQueueWithDeps(object):
         assert [list(map(_cwds_fv, s)) for s in expq] == \
             _enlist_state(queue._state)
         assert list(map(_c2adep, expwd)) == list(queue._awaiting_deps)
+        _assert_index_in_sync(queue)
+        _assert_dep_graph_in_sync(queue)
+
+    def test_on_test_success(self):
+        queue = ChangeQueueWithDeps(
+            [[_cwds_fv(1), _cwds_fv('2r1')], [_cwds_fv('3r2')]], 'k1',
+            [_c2adep('4r3,5')]
+        )
+        outsl, outfl, _ = queue.on_test_success('k1')
+        assert [1, 2] == list(map(ChangeQueueWithDeps._change_id, outsl))
+        assert [] == outfl
+        assert {2: set([3]), 3: set([4]), 5: set([4])} == queue._dependants
+        _assert_dep_graph_in_sync(queue)
+
+    def test_unpickle_old_state(self):
+        # Emulate a queue that was pickled before the dependency graph was
+        # introduced
+        queue = ChangeQueueWithDeps.__new__(ChangeQueueWithDeps)
+        queue.__dict__.update(
+            _state=deque([deque([_cwds_fv(1)]), deque([_cwds_fv('2r1')])]),
+            _test_key='k1', _awaiting_deps=[_c2adep('3r2,4')],
+        )
+        loaded = pickle.loads(pickle.dumps(queue))
+        assert {1: set([2]), 2: set([3]), 4: set([3])} == loaded._dependants
+        _, outfl, _ = loaded.on_test_failure('k1')
+        assert [1, 2, 3] == list(map(ChangeQueueWithDeps._change_id, outfl))
+        assert {} == loaded._dependants
+
+    def test_priority_lanes(self):
+        queue = ChangeQueueWithDeps()
+        for change in [
+            _cwds_fv(1), _pcd(2, [1], 2), _pcd(3, [], 1), _pcd(4, [3], 2),
+            _pcd(5, [4], 3), _pcd(6, [7], 1), _pcd(7, [], 3),
+        ]:
+            queue.add(change)
+        # Changes are not tested before the changes they depend on
+        assert [[_cwds_fv(1), _pcd(2, [1], 2)]] == _enlist_state(queue._state)
+        assert [(3, [7]), (1, [3, 4, 5, 6])] == [
+            (priority, list(map(ChangeQueueWithDeps._change_id, changes)))
+            for priority, changes in queue.priority_changes()
+        ]
+        test_key, test_list = queue.get_next_test()
+        assert [7] == list(map(ChangeQueueWithDeps._change_id, test_list))
+        queue.on_test_success(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [3, 4, 5, 6] == \
+            list(map(ChangeQueueWithDeps._change_id, test_list))
+        for _ in range(2):
+            queue.on_test_failure(test_key)
+            test_key, test_list = queue.get_next_test()
+        assert [3] == list(map(ChangeQueueWithDeps._change_id, test_list))
+        _, outfl, _ = queue.on_test_failure(test_key)
+        # Dependants of failed lane changes are removed
+        assert [3, 4, 5] == list(map(ChangeQueueWithDeps._change_id, outfl))
+        test_key, test_list = queue.get_next_test()
+        assert [6] == list(map(ChangeQueueWithDeps._change_id, test_list))
+        _assert_index_in_sync(queue)
+        _assert_dep_graph_in_sync(queue)
+
+    def test_priority_lanes_with_speculation(self):
+        queue = ChangeQueueWithDeps()
+
+        def state_ids():
+            return [
+                list(map(ChangeQueueWithDeps._change_id, section))
+                for section in queue._state
+            ]
+        queue.speculation_depth = 2
+        queue.add(_cwds_fv(1))
+        k1, _ = queue.get_next_test()
+        queue.add(_cwds_fv(2))
+        k2, _ = queue.get_next_test()
+        assert ([_pcd(3, [], 1)], []) == queue.add(_pcd(3, [], 1))
+        # Changes that require lane changes are held back, along with their
+        # own dependants
+        assert ([_cwds_fv('4r3')], []) == queue.add(_cwds_fv('4r3'))
+        assert ([_cwds_fv('5r4')], []) == queue.add(_cwds_fv('5r4'))
+        assert ([_cwds_fv(6)], []) == queue.add(_cwds_fv(6))
+        assert [[1], [2], [6]] == state_ids()
+        # No speculative tests are started while changes wait in the lanes
+        assert 1 == queue.tests_to_dispatch()
+        assert k1 == queue.get_next_test()[0]
+        merged = list(queue.on_test_success(k1)[0])
+        assert k2 == queue.get_next_test()[0]
+        merged.extend(queue.on_test_success(k2)[0])
+        # The lanes start once the running tests are done
+        test_key, test_list = queue.get_next_test()
+        assert [_pcd(3, [], 1)] == test_list
+        assert [[3], [6, 4, 5]] == state_ids()
+        assert not queue._awaiting_deps
+        merged.extend(queue.on_test_success(test_key)[0])
+        test_key, test_list = queue.get_next_test()
+        merged.extend(queue.on_test_success(test_key)[0])
+        assert [1, 2, 3, 6, 4, 5] == \
+            list(map(ChangeQueueWithDeps._change_id, merged))
+        _assert_index_in_sync(queue)
+        _assert_dep_graph_in_sync(queue)
+
+    def test_held_back_dependants_of_failed_lane_changes(self):
+        queue = ChangeQueueWithDeps()
+        queue.add(_cwds_fv(1))
+        test_key, _ = queue.get_next_test()
+        queue.add(_pcd(2, [], 1))
+        assert ([_cwds_fv('3r2')], []) == queue.add(_cwds_fv('3r2'))
+        queue.on_test_success(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [_pcd(2, [], 1)] == test_list
+        _, outfl, _ = queue.on_test_failure(test_key)
+        assert [2, 3] == list(map(ChangeQueueWithDeps._change_id, outfl))
+        assert not queue._awaiting_deps
+        assert not queue._held_back
+        _assert_dep_graph_in_sync(queue)
+
+    def test_lane_emptied_by_dependant_removal(self):
+        queue = ChangeQueueWithDeps()
+        for change in [1, 2]:
+            queue.add(_cwds_fv(change))
+            test_key, _ = queue.get_next_test()
+            queue.on_test_success(test_key)
+        queue.add(_pcd(10, [], 1))
+        queue.add(_pcd(11, [10], 1))
+        test_key, test_list = queue.get_next_test()
+        assert [10, 11] == list(map(ChangeQueueWithDeps._change_id, test_list))
+        queue.on_test_failure(test_key)
+        test_key, test_list = queue.get_next_test()
+        assert [10] == list(map(ChangeQueueWithDeps._change_id, test_list))
+        queue.add(_cwds_fv(3))
+        _, outfl, _ = queue.on_test_failure(test_key)
+        assert [10, 11] == list(map(ChangeQueueWithDeps._change_id, outfl))
+        # The lane section of the removed dependant is dropped, so the queue
+        # does not get stuck on it
+        assert [[_cwds_fv(3)]] == _enlist_state(queue._state)
+        assert 0 == queue._lane_sections
+        test_key, test_list = queue.get_next_test()
+        assert test_key is not None
+        assert [_cwds_fv(3)] == test_list
+        _assert_index_in_sync(queue)
+        _assert_dep_graph_in_sync(queue)
+
+    @pytest.mark.parametrize('num_changes', [1000, 4000])
+    def test_scaling(self, num_changes, monkeypatch):
+        """Benchmark queue operations with thousands of changes
+
+        The work done per change is measured by counting change ID lookups,
+        it should not grow with the size of the queue.
+        """
+        id_lookups = [0]
+        orig_change_id = ChangeQueueWithDeps._change_id
+
+        def counting_change_id(change):
+            id_lookups[0] += 1
+            return orig_change_id(change)
+        monkeypatch.setattr(
+            ChangeQueueWithDeps, '_change_id', staticmethod(counting_change_id)
+        )
+        rnd = random.Random(num_changes)
+        queue = ChangeQueueWithDeps()
+        start = time()
+        for chid in range(num_changes):
+            if chid % 100 == 51:
+                # Avoid making a dependency loop with the change below
+                reqs = set(rnd.sample(range(chid - 1), 2))
+            else:
+                reqs = set(rnd.sample(range(chid), min(chid, 2)))
+            if chid % 100 == 50:
+                # Make some changes wait for a change that is added later
+                reqs.add(chid + 1)
+            queue.add(ChangeWithDeps(chid, reqs))
+        add_time = time() - start
+        assert not queue._awaiting_deps
+        assert id_lookups[0] <= num_changes * 10
+        id_lookups[0] = 0
+        start = time()
+        bad_change = num_changes // 2
+        while True:
+            test_key, test_list = queue.get_next_test()
+            if bad_change in set(c.id for c in test_list):
+                _, fail_list, _ = queue.on_test_failure(test_key)
+            else:
+                _, fail_list, _ = queue.on_test_success(test_key)
+            if fail_list:
+                break
+        bisect_time = time() - start
+        assert bad_change == fail_list[0].id
+        assert id_lookups[0] <= num_changes * 10
+        print('{0} changes: add {1:.3f}s, bisect {2:.3f}s'.format(
+            num_changes, add_time, bisect_time
+        ))
+
+    @pytest.mark.parametrize('num_changes', [1000, 4000])
+    def test_awaiting_deps_scaling(self, num_changes, monkeypatch):
+        """Benchmark adding changes that many other changes wait for
+        """
+        id_lookups = [0]
+        orig_change_id = ChangeQueue._change_id
+
+        def counting_change_id(change):
+            id_lookups[0] += 1
+            return orig_change_id(change)
+        monkeypatch.setattr(
+            ChangeQueue, '_change_id', staticmethod(counting_change_id)
+        )
+        queue = ChangeQueueWithDeps()
+        for chid in range(num_changes):
+            queue.add(ChangeWithDeps(chid, set([num_changes + chid])))
+        assert num_changes == len(queue._awaiting_deps)
+        id_lookups[0] = 0
+        start = time()
+        for chid in range(num_changes):
+            queue.add(ChangeWithDeps(num_changes + chid, set()))
+        release_time = time() - start
+        assert not queue._awaiting_deps
+        assert 2 * num_changes == len(queue._state[0])
+        assert id_lookups[0] <= num_changes * 10
+        print('{0} changes: release {1:.3f}s'.format(
+            num_changes, release_time
+        ))
 
 
 class TestChangeQueueWithStreams(object):
@@ -511,6 +1131,547 @@ class TestJenkinsChangeQueue(object):
         with JenkinsChangeQueue.persist_in_artifacts() as queue:
             assert [changes * 2] == _enlist_state(queue._state)
 
+    @pytest.mark.parametrize(
+        ('ways', 'exp_slots'),
+        [(None, None), ('2', None), ('4', ['0', '1', '2'])]
+    )
+    def test_schedule_tester_run(self, jenkins_env, monkeypatch, ways,
+                                 exp_slots):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        if ways is not None:
+            monkeypatch.setenv('CQ_BISECT_WAYS', ways)
+        jcq = JenkinsChangeQueue([[1, 2, 3, 4], [5]], 'k1')
+        jcq.on_test_failure('k1')
+        jcq._schedule_tester_run()
+        with open('build_args.json') as fil:
+            build_args = json.load(fil)
+        if exp_slots is None:
+            assert 'some_change-queue-tester' == build_args['job']
+            assert [] == build_args['parameters']
+        else:
+            assert exp_slots == [
+                ba['parameters'][0]['value'] for ba in build_args
+            ]
+
+    @pytest.mark.parametrize(
+        ('max_window', 'arrivals', 'durations', 'exp_window'),
+        [
+            (None, [0, 2, 4], [], 0),
+            ('60', [4], [], 0),
+            ('60', [0, 2, 4], [], 8),
+            ('60', [0, 2, 4], [100], 8),
+            ('60', [0, 2, 4], [20], 5),
+            ('60', [0, 0, 0], [], 4),
+            ('60', [0, 100, 200], [], 0),
+            ('60', [0, 10, 20], [20], 0),
+            ('60', [0, 1000, 1003, 1006, 1009], [], 12),
+            ('10', [0, 3, 6], [], 10),
+        ]
+    )
+    def test_coalescing_window(
+        self, monkeypatch, max_window, arrivals, durations, exp_window
+    ):
+        if max_window is not None:
+            monkeypatch.setenv('CQ_COALESCING_WINDOW', max_window)
+        jcq = JenkinsChangeQueue()
+        jcq._arrival_times.extend(arrivals)
+        jcq._test_durations.extend(durations)
+        assert exp_window == jcq._coalescing_window()
+
+    def test_coalesced_tester_run(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setenv('CQ_COALESCING_WINDOW', '60')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        times = iter([0, 2, 4, 10, 110, 120, 122])
+        monkeypatch.setattr(
+            'stdci_libs.change_queue.time', lambda: next(times)
+        )
+
+        def quiet_period():
+            with open('build_args.json') as fil:
+                return json.load(fil).get('quietPeriod')
+        self._act('add', 1)
+        assert quiet_period() is None
+        self._act('add', 2)
+        assert 8 == quiet_period()
+        self._act('add', 3)
+        assert 8 == quiet_period()
+        queue = self._act('get_next_test')
+        assert [1, 2, 3] == list(
+            JenkinsTestedChangeList.load_from_artifact().change_list
+        )
+        queue = self._act('on_test_success', queue._test_key)
+        assert [100] == list(queue._test_durations)
+        assert [(3, 100)] == list(queue._batch_model._durations)
+        assert {} == queue._test_start_times
+        # The long gap between the bursts does not affect the window
+        self._act('add', 4)
+        assert 8 == quiet_period()
+        queue = self._act('add', 5)
+        assert [0, 2, 4, 120, 122] == list(queue._arrival_times)
+        assert 8 == quiet_period()
+
+    @pytest.mark.parametrize(('env_value', 'expected'), [
+        (None, False), ('', False), ('no', False), ('yes', True),
+        ('True', True), ('1', True),
+    ])
+    @pytest.mark.parametrize(('env_var', 'attr'), [
+        ('CQ_ADAPTIVE_BATCHING', 'adaptive_batching'),
+        ('CQ_RISK_WEIGHTED_BISECTION', 'risk_weighted_bisection'),
+    ])
+    def test_env_flags(self, monkeypatch, env_var, attr, env_value, expected):
+        if env_value is None:
+            monkeypatch.delenv(env_var, raising=False)
+        else:
+            monkeypatch.setenv(env_var, env_value)
+        assert expected == getattr(JenkinsChangeQueue(), attr)
+
+    def test_coalescing_while_testing(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setenv('CQ_COALESCING_WINDOW', '60')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        times = iter(range(0, 100, 2))
+        monkeypatch.setattr(
+            'stdci_libs.change_queue.time', lambda: next(times)
+        )
+        self._act('add', 1)
+        self._act('add', 2)
+        self._act('get_next_test')
+        self._act('add', 3)
+        # Changes arriving while a test is running do not delay the tester
+        with open('build_args.json') as fil:
+            assert 'quietPeriod' not in json.load(fil)
+
+    @staticmethod
+    def _act(action, arg=None, actor_url=None):
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            if action == 'add':
+                arg = queue.object_to_param_str(arg)
+            queue.act_on_job_params(action, arg, actor_url)
+            return queue
+
+    def test_journal(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        snapshot = jenkins_env.worspace / 'exported-artifacts' / \
+            'JenkinsChangeQueue.dat'
+        journal = jenkins_env.worspace / 'exported-artifacts' / \
+            'JenkinsChangeQueue.journal'
+        for change in [1, 2, 3]:
+            self._act('add', change)
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        test_key = queue._test_key
+        tested_changes = JenkinsTestedChangeList.load_from_artifact()
+        assert test_key == tested_changes.test_key
+        queue = self._act('on_test_failure', test_key, 'http://tester/1')
+        assert [[1], [2, 3], []] == _enlist_state(queue._state)
+        queue = self._act('get_next_test', actor_url='http://tester/2')
+        test_key = queue._test_key
+        assert not snapshot.exists()
+        assert 6 == len(journal.readlines())
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[1], [2, 3], []] == _enlist_state(queue._state)
+            assert test_key == queue._test_key
+            assert 'http://tester/2' == queue._running_test_url
+            assert 'http://tester/1' == queue._last_failed_test
+            assert (0, 0) == queue.locate(1)
+            assert not queue._journal_pending
+        # A context with no actions saves a snapshot
+        assert snapshot.exists()
+        assert not journal.exists()
+        queue = self._act('on_test_success', test_key, 'http://tester/2')
+        assert [[2], [3], []] == _enlist_state(queue._state)
+        assert 1 == len(journal.readlines())
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[2], [3], []] == _enlist_state(queue._state)
+
+    def test_journal_settings(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setenv('CQ_BISECT_WAYS', '3')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        for change in [1, 2, 3, 4, 5, 6]:
+            self._act('add', change)
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        queue = self._act('on_test_failure', queue._test_key)
+        assert [[1, 2], [3, 4], [5, 6], []] == _enlist_state(queue._state)
+        test_keys = set()
+        for _ in range(2):
+            self._act('get_next_test')
+            tested_changes = JenkinsTestedChangeList.load_from_artifact()
+            test_keys.add(tested_changes.test_key)
+        journal = jenkins_env.worspace / 'exported-artifacts' / \
+            'JenkinsChangeQueue.journal'
+        assert all(
+            3 == json.loads(line)['settings']['bisect_ways']
+            for line in journal.readlines()
+        )
+        # Actions are replayed with the settings they were performed with
+        monkeypatch.setenv('CQ_BISECT_WAYS', '2')
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[1, 2], [3, 4], [5, 6], []] == \
+                _enlist_state(queue._state)
+            assert test_keys == \
+                set([queue._test_key]) | set(queue._prefix_tests)
+            assert 2 == queue.bisect_ways
+            queue.act_on_job_params('on_test_failure', queue._test_key)
+            assert [[1], [2], [3, 4], [5, 6], []] == \
+                _enlist_state(queue._state)
+
+    def test_batch(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        schedule = MagicMock(
+            side_effect=JenkinsChangeQueue._schedule_tester_run
+        )
+        monkeypatch.setattr(
+            JenkinsChangeQueue, '_schedule_tester_run',
+            lambda self, *args: schedule(self, *args),
+        )
+        client = JenkinsChangeQueueClient('some')
+        client.start_batch()
+        for change in [1, 2, 3]:
+            assert client.add(change) is None
+        run_spec = client.submit_batch()
+        assert 'some_change-queue' == run_spec.job_name
+        assert 'batch' == run_spec.params['QUEUE_ACTION']
+        assert client.submit_batch() is None
+        queue = self._act(
+            'batch', run_spec.params['ACTION_ARG'], 'http://adder/1'
+        )
+        assert [[1, 2, 3]] == _enlist_state(queue._state)
+        assert 1 == schedule.call_count
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        test_key = queue._test_key
+        client.start_batch()
+        client.on_test_failure(test_key, 'http://tester/1')
+        client.add(4)
+        queue = self._act('batch', client.submit_batch().params['ACTION_ARG'])
+        assert 2 == schedule.call_count
+        assert [[1], [2, 3], [4]] == _enlist_state(queue._state)
+        assert 'http://tester/1' == queue._last_failed_test
+        # The batch is journaled as separate actions
+        journal = jenkins_env.worspace / 'exported-artifacts' / \
+            'JenkinsChangeQueue.journal'
+        assert [
+            'add', 'add', 'add', 'get_next_test', 'on_test_failure', 'add'
+        ] == [json.loads(line)['action'] for line in journal.readlines()]
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[1], [2, 3], [4]] == _enlist_state(queue._state)
+        # A batch can end with asking for the next test
+        queue = self._act('batch', queue.object_to_param_str([
+            ('add', queue.object_to_param_str(5)),
+            ('get_next_test', '', 'http://tester/2'),
+        ]))
+        assert 'http://tester/2' == queue._running_test_url
+        assert [1] == list(
+            JenkinsTestedChangeList.load_from_artifact().change_list
+        )
+
+    @pytest.mark.parametrize('batch', [
+        [('get_next_test', ''), ('add', '')],
+        [('batch', '')],
+        [('nothing', '')],
+    ])
+    def test_invalid_batch(self, jenkins_env, monkeypatch, batch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        self._act('add', 1)
+        with pytest.raises(InvalidChangeQueueAction):
+            self._act('batch', JenkinsChangeQueue.object_to_param_str(batch))
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[1]] == _enlist_state(queue._state)
+            assert queue._test_key is None
+
+    def test_build_registry(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setenv(
+            'CQ_BUILD_REGISTRY', str(jenkins_env.worspace / 'builds.json')
+        )
+        JenkinsChangeQueue.verify_artifacts_dir()
+
+        def change(builds=BuildsList()):
+            chg = GitMergedChange('project1', 'master', '1234567')
+            chg.build_spec = 'el8'
+            chg.build_duration = 300
+            chg.builds = builds
+            chg.failed_recipients = ()
+            return chg
+        builds = _bc(1).builds
+        queue = JenkinsChangeQueue()
+        # Changes without builds have nothing to register
+        queue.act_on_job_params('add', queue.object_to_param_str(change()))
+        assert dict(entries=0, reuses=0, saved_time=0) == \
+            queue.build_registry.stats()
+        queue.act_on_job_params(
+            'add', queue.object_to_param_str(change(builds))
+        )
+        assert dict(entries=1, reuses=0, saved_time=0) == \
+            queue.build_registry.stats()
+        # Changes get the registered builds before they are enqueued to other
+        # queues
+        other_change = change()
+        assert other_change.set_builds_from_registry(queue.build_registry)
+        assert builds == other_change.builds
+        other_queue = JenkinsChangeQueue()
+        other_queue.act_on_job_params(
+            'add', other_queue.object_to_param_str(other_change)
+        )
+        assert builds == other_queue._state[0][0].builds
+        assert dict(entries=1, reuses=1, saved_time=300) == \
+            other_queue.build_registry.stats()
+        # Infra failures are not blamed on the builds
+        other_queue.act_on_job_params('get_next_test', '')
+        other_queue.act_on_job_params(
+            'on_test_infra_failure', other_queue._test_key
+        )
+        assert builds == other_queue.build_registry.attach(
+            change().build_key
+        )
+
+    def test_metrics_file(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setenv(
+            'CQ_METRICS_TEXTFILE_DIR', str(jenkins_env.worspace)
+        )
+        JenkinsChangeQueue.verify_artifacts_dir()
+        times = iter(range(0, 1000, 100))
+        monkeypatch.setattr(
+            'stdci_libs.change_queue.time', lambda: next(times)
+        )
+        metrics_file = jenkins_env.worspace / 'exported-artifacts' / \
+            JenkinsChangeQueue.METRICS_FILE
+        for change in [1, 2, 3]:
+            self._act('add', change)
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        metrics = metrics_file.read().splitlines()
+        assert 'change_queue_changes{queue="some",stream=""} 3' in \
+            metrics
+        assert 'change_queue_batch_size{queue="some"} 3' in metrics
+        self._act('on_test_success', queue._test_key, 'http://tester/1')
+        metrics = metrics_file.read().splitlines()
+        assert 'change_queue_batch_size{queue="some"} 0' in metrics
+        assert 'change_queue_time_in_queue_seconds_bucket' \
+            '{le="300",queue="some"} 2' in metrics
+        assert 'change_queue_time_in_queue_seconds_count{queue="some"} 3' \
+            in metrics
+        assert 'change_queue_time_in_queue_seconds_sum{queue="some"} 900.0' \
+            in metrics
+        assert 'change_queue_test_duration_seconds_sum{queue="some"} 100.0' \
+            in metrics
+        assert 'change_queue_action_duration_seconds_count' \
+            '{action="add",queue="some"} 3' in metrics
+        for gauge in (
+            'change_queue_state_load_seconds',
+            'change_queue_state_save_seconds',
+            'change_queue_state_bytes',
+        ):
+            assert any(line.startswith(gauge + '{') for line in metrics)
+        assert metrics_file.read() == \
+            (jenkins_env.worspace / 'some_change_queue.prom').read()
+        # Observations are kept when the queue is loaded from the journal
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert 3 == queue._time_in_queue.count
+            assert 1 == queue._test_duration_histogram.count
+            assert 3 == queue._action_durations['add'].count
+
+    def _test_result_cache_env(self, monkeypatch, times):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        JenkinsChangeQueue.verify_artifacts_dir()
+        times = iter(times)
+        monkeypatch.setattr(
+            'stdci_libs.change_queue.time', lambda: next(times)
+        )
+
+    def test_result_cache(self, jenkins_env, monkeypatch):
+        self._test_result_cache_env(monkeypatch, range(0, 1000, 10))
+        tested_file = jenkins_env.worspace / 'exported-artifacts' / \
+            'JenkinsTestedChangeList.dat'
+        for change in [_bc(1), _bc(2)]:
+            self._act('add', change)
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        self._act('on_test_failure', queue._test_key, 'http://tester/1')
+        queue = self._act('get_next_test', actor_url='http://tester/2')
+        self._act('on_test_failure', queue._test_key, 'http://tester/2')
+        queue = self._act('get_next_test', actor_url='http://tester/3')
+        assert [_bc(2)] == list(
+            JenkinsTestedChangeList.load_from_artifact().change_list
+        )
+        queue = self._act(
+            'on_test_success', queue._test_key, 'http://tester/3'
+        )
+        assert [[]] == _enlist_state(queue._state)
+        assert 3 == len(queue._result_cache)
+        # Changes with the same builds are not tested again
+        for change in [_bc(1), _bc(2)]:
+            self._act('add', change)
+        queue = self._act('get_next_test', actor_url='http://tester/4')
+        assert [[]] == _enlist_state(queue._state)
+        assert queue._test_key is None
+        assert not tested_file.exists()
+        assert 'http://tester/2' == queue._last_failed_test
+        assert 'http://tester/3' == queue._last_successful_test
+        # The reused results are in the journal
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[]] == _enlist_state(queue._state)
+            assert queue._test_key is None
+            assert 3 == len(queue._result_cache)
+        # Changes with other builds are tested
+        self._act('add', _bc(1, 'http://build/other-{0}'))
+        self._act('get_next_test', actor_url='http://tester/5')
+        assert tested_file.exists()
+
+    def test_result_cache_expiry(self, jenkins_env, monkeypatch):
+        self._test_result_cache_env(monkeypatch, range(0, 1000, 10))
+        monkeypatch.setattr(JenkinsChangeQueue, 'result_cache_ttl', 5)
+        self._act('add', _bc(1))
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        self._act('on_test_failure', queue._test_key, 'http://tester/1')
+        self._act('add', _bc(1))
+        queue = self._act('get_next_test', actor_url='http://tester/2')
+        assert [[_bc(1)], []] == _enlist_state(queue._state)
+        assert queue._test_key is not None
+
+    def test_result_cache_infra_failure(self, jenkins_env, monkeypatch):
+        self._test_result_cache_env(monkeypatch, range(0, 1000, 10))
+        self._act('add', _bc(1))
+        queue = self._act('get_next_test', actor_url='http://tester/1')
+        queue = self._act(
+            'on_test_infra_failure', queue._test_key, 'http://tester/1'
+        )
+        assert [[]] == _enlist_state(queue._state)
+        assert 'http://tester/1' == queue._last_failed_test
+        assert {} == queue._result_cache
+        self._act('add', _bc(1))
+        queue = self._act('get_next_test', actor_url='http://tester/2')
+        assert [[_bc(1)], []] == _enlist_state(queue._state)
+        # Infra failures make the queue forget earlier results
+        queue._cache_test_result(queue._test_key, 'success', None, 0)
+        assert 1 == len(queue._result_cache)
+        queue._cache_test_result(queue._test_key, None, None, 0)
+        assert {} == queue._result_cache
+
+    def test_result_cache_size(self, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setattr(JenkinsChangeQueue, 'result_cache_size', 2)
+        queue = JenkinsChangeQueue()
+        for now, change in enumerate([_bc(1), _bc(2), _bc(3), _bc(1)]):
+            queue.add(change)
+            test_key, change_list = queue.get_next_test()
+            queue._cache_test_result(test_key, 'success', None, now)
+            queue.on_test_success(test_key)
+        assert set([
+            ('some_change-queue-tester', (('build', 'http://build/3'),)),
+            ('some_change-queue-tester', (('build', 'http://build/1'),)),
+        ]) == set(queue._result_cache)
+        assert queue._cached_test_result([_bc(2)], 0) is None
+        assert queue._cached_test_result([_bc(3)], 0) is not None
+        assert queue._cached_test_result([1], 0) is None
+
+    def test_journal_compaction(self, jenkins_env, monkeypatch):
+        monkeypatch.setenv('JOB_BASE_NAME', 'some_change-queue')
+        monkeypatch.setattr(JenkinsChangeQueue, 'snapshot_interval', 3)
+        JenkinsChangeQueue.verify_artifacts_dir()
+        journal = jenkins_env.worspace / 'exported-artifacts' / \
+            'JenkinsChangeQueue.journal'
+        self._act('add', 1)
+        self._act('add', 2)
+        saved_journal = journal.read()
+        queue = self._act('add', 3)
+        assert not journal.exists()
+        assert 3 == queue._journal_seq
+        # Simulate failing after saving the snapshot but before removing the
+        # journal. Entries should not be applied twice
+        journal.write(saved_journal)
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[1, 2, 3]] == _enlist_state(queue._state)
+        queue = self._act('add', 4)
+        assert 4 == queue._journal_seq
+        assert 1 == len(journal.readlines())
+        with JenkinsChangeQueue.persist_in_artifacts() as queue:
+            assert [[1, 2, 3, 4]] == _enlist_state(queue._state)
+
+    def test_status_files(self, jenkins_env, monkeypatch):
+        monkeypatch.setattr(JenkinsChangeQueue, 'status_page_size', 2)
+        JenkinsChangeQueue.verify_artifacts_dir()
+        artifacts = jenkins_env.worspace / 'exported-artifacts'
+        jcq = JenkinsChangeQueue([[1, 2, 3], [4], [5, 6, 7]], 'k1')
+        jcq._awaiting_deps.append((8, set([9])))
+        jcq._write_status_file()
+        status = json.loads((artifacts / 'queue-status.json').read())
+        assert 8 == status['num_changes']
+        assert 'k1' == status['test_key']
+        assert [3, 1, 3] == status['batch_sizes']
+        assert 1 == status['num_awaiting_deps']
+        assert [
+            'queue-status-1.json', 'queue-status-2.json',
+            'queue-status-3.json', 'queue-status-4.json',
+        ] == status['pages']
+        pages = [
+            json.loads((artifacts / page).read()) for page in status['pages']
+        ]
+        assert [
+            (1, 'under_test', 0), (2, 'under_test', 0),
+            (3, 'under_test', 0), (4, 'sected_off', 1),
+            (5, 'untested', 2), (6, 'untested', 2), (7, 'untested', 2),
+            (8, 'awaiting_deps', None),
+        ] == [
+            (chg['id'], chg['section'], chg['batch'])
+            for page in pages for chg in page['changes']
+        ]
+        assert [9] == pages[-1]['changes'][-1]['awaiting_deps']
+        html = (artifacts / 'queue-status.html').read()
+        assert 2 == html.count('and 1 more')
+        # Nothing changed, so nothing gets written
+        monkeypatch.setattr(jcq, '_write_status_html', MagicMock())
+        jcq._write_status_file()
+        assert not jcq._write_status_html.called
+        # Status files are written if the HTML file is missing
+        (artifacts / 'queue-status.html').remove()
+        jcq._write_status_file()
+        assert jcq._write_status_html.called
+        # Pages are removed as the queue gets shorter
+        jcq.on_test_success('k1')
+        jcq._write_status_file()
+        assert 2 == jcq._write_status_html.call_count
+        status = json.loads((artifacts / 'queue-status.json').read())
+        assert 4 == status['num_changes']
+        assert 2 == len(status['pages'])
+        assert not (artifacts / 'queue-status-3.json').exists()
+        assert not (artifacts / 'queue-status-4.json').exists()
+
+    def test_priority_status(self, jenkins_env):
+        JenkinsChangeQueue.verify_artifacts_dir()
+        artifacts = jenkins_env.worspace / 'exported-artifacts'
+        jcq = JenkinsChangeQueue([[1, 2]])
+        jcq.add(_pc(3, 1))
+        jcq.add(_pc(4, 2))
+        jcq._write_status_file()
+        status = json.loads((artifacts / 'queue-status.json').read())
+        assert 4 == status['num_changes']
+        assert [[2, 1], [1, 1]] == status['priority_lane_sizes']
+        page = json.loads((artifacts / status['pages'][0]).read())
+        assert [
+            (4, 'priority', 2), (3, 'priority', 1), (1, 'untested', None),
+            (2, 'untested', None),
+        ] == [
+            (chg['id'], chg['section'], chg.get('priority'))
+            for chg in page['changes']
+        ]
+        html = (artifacts / 'queue-status.html').read()
+        assert 'Priority changes' in html
+
+    def test_status_template_cache(self, jenkins_env, monkeypatch, tmpdir):
+        cache_dir = tmpdir / 'template-cache'
+        cache_dir.mkdir()
+        monkeypatch.setenv('CQ_TEMPLATE_CACHE_DIR', str(cache_dir))
+        monkeypatch.delattr(JenkinsChangeQueue, '_jinja_env', raising=False)
+        try:
+            JenkinsChangeQueue.verify_artifacts_dir()
+            JenkinsChangeQueue([[1, 2]])._write_status_file()
+            assert cache_dir.listdir()
+        finally:
+            del JenkinsChangeQueue._jinja_env
+
     def test_report_change_status(self):
         qname = 'some-queue-name'
         states = ('successful', 'failed', 'added', 'rejected')
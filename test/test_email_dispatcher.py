@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""test_email_dispatcher.py - Tests for email_dispatcher.py
+"""
+from __future__ import absolute_import, print_function
+import pytest
+from email.mime.text import MIMEText
+from threading import Thread, Lock
+import socket
+
+from stdci_libs.email_dispatcher import EmailDispatcher
+from stdci_libs.change_queue.changes import NumberChange
+
+smtpd = pytest.importorskip('smtpd')
+asyncore = pytest.importorskip('asyncore')
+
+
+class SinkServer(smtpd.SMTPServer):
+    def __init__(self, *args, **kwargs):
+        smtpd.SMTPServer.__init__(self, *args, **kwargs)
+        self.lock = Lock()
+        self.connections = 0
+        self.messages = []
+
+    def handle_accepted(self, conn, addr):
+        with self.lock:
+            self.connections += 1
+        smtpd.SMTPServer.handle_accepted(self, conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        with self.lock:
+            self.messages.append((mailfrom, tuple(rcpttos), data))
+
+
+@pytest.fixture
+def smtp_sink():
+    """Run a local SMTP server that stores the messages it receives"""
+    server = SinkServer(('127.0.0.1', 0), None)
+    server.host = '{0}:{1}'.format(*server.socket.getsockname())
+    thread = Thread(
+        target=asyncore.loop, kwargs=dict(timeout=0.05, map=server._map)
+    )
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.close()
+    asyncore.close_all(map=server._map)
+    thread.join()
+
+
+def make_msg(num, recipients):
+    msg = MIMEText('Message {0}'.format(num))
+    msg['From'] = 'jenkins@example.com'
+    msg['To'] = ', '.join(recipients)
+    msg['Subject'] = 'Message {0}'.format(num)
+    return msg
+
+
+def test_send_and_flush(smtp_sink):
+    dispatcher = EmailDispatcher(max_connections=2)
+    for num in range(10):
+        dispatcher.send(smtp_sink.host, make_msg(num, ['a@example.com']))
+    for num in range(10, 20):
+        dispatcher.send(
+            smtp_sink.host, make_msg(num, ['b@example.com', 'c@example.com'])
+        )
+    assert not smtp_sink.messages
+    dispatcher.flush()
+    assert 20 == len(smtp_sink.messages)
+    assert 2 == smtp_sink.connections
+    assert set(
+        'Message {0}'.format(num) for num in range(10)
+    ) == set(
+        data.decode('utf8').splitlines()[-1]
+        if isinstance(data, bytes) else data.splitlines()[-1]
+        for _, rcpttos, data in smtp_sink.messages
+        if rcpttos == ('a@example.com',)
+    )
+    assert 10 == sum(
+        rcpttos == ('b@example.com', 'c@example.com')
+        for _, rcpttos, _ in smtp_sink.messages
+    )
+    # Nothing is left to send
+    dispatcher.flush()
+    assert 20 == len(smtp_sink.messages)
+
+
+@pytest.mark.parametrize(
+    ('max_connections', 'per_connection', 'exp_connections'),
+    [(1, 100, 1), (4, 100, 4), (8, 100, 5), (1, 3, 4)]
+)
+def test_connection_limits(
+    smtp_sink, max_connections, per_connection, exp_connections
+):
+    dispatcher = EmailDispatcher(max_connections, per_connection)
+    for num in range(10):
+        dispatcher.send(
+            smtp_sink.host,
+            make_msg(num, ['{0}@example.com'.format(num % 5)])
+        )
+    dispatcher.flush()
+    assert 10 == len(smtp_sink.messages)
+    assert exp_connections == smtp_sink.connections
+
+
+def test_send_errors(smtp_sink):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    closed_host = '{0}:{1}'.format(*sock.getsockname())
+    sock.close()
+    dispatcher = EmailDispatcher()
+    dispatcher.send(closed_host, make_msg(1, ['a@example.com']))
+    dispatcher.send(smtp_sink.host, make_msg(2, ['a@example.com']))
+    with pytest.raises(socket.error):
+        dispatcher.flush()
+    # Messages to working hosts are still sent
+    assert 1 == len(smtp_sink.messages)
+
+
+def test_report_status(smtp_sink):
+    changes = [NumberChange(num, num, ['a@example.com']) for num in range(5)]
+    for change in changes:
+        change.smtp_host = smtp_sink.host
+    with EmailDispatcher() as dispatcher:
+        assert EmailDispatcher.active is dispatcher
+        for change in changes:
+            change.report_status('added', 'some-queue', None)
+        assert not smtp_sink.messages
+    assert EmailDispatcher.active is None
+    assert 5 == len(smtp_sink.messages)
+    assert 1 == smtp_sink.connections
+    # Without an active dispatcher every report opens its own connection
+    for change in changes:
+        change.report_status('added', 'some-queue', None)
+    assert 10 == len(smtp_sink.messages)
+    assert 6 == smtp_sink.connections
@@ -9,7 +9,12 @@ import random
 import re
 from os import path
 import json
+from base64 import b64decode, b64encode
+from bz2 import compress, BZ2File
 
+from six.moves import cPickle as pickle
+
+from stdci_libs import object_codec
 from stdci_libs.jenkins_objects import JenkinsObject, NotInJenkins, JobRunSpec, \
     BuildPtr, BuildsList
 
@@ -68,6 +73,25 @@ class TestJobRunSpec(object):
         jrc = JobRunSpec('some-job', params)
         out = jrc.as_pipeline_build_step()
         assert expected == out
+        expected['quietPeriod'] = 30
+        out = jrc.as_pipeline_build_step(quiet_period=30)
+        assert expected == out
+
+    def test_as_pipeline_build_steps_json(self, tmpdir):
+        out_file = tmpdir.join('build_args.json')
+        JobRunSpec.as_pipeline_build_steps_json(
+            [
+                JobRunSpec('some-job', dict(SLOT='0')),
+                JobRunSpec('some-job', dict(SLOT='1')),
+            ],
+            str(out_file)
+        )
+        assert [
+            dict(job='some-job', parameters=[dict(
+                name='SLOT', value=slot, **{'$class': 'StringParameterValue'}
+            )])
+            for slot in ('0', '1')
+        ] == json.loads(out_file.read())
 
 
 class TestBuildPtr(object):
@@ -341,3 +365,28 @@ class TestJenkinsObject(object):
             assert id(nobj) != id(lobj)
             assert obj == lobj
             assert obj != nobj
+
+    def test_param_str_codec(self):
+        jrs = JobRunSpec('some-job', {'PARAM': 'value'})
+        prm_str = JenkinsObject.object_to_param_str(jrs)
+        assert re.match('^[A-Za-z0-9+/]*=*$', prm_str)
+        assert object_codec.is_encoded(b64decode(prm_str.encode('utf8')))
+        assert JenkinsObject.param_str_to_object(prm_str) == jrs
+
+    def test_legacy_param_str(self):
+        jrs = JobRunSpec('some-job', {'PARAM': 'value'})
+        prm_str = b64encode(compress(pickle.dumps(jrs))).decode('utf8')
+        assert JenkinsObject.param_str_to_object(prm_str) == jrs
+
+    def test_legacy_artifact(self, jenkins_env):
+        art_file = '_artifact.dat'
+        jrs = JobRunSpec('some-job', {'PARAM': 'value'})
+        JenkinsObject.verify_artifacts_dir()
+        fd = BZ2File(path.join(JenkinsObject.ARTIFACTS_DIR, art_file), 'w')
+        fd.write(pickle.dumps(jrs))
+        fd.close()
+        assert JenkinsObject.object_from_artifact(art_file) == jrs
+        JenkinsObject.object_to_artifact(jrs, art_file)
+        with open(path.join(JenkinsObject.ARTIFACTS_DIR, art_file), 'rb') as f:
+            assert object_codec.is_encoded(f.read())
+        assert JenkinsObject.object_from_artifact(art_file) == jrs
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""test_object_codec.py - Tests for object_codec.py
+"""
+from __future__ import absolute_import, print_function
+import pytest
+from bz2 import compress, decompress
+from collections import deque, namedtuple
+import json
+import random
+from time import time
+
+from six.moves import cPickle
+
+from stdci_libs import object_codec
+from stdci_libs.object_codec import encode, decode, is_encoded, CodecError
+from stdci_libs.jenkins_objects import JobRunSpec, BuildPtr, BuildsList, \
+    _cpickle_loads
+from stdci_libs.gerrit import GerritServer, GerritProject, GerritBranch, \
+    GerritChange, GerritPatchset, GerritPerson
+from stdci_libs.change_queue import JenkinsChangeQueue
+from stdci_libs.change_queue.changes import NumberChange, \
+    GerritMergedChange, GitMergedChange
+
+
+class UntrustedTuple(namedtuple('_UntrustedTuple', ('a', 'b'))):
+    pass
+
+
+def make_payload(obj, classes=(), shapes=()):
+    payload = json.dumps(dict(v=1, c=list(classes), k=list(shapes), o=obj))
+    return b'JOC1' + compress(payload.encode('utf8'))
+
+
+def make_gerrit_change(num, rnd=random):
+    server = GerritServer('gerrit.ovirt.org', 29418, 'ssh')
+    person = GerritPerson('Some One', 'some@one.org')
+    change = GerritChange(
+        branch=GerritBranch(
+            GerritProject(server, 'project{0}'.format(num % 10)), 'master'
+        ),
+        change_id='I{0:040x}'.format(rnd.getrandbits(160)),
+        number=num,
+        owner=person,
+        subject='Change {0} subject'.format(num),
+        url='https://gerrit.ovirt.org/{0}'.format(num),
+    )
+    chg = GerritMergedChange(GerritPatchset(
+        change=change,
+        refspec='refs/changes/{0}/1'.format(num),
+        patchset_number=1,
+        uploader=person,
+        revision='{0:040x}'.format(rnd.getrandbits(160)),
+        commit_message='Change {0} subject\n\nSome details'.format(num),
+        topic=None,
+    ))
+    chg.builds = BuildsList([BuildPtr(
+        'some-job', 'job/some-job', build_id=str(num),
+        build_url='job/some-job/{0}'.format(num),
+    )])
+    return chg
+
+
+@pytest.mark.parametrize('obj', [
+    None, True, False, 7, 2 ** 70, 3.5, 'a string', u'שלום',
+    b'\x00\xffbytes', [1, 'two', [3]], (1, (2, 3)), set([1, 2]),
+    frozenset(['a']), deque([1, 2, 3]), deque([1], 5),
+    {'a': 1, 2: 'b', (3, 4): [5]}, [{}, (), set()],
+])
+def test_builtins_round_trip(obj):
+    data = encode(obj)
+    assert is_encoded(data)
+    out = decode(data)
+    assert out == obj
+    assert type(out) == type(obj)
+    if isinstance(obj, deque):
+        assert out.maxlen == obj.maxlen
+
+
+def test_objects_round_trip():
+    chg = make_gerrit_change(1)
+    jrs = JobRunSpec('some-job', {'CHANGE': 'chg', 'FLAG': True})
+    num_chg = NumberChange(1, 2, ['some@one.org'])
+    num_chg.url = 'http://some.url'
+    git_chg = GitMergedChange('prj', 'master', 'a' * 40, 'http://some.url')
+    out_chg, out_jrs, out_num_chg, out_git_chg = \
+        decode(encode([chg, jrs, num_chg, git_chg]))
+    assert type(out_chg) == GerritMergedChange
+    assert out_chg.gerrit_patchset == chg.gerrit_patchset
+    assert out_chg.id == chg.id
+    assert type(out_chg.builds) == BuildsList
+    assert out_chg.builds == chg.builds
+    assert out_jrs == jrs
+    assert type(out_jrs) == JobRunSpec
+    assert out_num_chg == num_chg
+    assert out_num_chg.url == 'http://some.url'
+    assert out_git_chg.id == git_chg.id
+    assert out_git_chg.url == git_chg.url
+
+
+def test_shared_references():
+    bp = BuildPtr('job', 'job/url', build_id='1', build_url='job/1')
+    server = GerritServer('gerrit.ovirt.org', 29418, 'ssh')
+    out = decode(encode(
+        [bp, bp, server, GerritServer('gerrit.ovirt.org', 29418, 'ssh')]
+    ))
+    assert out[0] is out[1]
+    assert out[0] == bp
+    assert out[2] is out[3]
+    assert out[2] == server
+
+
+def test_queue_round_trip():
+    queue = JenkinsChangeQueue()
+    for num in range(20):
+        queue.add(make_gerrit_change(num))
+    queue.get_next_test()
+    queue.on_test_failure(queue._test_key)
+    out = decode(encode(queue))
+    assert type(out) == JenkinsChangeQueue
+    assert [[c.id for c in b] for b in queue._state] == \
+        [[c.id for c in b] for b in out._state]
+    assert queue._test_key == out._test_key
+    assert queue._failing_prefix == out._failing_prefix
+    for chg_id in queue._change_index:
+        assert queue.locate(chg_id) == out.locate(chg_id)
+    assert [c.id for c in queue.get_next_test()[1]] == \
+        [c.id for c in out.get_next_test()[1]]
+
+
+def test_untrusted_class_encode():
+    with pytest.raises(CodecError):
+        encode([UntrustedTuple(1, 2)])
+
+
+@pytest.mark.parametrize('class_name', [
+    'os:system', 'subprocess:Popen', 'test_object_codec:UntrustedTuple',
+    'stdci_libs.jenkins_objects:json', 'stdci_libs.no_such_module:Foo',
+    'stdci_libs.jenkins_objects', 'stdci_libs.jenkins_objects:NoSuchClass',
+])
+def test_untrusted_class_decode(class_name):
+    data = make_payload(dict(O=0, i=['ls']), [[class_name, None]])
+    with pytest.raises(CodecError):
+        decode(data)
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'not encoded', b'JOCx', b'JOC9' + compress(b'{}'),
+    b'JOC1garbage', b'JOC1' + compress(b'not json'),
+    b'JOC1' + compress(b'{"v":1}'),
+    make_payload(dict(X=1)),
+    make_payload(dict(R=1)),
+    make_payload(dict(O=1), [['stdci_libs.jenkins_objects:BuildPtr', None]]),
+    make_payload(
+        dict(O=0, a=[3]), [['stdci_libs.jenkins_objects:BuildPtr', None]]
+    ),
+])
+def test_malformed_data(data):
+    with pytest.raises(CodecError):
+        decode(data)
+
+
+def test_renamed_module():
+    data = make_payload(
+        dict(O=0, i=['some-job', dict(D=[])]),
+        [['scripts.jenkins_objects:JobRunSpec', ['job_name', 'params']]]
+    )
+    assert JobRunSpec('some-job', {}) == decode(data)
+
+
+def test_named_tuple_fields_by_name():
+    data = make_payload(
+        dict(O=0, i=['gerrit.ovirt.org', 'ssh', 'removed']),
+        [['stdci_libs.gerrit:GerritServer', ['host', 'schema', 'removed']]]
+    )
+    assert GerritServer('gerrit.ovirt.org', None, 'ssh') == decode(data)
+
+
+def test_no_code_runs_on_decode(monkeypatch):
+    def boom(*args, **kwargs):
+        raise AssertionError('Constructor called while decoding')
+    monkeypatch.setattr(BuildPtr, '__init__', boom)
+    bp = object.__new__(BuildPtr)
+    bp.__dict__.update(job_name='job', job_url='job/url')
+    out = decode(encode(bp))
+    assert out == bp
+
+
+def test_trusted_prefixes(monkeypatch):
+    monkeypatch.setattr(object_codec, 'TRUSTED_MODULE_PREFIXES', ('nope.',))
+    with pytest.raises(CodecError):
+        encode(BuildPtr('job', 'job/url'))
+    monkeypatch.undo()
+    data = encode(BuildPtr('job', 'job/url'))
+    monkeypatch.setattr(object_codec, 'TRUSTED_MODULE_PREFIXES', ('nope.',))
+    with pytest.raises(CodecError):
+        decode(data)
+
+
+@pytest.mark.parametrize('num_changes', [100, 1000])
+def test_benchmark_vs_pickle(num_changes):
+    """Compare the size and speed of the codec with the compressed pickle
+    format JenkinsObject used before
+    """
+    rnd = random.Random(num_changes)
+    queue = JenkinsChangeQueue()
+    for num in range(num_changes):
+        queue.add(make_gerrit_change(num, rnd))
+    queue.get_next_test()
+    queue.on_test_failure(queue._test_key)
+    results = {}
+    for name, dumps, loads in (
+        ('pickle', lambda o: compress(cPickle.dumps(o)),
+         lambda d: _cpickle_loads(decompress(d))),
+        ('codec', encode, decode),
+    ):
+        start = time()
+        data = dumps(queue)
+        encode_time = time() - start
+        start = time()
+        out = loads(data)
+        decode_time = time() - start
+        assert [[c.id for c in b] for b in queue._state] == \
+            [[c.id for c in b] for b in out._state]
+        results[name] = (len(data), encode_time, decode_time)
+        print('{0} changes, {1}: {2} bytes, encode {3:.3f}s, '
+              'decode {4:.3f}s'.format(num_changes, name, *results[name]))
+    assert results['codec'][0] <= results['pickle'][0] * 1.1
@@ -2,6 +2,7 @@
 """test_object_utils - Tests for object_utils
 """
 import pytest
+from timeit import timeit
 try:
     from unittest.mock import sentinel
 except ImportError:
@@ -9,6 +10,8 @@ except ImportError:
 
 from stdci_libs.object_utils import object_with_defaults, \
     object_with_cast_attrs, object_witp_opt_attrs, object_proxy
+from stdci_libs.change_queue.changes import DisplayableChangeWrapper, \
+    NumberChange
 
 
 class TestObjectWithDefaults(object):
@@ -267,3 +270,148 @@ class TestProxyWithOptAttrs(object):
         assert prx.child1 == sentinel.child1_custom
         assert obj.attr1 == sentinel.attr1_custom
         assert obj.child1 == sentinel.child1_custom
+
+
+class TestDescriptors(object):
+    class WithOptAttrs(object_witp_opt_attrs):
+        default_attr1 = sentinel.attr1_default
+
+        def _cast_attr1(self, value):
+            return (value,)
+
+    class WithOverridingProp(WithOptAttrs):
+        @property
+        def attr1(self):
+            return sentinel.attr1_prop
+
+    def test_overriding_prop_is_cast(self):
+        obj = self.WithOverridingProp()
+        assert obj.attr1 == (sentinel.attr1_prop,)
+        with pytest.raises(AttributeError):
+            obj.attr1 = sentinel.attr1_custom
+
+    def test_instance_defaults(self):
+        obj = self.WithOptAttrs()
+        obj.default_attr2 = sentinel.attr2_default
+        assert obj.attr2 == sentinel.attr2_default
+        with pytest.raises(AttributeError) as e:
+            obj.attr3
+        assert str(e.value).endswith("'attr3'")
+
+    def test_del_attr(self):
+        obj = self.WithOptAttrs()
+        obj.attr1 = sentinel.attr1_custom
+        del obj.attr1
+        assert obj.attr1 == (sentinel.attr1_default,)
+        with pytest.raises(AttributeError):
+            del obj.attr1
+
+    def test_class_access(self):
+        with pytest.raises(AttributeError):
+            self.WithOptAttrs.attr1
+        assert isinstance(self.WithOverridingProp.attr1, property)
+
+
+class _LegacyWithDefaults(object):
+    """The object_with_defaults implementation that looked up defaults on
+    every attribute access, used for comparison in the benchmark
+    """
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            name_no_unders = name[1:]
+            unders = '_'
+        else:
+            unders = ''
+            name_no_unders = name
+        if name_no_unders.startswith('default_'):
+            return super(_LegacyWithDefaults, self).__getattribute__(name)
+        default_name = unders + 'default_' + name_no_unders
+        try:
+            return getattr(self, default_name)
+        except AttributeError:
+            return super(_LegacyWithDefaults, self).__getattribute__(name)
+
+
+class _LegacyWithCastAttrs(object):
+    def __getattribute__(self, name):
+        try:
+            value = super(_LegacyWithCastAttrs, self).__getattribute__(name)
+        except AttributeError:
+            value = super(_LegacyWithCastAttrs, self).__getattr__(name)
+        try:
+            cast_method = getattr(self, '_cast_' + name)
+        except AttributeError:
+            return value
+        return cast_method(value)
+
+
+class _LegacyProxy(object):
+    __slots__ = ["_obj", "__weakref__"]
+
+    def __init__(self, obj):
+        object.__setattr__(self, "_obj", obj)
+
+    def __getattribute__(self, name):
+        try:
+            return super(_LegacyProxy, self).__getattribute__(name)
+        except AttributeError:
+            return getattr(object.__getattribute__(self, "_obj"), name)
+
+
+class _LegacyDisplayableChange(_LegacyWithCastAttrs, _LegacyWithDefaults):
+    @property
+    def default_id(self):
+        return self
+
+    @property
+    def default_presentable_id(self):
+        return self.id
+
+    def _cast_presentable_id(self, value):
+        return str(value)
+
+    default_url = None
+
+
+class _LegacyNumberChange(_LegacyDisplayableChange):
+    def __init__(self, id, number):
+        self.id = id
+        self.number = number
+
+
+class _LegacyDisplayableChangeWrapper(
+    _LegacyDisplayableChange, _LegacyProxy
+):
+    pass
+
+
+class _PlainChange(object):
+    def __init__(self, id):
+        self.id = id
+
+
+@pytest.mark.parametrize(('attr', 'make_new', 'make_legacy'), [
+    ('number', lambda: NumberChange(1, 2, ()),
+     lambda: _LegacyNumberChange(1, 2)),
+    ('url', lambda: NumberChange(1, 2, ()), lambda: _LegacyNumberChange(1, 2)),
+    ('presentable_id', lambda: DisplayableChangeWrapper(_PlainChange(1)),
+     lambda: _LegacyDisplayableChangeWrapper(_PlainChange(1))),
+    ('id', lambda: DisplayableChangeWrapper(_PlainChange(1)),
+     lambda: _LegacyDisplayableChangeWrapper(_PlainChange(1))),
+])
+def test_benchmark_attr_access(attr, make_new, make_legacy):
+    """Compare the per-access cost of attributes resolved by descriptors with
+    the cost of resolving them dynamically on every access
+    """
+    number = 2000
+    results = {}
+    for name, obj in (('legacy', make_legacy()), ('descriptors', make_new())):
+        results[name] = min(
+            timeit(lambda: getattr(obj, attr), number=number)
+            for _ in range(3)
+        ) / number
+        print('{0}.{1}: {2:.3f}us per access'.format(
+            name, attr, results[name] * 1e6
+        ))
+    assert getattr(make_new(), attr) == getattr(make_legacy(), attr)
+    assert results['descriptors'] < results['legacy']
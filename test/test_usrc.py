@@ -12,7 +12,9 @@ from six import iteritems
 from six.moves import map, builtins
 import yaml
 import re
+import signal
 import sys
+from threading import Lock, Thread
 try:
     from unittest.mock import MagicMock, call, sentinel, create_autospec
 except ImportError:
@@ -742,6 +744,115 @@ class TestGitUpstreamSource(object):
         ]
         assert out_files == sorted(ds_files + exp_files)
 
+    @pytest.mark.parametrize('materialize', ['hardlink', 'reflink'])
+    def test_files_format_handler_materialize(
+        self, upstream, downstream, git_last_sha, gerrit_push_map, tmpdir,
+        monkeypatch, materialize
+    ):
+        monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir / 'cache'))
+        monkeypatch.setattr(
+            usrc.BlobStore, '_hardlinks_safe', staticmethod(lambda: True)
+        )
+        gus = GitUpstreamSource(
+            str(upstream), 'master', git_last_sha(upstream),
+            dest_formats={'files': {'materialize': materialize}}
+        )
+        other_ws = tmpdir.mkdir('other_ws')
+        gus.get(str(downstream), gerrit_push_map)
+        gus.get(str(other_ws), gerrit_push_map)
+        for ws in (downstream, other_ws):
+            assert (ws / 'upstream_file.txt').read() == 'Upstream content'
+            assert (ws / 'file2').read() == 'Just a file'
+            assert (ws / 'link_to_file').readlink() == 'upstream_file.txt'
+        ds_stat = (downstream / 'file2').stat()
+        other_stat = (other_ws / 'file2').stat()
+        if materialize == 'hardlink':
+            assert ds_stat.ino == other_stat.ino
+            assert ds_stat.nlink == 3
+        else:
+            assert ds_stat.ino != other_stat.ino
+            (other_ws / 'file2').write('Changed')
+            assert (downstream / 'file2').read() == 'Just a file'
+        savings = yaml.safe_load((
+            tmpdir / 'cache' / usrc.CACHE_NAME / usrc.BLOB_STORE_NAME /
+            usrc.BLOB_STORE_SAVINGS_FILE
+        ).read())
+        assert len(savings) == 2
+        for record in savings:
+            assert record['url'] == str(upstream)
+            assert record['commit'] == gus.commit
+            assert record['symlink'] == 1
+            assert record['hardlink'] + record['reflink'] + record['copy'] \
+                == 4
+            if materialize == 'hardlink':
+                assert record['inodes_saved'] == 4
+                assert record['bytes_saved'] > 0
+
+    def test_files_format_handler_materialize_as_root(
+        self, upstream, downstream, git_last_sha, gerrit_push_map, tmpdir,
+        monkeypatch
+    ):
+        monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir / 'cache'))
+        monkeypatch.setattr(
+            usrc.BlobStore, '_hardlinks_safe', staticmethod(lambda: False)
+        )
+        gus = GitUpstreamSource(
+            str(upstream), 'master', git_last_sha(upstream),
+            dest_formats={'files': {'materialize': 'hardlink'}}
+        )
+        gus.get(str(downstream), gerrit_push_map)
+        assert (downstream / 'file2').stat().nlink == 1
+        (downstream / 'file2').write('Changed')
+        other_ws = tmpdir.mkdir('other_ws')
+        gus.get(str(other_ws), gerrit_push_map)
+        assert (other_ws / 'file2').read() == 'Just a file'
+
+    def test_files_format_handler_materialize_corrupt_blob(
+        self, upstream, downstream, git_last_sha, gerrit_push_map, tmpdir,
+        monkeypatch
+    ):
+        monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir / 'cache'))
+        gus = GitUpstreamSource(
+            str(upstream), 'master', git_last_sha(upstream),
+            dest_formats={'files': {'materialize': 'reflink'}}
+        )
+        gus.get(str(downstream), gerrit_push_map)
+        blob_store = usrc.BlobStore()
+        files = usrc.git_ls_files(gus.commit, git_func=gus._cache_git)
+        blob_path = blob_store.blob_path(files['file2'])
+        os.chmod(blob_path, 0o644)
+        with open(blob_path, 'w') as blob_file:
+            blob_file.write('Corrupted')
+        other_ws = tmpdir.mkdir('other_ws')
+        gus.get(str(other_ws), gerrit_push_map)
+        assert (other_ws / 'file2').read() == 'Just a file'
+        with open(blob_path) as blob_file:
+            assert blob_file.read() == 'Just a file'
+
+    def test_files_format_handler_materialize_with_filter(
+        self, upstream, tmpdir, git_last_sha, gerrit_push_map, monkeypatch
+    ):
+        monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir / 'cache'))
+        gus = GitUpstreamSource(
+            str(upstream), 'master', git_last_sha(upstream),
+            dest_formats={
+                'files': {'materialize': 'hardlink', 'filter': 'file*'}
+            }
+        )
+        ws = tmpdir.mkdir('ws')
+        gus.get(str(ws), gerrit_push_map)
+        assert sorted(f.basename for f in ws.listdir()) == ['file2', 'file3']
+
+    def test_files_format_handler_bad_materialize(
+        self, upstream, tmpdir, git_last_sha, gerrit_push_map
+    ):
+        gus = GitUpstreamSource(
+            str(upstream), 'master', git_last_sha(upstream),
+            dest_formats={'files': {'materialize': 'teleport'}}
+        )
+        with pytest.raises(usrc.ConfigError):
+            gus.get(str(tmpdir), gerrit_push_map)
+
     def test_branch_format_handler(
         self, monkeypatch, upstream, downstream, downstream_remote,
         git_at, git_last_sha, gerrit_push_map
@@ -779,6 +890,26 @@ class TestGitUpstreamSource(object):
             gerrit_push_map, dst_path='path', gen_source_repos=True
         )
 
+    def test_branch_format_handler_queued(
+        self, upstream, gerrit_push_map, git_last_sha
+    ):
+        gus = GitUpstreamSource(
+            str(upstream), 'master', git_last_sha(upstream), 'no',
+            {'branch': None}
+        )
+        branch_pusher = MagicMock()
+        gus._branch_format_handler(
+            gerrit_push_map, branch_pusher, push_url=str(upstream)
+        )
+        assert branch_pusher.add.call_count == 1
+        push_details, git_dir, commit, dst_branch = \
+            branch_pusher.add.call_args[0]
+        assert push_details.push_url == str(upstream)
+        assert git_dir == gus._cache_git_dir
+        assert commit == gus.commit
+        assert dst_branch == '_upstream_master_' + gus.commit[0:7]
+        assert not branch_pusher.push.called
+
     @pytest.mark.parametrize(
         'src_repos_file,files_dest_dir,expected_file_name',
         [
@@ -901,6 +1032,85 @@ class TestGitUpstreamSource(object):
         assert gus.dest_formats == dest_formats
         assert updated.files_dest_dir == files_dest_dir
 
+    def test_update_with_precheck(
+        self, gitrepo, upstream, git_last_sha, tmpdir, monkeypatch
+    ):
+        monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir / 'cache'))
+        url, branch, commit = str(upstream), 'master', git_last_sha(upstream)
+        gus = GitUpstreamSource(url, branch, commit)
+        updated = gus.updated(usrc.ls_remote(url))
+        assert updated is gus
+        refs_cache_file = (
+            tmpdir / 'cache' / usrc.CACHE_NAME /
+            os.path.basename(gus._cache_dir) / usrc.REMOTE_REFS_CACHE_FILE
+        )
+        assert ['checks'] == list(yaml.safe_load(refs_cache_file.read()))
+        fetch = MagicMock(side_effect=gus._fetch)
+        monkeypatch.setattr(gus, '_fetch', fetch)
+        updated = gus.updated(usrc.ls_remote(url))
+        assert updated is gus
+        assert not fetch.called
+        gitrepo('upstream', {
+            'msg': 'New US commit',
+            'files': {'upstream_file.txt': 'Updated US content'}
+        })
+        new_commit = git_last_sha(upstream)
+        updated = gus.updated(usrc.ls_remote(url))
+        assert fetch.called
+        assert updated.commit == new_commit
+        fetch.reset_mock()
+        updated = gus.updated(usrc.ls_remote(url))
+        assert not fetch.called
+        assert updated.commit == new_commit
+        # Checks of newer commits replace the older ones
+        updated.updated(usrc.ls_remote(url))
+        checks = yaml.safe_load(refs_cache_file.read())['checks']
+        assert [new_commit] == [chk['commit'] for chk in checks.values()]
+
+    @pytest.mark.parametrize('init_args,remote_refs,expected', [
+        (
+            dict(branch='master'),
+            {
+                'HEAD': 'sha1',
+                'refs/heads/master': 'sha1',
+                'refs/heads/other': 'sha2',
+                'refs/tags/v1': 'sha3',
+            },
+            {'refs/heads/master': 'sha1'},
+        ),
+        (
+            dict(branch='master', update_policy='tagged', tag_filter='v1*'),
+            {
+                'refs/heads/master': 'sha1',
+                'refs/tags/v1.0': 'sha3',
+                'refs/tags/v1.0^{}': 'sha4',
+                'refs/tags/v2.0': 'sha5',
+            },
+            {
+                'refs/heads/master': 'sha1',
+                'refs/tags/v1.0': 'sha3',
+                'refs/tags/v1.0^{}': 'sha4',
+            },
+        ),
+        (
+            dict(branch='master', update_policy='tagged', tag_filter='v1'),
+            {
+                'refs/heads/master': 'sha1',
+                'refs/tags/v1': 'sha3',
+                'refs/tags/v1/rc1': 'sha4',
+                'refs/tags/v10': 'sha5',
+            },
+            {
+                'refs/heads/master': 'sha1',
+                'refs/tags/v1': 'sha3',
+                'refs/tags/v1/rc1': 'sha4',
+            },
+        ),
+    ])
+    def test_relevant_remote_refs(self, init_args, remote_refs, expected):
+        gus = GitUpstreamSource('git://url.of/repo', commit='sha', **init_args)
+        assert gus._relevant_remote_refs(remote_refs) == expected
+
     def test_commit_details(self, upstream, git_last_sha, git_at):
         url, branch, commit = str(upstream), 'master', git_last_sha(upstream)
         git = git_at(upstream)
@@ -1023,6 +1233,47 @@ class TestGitUpstreamSource(object):
         assert isinstance(tags, str)
         assert tags == ''
 
+    @pytest.mark.parametrize('tag_filter,expected', [
+        (None, None),
+        ('a*', '+refs/tags/a*:refs/tags/a*'),
+        ('v1.*-rc', '+refs/tags/v1.*-rc:refs/tags/v1.*-rc'),
+        ('a_tag', '+refs/tags/a_tag*:refs/tags/a_tag*'),
+        ('*_tag*', None),
+        ('?_tag', None),
+        ('[ab]_tag', None),
+    ])
+    def test_tag_refspec(self, tag_filter, expected):
+        gus = GitUpstreamSource(
+            url='https://gerrit.ovirt.org/some-project',
+            branch='master',
+            commit='master',
+            tag_filter=tag_filter
+        )
+        assert gus._tag_refspec() == expected
+
+    @pytest.mark.parametrize('tag_filter,expected', [
+        (None, ['a_tag', 'b_tag', 'c_tag', 'd_tag']),
+        ('a*', ['a_tag']),
+        ('c_tag', ['c_tag']),
+        ('blabla', []),
+    ])
+    def test_fetch_narrows_tags(
+        self, tag_filter, expected,
+        upstream_scenarios_for_tests, tmpdir, monkeypatch
+    ):
+        monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir))
+        gus = GitUpstreamSource(
+            url=str(upstream_scenarios_for_tests),
+            branch='master',
+            commit='master',
+            tag_filter=tag_filter
+        )
+        gus._fetch()
+        out = gus._cache_git(
+            'for-each-ref', '--format=%(refname:short)', 'refs/tags'
+        ).split()
+        assert out == expected
+
     @pytest.mark.parametrize('tags_yaml_struct,expected', [
         ([], []),
         (
@@ -1154,6 +1405,296 @@ def updated_upstream(gitrepo, upstream, downstream):
     })
 
 
+def test_branch_pusher(
+    monkeypatch, gitrepo, upstream, downstream_remote, git_at, git_last_sha
+):
+    upstream2 = gitrepo('upstream2', {'files': {'file.txt': 'content'}})
+    sources = [
+        GitUpstreamSource(str(upstream), 'master', git_last_sha(upstream)),
+        GitUpstreamSource(str(upstream2), 'master', git_last_sha(upstream2)),
+    ]
+    push_details = MagicMock(push_url=str(downstream_remote), host_key=None)
+    branch_pusher = usrc.BranchPusher()
+    for gus in sources:
+        gus._fetch()
+        branch_pusher.add(
+            push_details, gus._cache_git_dir, gus.commit, 'br_' + gus.commit
+        )
+    git_spy = MagicMock(side_effect=usrc.git)
+    monkeypatch.setattr(usrc, 'git', git_spy)
+    branch_pusher.push()
+    push_calls = [c for c in git_spy.call_args_list if 'push' in c[0]]
+    assert len(push_calls) == 1
+    remote_git = git_at(downstream_remote)
+    for gus in sources:
+        assert remote_git('rev-parse', 'br_' + gus.commit).strip() == \
+            gus.commit
+    git_spy.reset_mock()
+    for gus in sources:
+        branch_pusher.add(
+            push_details, gus._cache_git_dir, gus.commit, 'br_' + gus.commit
+        )
+    branch_pusher.push()
+    assert not [c for c in git_spy.call_args_list if 'push' in c[0]]
+
+
+def test_ls_remote(upstream, git_last_sha, git_at):
+    git_at(upstream)('tag', '-a', 'v1', '-m', 'v1')
+    out = usrc.ls_remote(str(upstream), ['refs/heads/*', 'refs/tags/*'])
+    assert out == {
+        'refs/heads/master': git_last_sha(upstream),
+        'refs/tags/v1': git_at(upstream)('rev-parse', 'v1').strip(),
+        'refs/tags/v1^{}': git_last_sha(upstream),
+    }
+
+
+def test_ls_remote_upstream_sources(monkeypatch, tmpdir):
+    monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir))
+    ls_remote = MagicMock(side_effect=(
+        sentinel.refs1, GitProcessError(128, 'git'), sentinel.refs2
+    ))
+    monkeypatch.setattr(usrc, 'ls_remote', ls_remote)
+    sources = [
+        GitUpstreamSource('git://url/1', 'master', 'sha'),
+        GitUpstreamSource('git://url/2', 'master', 'sha'),
+        GitUpstreamSource(
+            'git://url/1', 'b1', 'sha', update_policy='tagged',
+            tag_filter='v*',
+        ),
+        GitUpstreamSource('git://url/3', 'master', 'sha'),
+    ]
+    out = usrc.ls_remote_upstream_sources(sources)
+    assert ls_remote.call_args_list == [
+        call('git://url/1', ['refs/heads/b1', 'refs/heads/master',
+                             'refs/tags/v*'], None),
+        call('git://url/2', ['refs/heads/master'], None),
+        call('git://url/3', ['refs/heads/master'], None),
+    ]
+    assert out == {
+        'git://url/1': sentinel.refs1, 'git://url/3': sentinel.refs2
+    }
+
+
+def test_git_timeout():
+    with pytest.raises(usrc.GitTimeoutError) as error:
+        usrc.git(
+            '-c', 'protocol.ext.allow=always', 'ls-remote', 'ext::sleep 30',
+            timeout=0.5
+        )
+    assert error.value.timeout == 0.5
+    assert 'timed out after 0.5 seconds' in str(error.value)
+
+
+def test_git_finished_at_timeout(monkeypatch):
+    """A command that finishes just as its timer fires has succeeded"""
+    killpg = MagicMock()
+    monkeypatch.setattr(usrc.os, 'killpg', killpg)
+
+    class FiringTimer(object):
+        def __init__(self, delay, function, args):
+            self.function, self.args = function, args
+
+        def start(self):
+            self.function(*self.args)
+
+        def cancel(self):
+            pass
+    monkeypatch.setattr(usrc, 'Timer', FiringTimer)
+    assert usrc.git('--version', timeout=30).startswith('git version')
+    assert killpg.called
+
+
+def test_terminate_process_group_when_done(monkeypatch):
+    killpg = MagicMock()
+    monkeypatch.setattr(usrc.os, 'killpg', killpg)
+    process = MagicMock(pid=12345, returncode=None)
+    terminated = [None]
+    usrc._terminate_process_group(
+        process, signal.SIGTERM, terminated, Lock()
+    )
+    assert not killpg.called
+    terminated = []
+    usrc._terminate_process_group(
+        process, signal.SIGTERM, terminated, Lock()
+    )
+    killpg.assert_called_once_with(12345, signal.SIGTERM)
+    assert [signal.SIGTERM] == terminated
+
+
+def test_git_error_stderr():
+    with pytest.raises(GitProcessError) as error:
+        usrc.git('no-such-git-command')
+    assert error.value.stderr
+
+
+@pytest.mark.parametrize('error,expected', [
+    (usrc.GitTimeoutError(-15, ['git'], 10), True),
+    (GitProcessError(128, ['git']), False),
+    (
+        MagicMock(
+            spec=GitProcessError,
+            stderr='fatal: unable to access: Could not resolve host: foo',
+        ),
+        True
+    ),
+    (
+        MagicMock(
+            spec=GitProcessError,
+            stderr='fatal: The remote end hung up unexpectedly',
+        ),
+        True
+    ),
+    (
+        MagicMock(
+            spec=GitProcessError,
+            stderr="fatal: couldn't find remote ref refs/heads/nope",
+        ),
+        False
+    ),
+])
+def test_is_transient_git_error(error, expected):
+    assert usrc.is_transient_git_error(error) == expected
+
+
+@pytest.mark.parametrize('side_effect,retries,expected_calls,should_raise', [
+    ((sentinel.out,), 2, 1, False),
+    ((usrc.GitTimeoutError(-15, ['git'], 1), sentinel.out), 2, 2, False),
+    ((usrc.GitTimeoutError(-15, ['git'], 1),) * 3, 2, 3, True),
+    ((usrc.GitTimeoutError(-15, ['git'], 1),) * 3, 0, 1, True),
+    ((GitProcessError(128, ['git']), sentinel.out), 2, 1, True),
+])
+def test_retry_transient(
+    monkeypatch, side_effect, retries, expected_calls, should_raise
+):
+    sleep = MagicMock()
+    monkeypatch.setattr(usrc, 'sleep', sleep)
+    func = MagicMock(side_effect=side_effect)
+    if should_raise:
+        with pytest.raises(GitProcessError):
+            usrc.retry_transient(func, retries, 'testing')
+    else:
+        out = usrc.retry_transient(func, retries, 'testing')
+        assert out == sentinel.out
+    assert func.call_count == expected_calls
+    assert sleep.call_args_list == [
+        call(usrc.NETWORK_RETRY_BACKOFF * 2 ** i)
+        for i in range(expected_calls - 1)
+    ]
+
+
+def test_network_op_settings_and_timings(monkeypatch, tmpdir):
+    monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir))
+    monkeypatch.setattr(usrc, 'sleep', MagicMock())
+    gus = GitUpstreamSource.from_yaml_struct(dict(
+        url='git://url/1', branch='master', commit='sha', timeout=30,
+    ))
+    assert gus.to_yaml_struct()['timeout'] == 30
+    gus.set_network_defaults(timeout=5, retries=1)
+    assert 'retries' not in gus.to_yaml_struct()
+    func = MagicMock(side_effect=(
+        usrc.GitTimeoutError(-15, ['git'], 30), sentinel.out,
+    ))
+    assert gus._network_op('fetch', func) == sentinel.out
+    assert func.call_args_list == [call(30), call(30)]
+    func = MagicMock(side_effect=(usrc.GitTimeoutError(-15, ['git'], 30),) * 2)
+    with pytest.raises(usrc.GitTimeoutError):
+        gus._network_op('fetch', func)
+    timings = yaml.safe_load(
+        (tmpdir / usrc.CACHE_NAME / os.path.basename(gus._cache_dir) /
+         usrc.TIMINGS_FILE).read()
+    )
+    assert [(t['operation'], t['attempts'], t['status']) for t in timings] \
+        == [('fetch', 2, 'ok'), ('fetch', 2, 'timeout')]
+    assert all(t['url'] == 'git://url/1' for t in timings)
+
+
+def test_url_health(monkeypatch, tmpdir):
+    now = [1000]
+    monkeypatch.setattr(usrc, 'time', lambda: now[0])
+    url_health = usrc.UrlHealth(str(tmpdir / 'health.yaml'))
+    urls = ['mirror1', 'mirror2', 'canonical']
+    assert url_health.rank(urls) == urls
+    url_health.record('mirror1', 10)
+    url_health.record('mirror2', 2)
+    url_health.record('canonical', 5)
+    assert url_health.rank(urls) == ['mirror2', 'canonical', 'mirror1']
+    assert url_health.rank(urls + ['new']) == \
+        ['new', 'mirror2', 'canonical', 'mirror1']
+    url_health.record('mirror1', 1)
+    assert url_health.load()['mirror1']['latency'] == 7.3
+    url_health.record('mirror2', failed=True)
+    assert url_health.rank(urls) == ['canonical', 'mirror1', 'mirror2']
+    now[0] += usrc.URL_FAILURE_COOLDOWN
+    assert url_health.rank(urls) == ['mirror2', 'canonical', 'mirror1']
+    url_health.record('mirror2', failed=True)
+    url_health.record('mirror2', failed=True)
+    now[0] += usrc.URL_FAILURE_COOLDOWN * 3
+    assert url_health.rank(urls) == ['canonical', 'mirror1', 'mirror2']
+    url_health.record('mirror2', 3)
+    assert url_health.load()['mirror2']['failures'] == 0
+    assert url_health.rank(urls) == ['mirror2', 'canonical', 'mirror1']
+
+
+def test_url_health_concurrent_records(tmpdir):
+    url_health = usrc.UrlHealth(str(tmpdir / 'cache' / 'health.yaml'))
+
+    def record(url):
+        for seconds in range(10):
+            url_health.record(url, seconds)
+    threads = [
+        Thread(target=record, args=('mirror{0}'.format(i),))
+        for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(url_health.load()) == [
+        'mirror{0}'.format(i) for i in range(8)
+    ]
+
+
+def test_fetch_from_mirrors(
+    monkeypatch, tmpdir, gitrepo, upstream, git, git_at, git_last_sha
+):
+    monkeypatch.setattr(usrc, 'xdg_cache_home', str(tmpdir / 'cache'))
+    mirror = tmpdir / 'mirror'
+    git('clone', '--bare', '-q', str(upstream), str(mirror))
+    broken_mirror = tmpdir / 'no-such-mirror'
+    gus = GitUpstreamSource.from_yaml_struct(dict(
+        url=str(upstream), branch='master', commit=git_last_sha(upstream),
+        mirrors=[str(broken_mirror), str(mirror)], retries=0,
+    ))
+    assert gus.to_yaml_struct()['mirrors'] == \
+        [str(broken_mirror), str(mirror)]
+    url_health = usrc.UrlHealth()
+    fetches = []
+    orig_cache_git = gus._cache_git
+
+    def cache_git(*args, **kwargs):
+        if args[0] == 'fetch':
+            fetches.append(args[2])
+        return orig_cache_git(*args, **kwargs)
+
+    monkeypatch.setattr(gus, '_cache_git', cache_git)
+    gus._fetch()
+    assert fetches == [str(broken_mirror), str(mirror)]
+    assert gus._rev_parse('origin/master') == gus.commit
+    assert url_health.load()[str(broken_mirror)]['failures'] == 1
+    assert 'latency' in url_health.load()[str(mirror)]
+    # The mirror lags behind upstream, so we fall back to upstream
+    url_health.record(str(upstream), 1000)
+    gitrepo('upstream', {'msg': 'New US commit', 'files': {'f': 'new'}})
+    new_commit = git_last_sha(upstream)
+    del fetches[:]
+    gus._fetch([new_commit])
+    assert fetches == [str(mirror), str(upstream)]
+    assert gus._rev_parse('origin/master') == new_commit
+    assert gus._cache_dir.endswith(
+        usrc.sha1(str(upstream).encode('utf-8')).hexdigest()
+    )
+
+
 def test_update_upstream_sources(
     monkeypatch, gerrit_push_map, updated_upstream, downstream, git_status
 ):